@@ -25,6 +25,7 @@ setup(name="zgres",
               ],
           'zgres.deadman': [
               'apt = zgres.apt:AptPostgresqlPlugin',
+              'fake-postgresql = zgres.fakepg:FakePostgresqlPlugin',
               'ec2 = zgres.ec2:Ec2Plugin',
               'follow-the-leader = zgres.replication:FollowTheLeader',
               'select-furthest-ahead-replica = zgres.replication:SelectFurthestAheadReplica',
@@ -0,0 +1,64 @@
+"""Compare the encodings of DCS values: bytes on the wire and CPU per event.
+
+Every watcher decodes a value on each change, so decode time is paid once per
+event by every deadman and zgres-sync watching the group. Encodings which need
+msgpack are skipped if it is not installed:
+
+    python3 testscripts/codec_benchmark.py --runs 20000
+"""
+import sys
+import timeit
+import argparse
+import importlib.util
+
+from zgres.codec import Codec, decode
+
+def _state(problems):
+    return {
+            'replication_role': 'replica',
+            'willing': 1466000000.123,
+            'pg_last_xlog_replay_location': '2F/3A000060',
+            'pg_last_xlog_receive_location': '2F/3A000060',
+            'timeline': 7,
+            'database_identifier': '6286123487541234567',
+            'health_problems': dict(
+                ('zgres#check-{}'.format(i), {'can_be_replica': True, 'reason': 'check {} is failing'.format(i)})
+                for i in range(problems)),
+            }
+
+PAYLOADS = {
+        'stats': {'pg_last_xlog_replay_location': '2F/3A000060', 'replay_lag_seconds': 0.25},
+        'state': _state(0),
+        'large-state': _state(40),
+        }
+
+ENCODINGS = [
+        ('json', 'json', None),
+        ('json+zlib', 'json', 256),
+        ('msgpack', 'msgpack', None),
+        ('msgpack+zlib', 'msgpack', 256),
+        ]
+
+def main(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=10000)
+    args = parser.parse_args(argv)
+    print('{:12} {:14} {:>7} {:>11} {:>11}'.format('payload', 'encoding', 'bytes', 'encode us', 'decode us'))
+    for payload_name, payload in sorted(PAYLOADS.items()):
+        for name, encoding, compress_above in ENCODINGS:
+            if encoding == 'msgpack' and importlib.util.find_spec('msgpack') is None:
+                continue
+            codec = Codec(encoding, compress_above=compress_above)
+            data = codec.encode(payload)
+            assert decode(data) == payload
+            encode_time = min(timeit.repeat(lambda: codec.encode(payload), number=args.runs, repeat=3))
+            decode_time = min(timeit.repeat(lambda: decode(data), number=args.runs, repeat=3))
+            print('{:12} {:14} {:7} {:11.2f} {:11.2f}'.format(
+                payload_name,
+                name,
+                len(data),
+                encode_time / args.runs * 1e6,
+                decode_time / args.runs * 1e6))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,560 @@
+"""Simulate failovers of a group of deadman nodes in virtual time.
+
+Every node is a real zgres.deadman.App with the zookeeper, fake-postgresql,
+follow-the-leader and select-furthest-ahead-replica plugins. All nodes run in
+one process on one event loop against one in-memory (zake) ZooKeeper. Time is
+virtual: when nothing is ready to run, the clock jumps to the next timer. A
+simulated hour takes seconds and a run is repeatable for a given seed (and
+PYTHONHASHSEED).
+
+The faults which can be injected into the master are:
+
+    crash       PostgreSQL and the network of the master die, its ZooKeeper
+                session expires after the session timeout
+    expire      the ZooKeeper session of the master expires
+    partition   the master cannot reach ZooKeeper for partition_time seconds
+
+A run bootstraps a master and its replicas, waits till the replicas are
+willing to take over, injects the fault and measures the time till a master
+holds the lock and is out of recovery. Sweeping parameters gives failover time
+distributions:
+
+    python3 testscripts/simulate.py --replicas 1 2 4 --tick-time 0.5 1 2 --runs 20 --fault crash
+
+This is a test tool, it needs zake (like the tests) and zgres installed.
+
+How the simulation differs from reality:
+
+    * Blocking hooks run immediately, but their result arrives after the
+      (virtual) time they spent sleeping, as if they ran in a thread.
+    * Time spent sleeping on the event loop (e.g. ZooKeeper retries) only delays
+      what that callback schedules afterwards, other nodes carry on.
+    * ZooKeeper operations take no time and the connection is suspended as soon
+      as the network breaks.
+"""
+import sys
+import time
+import random
+import asyncio
+import logging
+import argparse
+import selectors
+import statistics
+import concurrent.futures
+from unittest import mock
+from contextlib import ExitStack
+
+import kazoo.retry
+import kazoo.exceptions
+from kazoo.client import KazooState
+from kazoo.handlers.threading import SequentialThreadingHandler, KazooTimeoutError
+from zake.fake_client import FakeClient
+from zake.fake_storage import FakeStorage
+
+import zgres.deadman
+import zgres.publish
+import zgres.zookeeper
+import zgres.utils
+from zgres import fakepg
+from zgres.deadman import App
+from zgres.scheduler import HealthCheckScheduler
+
+_logger = logging.getLogger('zgres.simulate')
+
+FAULTS = ('crash', 'expire', 'partition')
+
+class _VirtualSelector(selectors.DefaultSelector):
+    """Never waits for a timer, moves the clock of the loop forward instead"""
+
+    loop = None
+
+    def select(self, timeout=None):
+        events = super().select(0)
+        if events or timeout == 0:
+            return events
+        if timeout is None:
+            # no timers, only something outside the simulation can wake us
+            return super().select(None)
+        self.loop.advance(timeout)
+        return []
+
+class VirtualTimeLoop(asyncio.SelectorEventLoop):
+    """An event loop with a virtual clock.
+
+    The clock stands still while callbacks run, unless they sleep (see
+    VirtualClock.sleep). The time a callback slept delays everything it
+    schedules, but not other callbacks.
+    """
+
+    def __init__(self):
+        selector = _VirtualSelector()
+        super().__init__(selector)
+        selector.loop = self
+        self._now = 0.0
+        self._stall = 0.0
+
+    def time(self):
+        return self._now + self._stall
+
+    def advance(self, seconds):
+        self._now += max(0, seconds)
+
+    def stall(self, seconds):
+        """The running callback blocks for seconds"""
+        self._stall += max(0, seconds)
+
+    def _run_stalling(self, callback, *args):
+        self._stall = 0.0
+        try:
+            return callback(*args)
+        finally:
+            self._stall = 0.0
+
+    def call_soon(self, callback, *args, **kw):
+        return super().call_soon(self._run_stalling, callback, *args, **kw)
+
+    def call_soon_threadsafe(self, callback, *args, **kw):
+        return super().call_soon_threadsafe(self._run_stalling, callback, *args, **kw)
+
+    def call_at(self, when, callback, *args, **kw):
+        return super().call_at(when, self._run_stalling, callback, *args, **kw)
+
+class VirtualClock:
+    """Replaces the time module in the modules being simulated"""
+
+    def __init__(self, loop, epoch=1500000000.0):
+        self._loop = loop
+        self._epoch = epoch
+
+    def time(self):
+        return self._epoch + self._loop.time()
+
+    def monotonic(self):
+        return self._loop.time()
+
+    def sleep(self, seconds):
+        self._loop.stall(seconds)
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+class InlineExecutor(concurrent.futures.Executor):
+    """Runs blocking calls immediately, as if they ran in a thread.
+
+    The result arrives after the virtual time the call spent sleeping.
+    """
+
+    def __init__(self, loop):
+        self._loop = loop
+
+    def submit(self, fn, *args, **kw):
+        future = concurrent.futures.Future()
+        stalled, self._loop._stall = self._loop._stall, 0.0
+        try:
+            result = fn(*args, **kw)
+        except BaseException as e:
+            set_result = future.set_exception
+            result = e
+        else:
+            set_result = future.set_result
+        finally:
+            took, self._loop._stall = self._loop._stall, stalled
+        self._loop.call_later(took, set_result, result)
+        return future
+
+    def shutdown(self, wait=True, *, cancel_futures=False):
+        pass
+
+class SynchronousHandler(SequentialThreadingHandler):
+    """A kazoo handler which calls back immediately, without threads"""
+
+    def __init__(self, clock):
+        super().__init__()
+        self.sleep_func = clock.sleep
+
+    def start(self):
+        self._running = True
+
+    def stop(self):
+        self._running = False
+
+    def spawn(self, func, *args, **kw):
+        func(*args, **kw)
+
+    def dispatch_callback(self, callback):
+        try:
+            callback.func(*callback.args)
+        except Exception:
+            _logger.exception('Error in kazoo callback')
+
+class SimClient(FakeClient):
+    """A zake client on the network of a simulated node.
+
+    While the node is partitioned, operations fail with ConnectionLoss and
+    watches are held back. If the partition lasts longer than the session
+    timeout, the server expires the session.
+    """
+
+    _expiry = None
+
+    def __init__(self, node, storage, timeout):
+        super().__init__(handler=node.sim.handler, storage=storage)
+        self._node = node
+        self._timeout = timeout
+        self._missed = []
+        self._retry = kazoo.retry.KazooRetry(sleep_func=node.sim.clock.sleep)
+
+    @property
+    def client_id(self):
+        return (self.session_id, b'')
+
+    def verify(self):
+        super().verify()
+        if self._node.partitioned:
+            raise kazoo.exceptions.ConnectionLoss('Network partitioned')
+
+    def start(self, timeout=None):
+        if self._node.partitioned:
+            raise KazooTimeoutError('Connection time-out')
+        super().start(timeout=timeout)
+
+    def close(self, close_handler=True):
+        if not (self._node.partitioned and self._connected):
+            return super().close(close_handler=close_handler)
+        # the server does not hear us leave, our session expires after the timeout
+        with self._open_close_lock:
+            self._connected = False
+            with self._watches_lock:
+                self._child_watchers.clear()
+                self._data_watchers.clear()
+            self._fire_state_change(KazooState.LOST)
+
+    def _fire_watches(self, paths, event, watch_source):
+        if self._node.partitioned:
+            self._missed.append((paths, event, watch_source))
+            return
+        super()._fire_watches(paths, event, watch_source)
+
+    def suspend(self):
+        if self._expiry is None:
+            self._expiry = self._node.sim.loop.call_later(self._timeout, self._expire_on_server)
+        if self._connected:
+            self._fire_state_change(KazooState.SUSPENDED)
+
+    def resume(self):
+        if self._expiry is not None:
+            self._expiry.cancel()
+            self._expiry = None
+        if not self._connected:
+            return
+        if self.expired:
+            self.close()
+            return
+        self._fire_state_change(KazooState.CONNECTED)
+        missed, self._missed = self._missed, []
+        for paths, event, watch_source in missed:
+            super()._fire_watches(paths, event, watch_source)
+
+    def _expire_on_server(self):
+        self._expiry = None
+        self.expired = True
+        self._missed = []
+        self.storage.purge(self)
+
+    def expire(self):
+        """The server expires our session right now"""
+        self.expired = True
+        self.close()
+
+class SimNode:
+    """A simulated host: the supervisor of its deadman App"""
+
+    app = None
+    client = None
+    crashed = False
+    partitioned = False
+    restarts = 0
+
+    def __init__(self, sim, name, config):
+        self.sim = sim
+        self.name = name
+        self.config = config
+        self.tick_time = float(config['deadman']['tick_time'])
+        self.scheduler = HealthCheckScheduler(config['deadman'])
+        self.executor = InlineExecutor(sim.loop)
+
+    @property
+    def pg(self):
+        return self.sim.cluster.nodes.get(self.name)
+
+    def acquire_shared(self, key, factory):
+        return factory()
+
+    def release_shared(self, key):
+        return True
+
+    def connect(self, hosts, timeout):
+        self.client = SimClient(self, self.sim.storage, timeout)
+        return self.client
+
+    def start(self):
+        if self.crashed:
+            return
+        app = self.app = App(self.config, supervisor=self, cluster=self.name)
+        try:
+            timeout = app.initialize()
+        except Exception:
+            _logger.exception('Failed to initialize {}'.format(self.name))
+            timeout = 10
+        if timeout is None:
+            return
+        try:
+            app.restart(timeout)
+        except Exception:
+            _logger.exception('Failed to shut down {}'.format(self.name))
+            if self.app is app:
+                self.restart(app, timeout)
+
+    def restart(self, app, timeout):
+        if self.app is app:
+            self.app = None
+        if self.crashed or self.sim.stopped:
+            return
+        self.restarts += 1
+        self.sim.loop.call_later(timeout * self.tick_time, self.start)
+
+    @property
+    def role(self):
+        if self.app is None or self.crashed:
+            return None
+        return self.app.replication_role
+
+    def crash(self):
+        self.crashed = True
+        if self.pg is not None:
+            self.pg.position()
+            self.pg.running = False
+        self.partition()
+        app = self.app
+        if app is not None:
+            # the process is gone, nothing runs any more
+            app._stopped = True
+            app._scheduler.stop()
+            app._publisher.close()
+
+    def partition(self, duration=None):
+        self.partitioned = True
+        if self.client is not None:
+            self.client.suspend()
+        if duration is not None:
+            self.sim.loop.call_later(duration, self.heal)
+
+    def heal(self):
+        if self.crashed:
+            return
+        self.partitioned = False
+        if self.client is not None:
+            self.client.resume()
+
+class Simulation:
+    """A group of deadman nodes sharing one virtual ZooKeeper and fake cluster"""
+
+    group = 'sim'
+    path = '/databases'
+    stopped = False
+
+    def __init__(self, replicas=2, tick_time=1.0, zk_timeout=10.0, latency=0.0, seed=0, config=None):
+        self.replicas = replicas
+        self.tick_time = tick_time
+        self.zk_timeout = zk_timeout
+        self.latency = latency
+        self.seed = seed
+        self.config = config or {}
+        self.loop = VirtualTimeLoop()
+        self.clock = VirtualClock(self.loop)
+        self.handler = SynchronousHandler(self.clock)
+        self.storage = FakeStorage(self.handler)
+        self.cluster = None
+        self.nodes = {}
+
+    def _node_config(self, name):
+        config = {
+                'deadman': {
+                    'plugins': '\n'.join([
+                        'zgres#zookeeper',
+                        'zgres#fake-postgresql',
+                        'zgres#follow-the-leader',
+                        'zgres#select-furthest-ahead-replica']),
+                    'tick_time': self.tick_time,
+                    'initialize_workers': '0',
+                    },
+                'zookeeper': {
+                    'connection_string': name,
+                    'path': self.path,
+                    'group': self.group,
+                    'timeout': str(self.zk_timeout),
+                    },
+                'fake-postgresql': {
+                    'cluster': self._cluster_name,
+                    'node_id': name,
+                    'latency': str(self.latency),
+                    },
+                }
+        for section, options in self.config.items():
+            config.setdefault(section, {}).update(options)
+        return config
+
+    def _connect(self, hosts, timeout=10.0, **kw):
+        return self.nodes[hosts].connect(hosts, timeout)
+
+    def lock_owner(self):
+        path = '{}/lock/{}-master'.format(self.path, self.group)
+        try:
+            data, stat = self.storage.get(path)
+        except KeyError:
+            return None
+        return data.decode('utf-8')
+
+    def master(self):
+        """The node which holds the lock and is out of recovery, if any"""
+        node = self.nodes.get(self.lock_owner())
+        if node is None or node.crashed or node.role != 'master':
+            return None
+        return node
+
+    def run_for(self, seconds):
+        self.loop.run_until_complete(asyncio.sleep(seconds))
+
+    def run_until(self, predicate, timeout, step=0.05):
+        """Run till predicate() is true, returns the virtual time it took or None"""
+        start = self.loop.time()
+        while self.loop.time() - start < timeout:
+            if predicate():
+                return self.loop.time() - start
+            self.run_for(step)
+        return None
+
+    def _patch(self, stack):
+        for module in (zgres.deadman, zgres.publish, zgres.zookeeper, zgres.utils, kazoo.retry):
+            stack.enter_context(mock.patch.object(module, 'time', self.clock))
+        stack.enter_context(mock.patch.object(zgres.zookeeper, 'KazooClient', self._connect))
+        # every node connects with its own name, so it gets a session of its own
+        stack.enter_context(mock.patch.object(zgres.zookeeper, 'sessions', zgres.zookeeper.SessionRegistry()))
+
+    def failover(self, fault='crash', partition_time=None, warmup=700, timeout=600):
+        """Inject fault into the master, returns the failover time in seconds.
+
+        None is returned if there was no master timeout seconds after the fault.
+        """
+        if fault not in FAULTS:
+            raise ValueError('Unknown fault {}, choose one of: {}'.format(fault, ', '.join(FAULTS)))
+        if partition_time is None:
+            partition_time = 2 * self.zk_timeout
+        random.seed(self.seed)
+        self._cluster_name = 'simulate-{}'.format(id(self))
+        asyncio.set_event_loop(self.loop)
+        with ExitStack() as stack:
+            self._patch(stack)
+            stack.callback(self._shutdown)
+            self.cluster = fakepg.get_cluster(
+                    self._cluster_name,
+                    clock=self.clock.monotonic,
+                    sleep=self.clock.sleep)
+            stack.callback(fakepg.remove_cluster, self._cluster_name)
+            names = ['node{}'.format(i) for i in range(self.replicas + 1)]
+            for name in names:
+                self.nodes[name] = SimNode(self, name, self._node_config(name))
+            # the first node bootstraps the master, the others restore from its backup
+            self.nodes[names[0]].start()
+            for name in names[1:]:
+                self.loop.call_later(self.tick_time, self.nodes[name].start)
+            self.run_for(warmup)
+            old = self.master()
+            if old is None:
+                raise RuntimeError('No master after warming up for {}s'.format(warmup))
+            _logger.info('Injecting {} into master {}'.format(fault, old.name))
+            if fault == 'crash':
+                old.crash()
+            elif fault == 'expire':
+                old.client.expire()
+            else:
+                old.partition(partition_time)
+            restarts = old.restarts
+            def recovered():
+                # the old master may get the lock back, but only after losing it
+                master = self.master()
+                return master is not None and (master is not old or old.restarts > restarts)
+            return self.run_until(recovered, timeout)
+
+    def _shutdown(self):
+        self.stopped = True
+        for node in self.nodes.values():
+            if node.app is not None:
+                node.app._stopped = True
+                node.app._scheduler.stop()
+                node.app._publisher.close()
+        tasks = _pending_tasks(self.loop)
+        for task in tasks:
+            task.cancel()
+        self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        asyncio.set_event_loop(None)
+        self.loop.close()
+
+def _pending_tasks(loop):
+    if hasattr(asyncio, 'all_tasks'):
+        return asyncio.all_tasks(loop)
+    # before python 3.7
+    return set(t for t in asyncio.Task.all_tasks(loop) if not t.done())
+
+def _percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def simulate_cli(argv=sys.argv):
+    parser = argparse.ArgumentParser(description="""Measure failover times of simulated deadman nodes.
+
+Every combination of the given replica counts, tick times and ZooKeeper session
+timeouts is run --runs times with different seeds. Prints the distribution of
+the time from the fault till a new master holds the lock and is out of
+recovery.""")
+    parser.add_argument('--replicas', type=int, nargs='+', default=[2])
+    parser.add_argument('--tick-time', type=float, nargs='+', default=[1.0])
+    parser.add_argument('--zk-timeout', type=float, nargs='+', default=[10.0])
+    parser.add_argument('--latency', type=float, default=0.0,
+            help='seconds every fake postgresql operation takes')
+    parser.add_argument('--fault', choices=FAULTS, default='crash')
+    parser.add_argument('--partition-time', type=float, default=None,
+            help='seconds a partition lasts, default is twice the ZooKeeper timeout')
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args(args=argv[1:])
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.CRITICAL)
+    print('replicas tick_time zk_timeout   min median    p90    max failed')
+    for replicas in args.replicas:
+        for tick_time in args.tick_time:
+            for zk_timeout in args.zk_timeout:
+                times = []
+                failed = 0
+                for run in range(args.runs):
+                    sim = Simulation(
+                            replicas=replicas,
+                            tick_time=tick_time,
+                            zk_timeout=zk_timeout,
+                            latency=args.latency,
+                            seed=args.seed + run)
+                    took = sim.failover(args.fault, partition_time=args.partition_time)
+                    if took is None:
+                        failed += 1
+                    else:
+                        times.append(took)
+                if times:
+                    summary = '{:6.1f} {:6.1f} {:6.1f} {:6.1f}'.format(
+                            min(times), statistics.median(times), _percentile(times, 0.9), max(times))
+                else:
+                    summary = '{:>6} {:>6} {:>6} {:>6}'.format(*['-'] * 4)
+                print('{:8} {:9} {:10} {} {:6}'.format(replicas, tick_time, zk_timeout, summary, failed))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(simulate_cli())
@@ -0,0 +1,55 @@
+"""Measure how long the zgres commands take to start.
+
+Each run is a new python process which imports the command's module, parses
+a config and, for deadman, builds the App. It stops before initialize() so no
+DCS or PostgreSQL is needed. Prints the median of the runs:
+
+    python3 testscripts/startup_benchmark.py --runs 20 --config /etc/zgres/deadman.ini
+"""
+import sys
+import time
+import argparse
+import statistics
+import subprocess
+
+_SCRIPTS = {
+        'deadman': '''
+import configparser, sys
+from zgres.deadman import App
+config = configparser.ConfigParser()
+config.read(sys.argv[1:])
+if config.has_section('deadman'):
+    App(config)
+''',
+        'show': '''
+import configparser, sys
+import zgres.show
+config = configparser.ConfigParser()
+config.read(sys.argv[1:])
+''',
+        }
+
+def run(script, config_files):
+    start = time.monotonic()
+    subprocess.check_call([sys.executable, '-c', script] + config_files)
+    return time.monotonic() - start
+
+def main(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--config', action='append', default=[])
+    parser.add_argument('commands', nargs='*', default=sorted(_SCRIPTS))
+    args = parser.parse_args(argv)
+    # baseline: an empty interpreter
+    commands = [('python', 'pass')] + [(c, _SCRIPTS[c]) for c in args.commands]
+    for name, script in commands:
+        run(script, args.config) # warm the OS caches (and our entry point cache)
+        times = [run(script, args.config) for i in range(args.runs)]
+        print('{:10} median {:.1f}ms  min {:.1f}ms  max {:.1f}ms'.format(
+            name,
+            statistics.median(times) * 1000,
+            min(times) * 1000,
+            max(times) * 1000))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+from unittest import mock
+
+import pytest
+
+@pytest.fixture
+def entry_points():
+    from zgres.plugin import _EntryPoint
+    plugins = [
+            _EntryPoint('zgres', 'zookeeper', 'zgres.zookeeper:ZooKeeperDeadmanPlugin'),
+            _EntryPoint('zgres', 'fake-postgresql', 'zgres.fakepg:FakePostgresqlPlugin'),
+            _EntryPoint('zgres', 'follow-the-leader', 'zgres.replication:FollowTheLeader'),
+            _EntryPoint('zgres', 'select-furthest-ahead-replica', 'zgres.replication:SelectFurthestAheadReplica'),
+            ]
+    with mock.patch('zgres.plugin.iter_entry_points', return_value=plugins):
+        yield
+
+def test_virtual_time_loop():
+    import asyncio
+    from simulate import VirtualTimeLoop, VirtualClock
+    loop = VirtualTimeLoop()
+    clock = VirtualClock(loop)
+    ran = []
+    def blocking():
+        clock.sleep(5)
+        assert loop.time() == 7
+        loop.call_later(1, lambda: ran.append(('after blocking', loop.time())))
+    loop.call_later(2, blocking)
+    loop.call_later(3, lambda: ran.append(('other', loop.time())))
+    loop.run_until_complete(asyncio.sleep(3600))
+    # an hour passes instantly, the blocking call only delays what it scheduled
+    assert loop.time() == 3600
+    assert ran == [('other', 3), ('after blocking', 8)]
+    loop.close()
+
+@pytest.mark.parametrize('fault', ['crash', 'partition'])
+def test_failover(entry_points, fault):
+    from simulate import Simulation
+    sim = Simulation(replicas=2, tick_time=1, zk_timeout=10, latency=0.5)
+    took = sim.failover(fault)
+    # the session of the master expires, then the best replica replays and promotes
+    assert 10 <= took < 15
+    new_master = sim.master()
+    assert new_master.name != 'node0'
+    assert sim.cluster.primary is new_master.pg
+    # a partitioned master only steps down once it gives up reconnecting
+    assert sim.nodes['node0'].role == ('master' if fault == 'partition' else None)
+    # the same seed gives the same result
+    assert Simulation(replicas=2, tick_time=1, zk_timeout=10, latency=0.5).failover(fault) == took
+
+def test_expired_master_takes_the_lock_again(entry_points):
+    from simulate import Simulation
+    sim = Simulation(replicas=1, latency=0.5)
+    took = sim.failover('expire')
+    assert took < 5
+    assert sim.master().name == 'node0'
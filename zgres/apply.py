@@ -125,8 +125,17 @@ def _apply(_prefix=_DEFAULT_PREFIX):
     return failures
 
 class Plugin:
+    """Write the databases, masters and conn_info to databases.json and apply it.
+
+    After zgres-apply succeeds, what it applied is recorded in _applied_file.
+    On a warm start (see zgres.sync.SyncApp) we take the values from the
+    snapshot and only apply them again if they were not applied yet (e.g. we
+    were stopped or zgres-apply failed), so a restart does not re-run the hooks.
+    """
 
     _write_timer = None
+    _config_file = os.path.join(_DEFAULT_PREFIX, 'config', 'databases.json')
+    _applied_file = os.path.join(_DEFAULT_PREFIX, 'databases.applied.json')
 
     def __init__(self, name, app):
         self._state = {
@@ -135,6 +144,20 @@ class Plugin:
                 'conn_info': {}
                 }
 
+    @subscribe
+    def warm_start(self, snapshot):
+        for k in self._state:
+            if k in snapshot:
+                self._state[k] = snapshot[k]
+        try:
+            with open(self._applied_file, 'r') as f:
+                applied = f.read()
+        except FileNotFoundError:
+            applied = None
+        if applied != self._serialize():
+            _logger.info('The snapshot was not applied yet')
+            self._write()
+
     @subscribe
     def databases(self, databases):
         _logger.info('New database list {}'.format(databases))
@@ -159,13 +182,18 @@ class Plugin:
             # limit the writes to our list of databases to 1 per second
             self._write_timer = loop.call_later(1, self._debounced_write)
 
+    def _serialize(self):
+        return json.dumps(self._state, sort_keys=True)
+
     def _debounced_write(self):
         self._write_timer = None
-        with open('/var/lib/zgres/config/databases.json.tmp', 'w') as f:
-            f.write(json.dumps(self._state, sort_keys=True))
-        os.rename('/var/lib/zgres/config/databases.json.tmp', '/var/lib/zgres/config/databases.json')
+        data = self._serialize()
+        with open(self._config_file + '.tmp', 'w') as f:
+            f.write(data)
+        os.rename(self._config_file + '.tmp', self._config_file)
         _logger.info('Written databases.json, calling zgres-apply')
         check_call('zgres-apply') # apply the configuration to the machine
+        writeout(data, self._applied_file)
 
 #
 # Command Line Scripts
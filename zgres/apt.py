@@ -2,15 +2,12 @@ import os
 import time
 import shutil
 import asyncio
-from asyncio import sleep
 import logging
 from subprocess import check_output, call, check_call
 
-import psycopg2
-import psycopg2.errorcodes
-
 from . import systemd, utils
 from .plugin import subscribe
+from .dispatch import HookTimeout
 
 def _pg_controldata_value(pg_version, data_dir, key):
     if not os.path.exists(os.path.join(data_dir, 'global', 'pg_control')):
@@ -38,6 +35,8 @@ class AptPostgresqlPlugin:
         self.app = app
         self._systemd_check_key = '{}-systemd'.format(name)
         self._select1_check_key = '{}-select1'.format(name)
+        self._replication_role_check_key = '{}-replication-role'.format(name)
+        self._failures = {}
         self.logger = logging.getLogger(name)
         self._config_cache = {}
         self._config_mtime = None
@@ -182,6 +181,7 @@ class AptPostgresqlPlugin:
         return _pg_controldata_value(self._version, self._data_dir(), 'Database system identifier')
 
     def _conn(self):
+        import psycopg2 # deferred, it slows down startup
         info = self.pg_connect_info()
         return psycopg2.connect(**info)
 
@@ -278,6 +278,22 @@ class AptPostgresqlPlugin:
     def get_conn_info(self):
         return dict(port=self._port())
 
+    @subscribe
+    def pg_get_replay_location(self):
+        import psycopg2
+        try:
+            conn = self._conn()
+            try:
+                cur = conn.cursor()
+                cur.execute("SELECT pg_last_xlog_replay_location();")
+                return cur.fetchall()[0][0]
+            finally:
+                conn.rollback()
+                conn.close()
+        except psycopg2.OperationalError as e:
+            self.logger.warn('Could not get wal location from postgresql: {}'.format(e))
+            return None
+
     @subscribe
     def pg_replication_role(self):
         try:
@@ -287,26 +303,35 @@ class AptPostgresqlPlugin:
 
     @subscribe
     def start_monitoring(self):
-        loop = asyncio.get_event_loop()
         self.app.unhealthy(self._systemd_check_key, 'Waiting for first systemd check')
-        loop.call_soon(loop.create_task, self._monitor_systemd())
+        self.app.add_check(self._systemd_check_key, self._monitor_systemd, 5, retry_interval=1)
         self.app.unhealthy(self._select1_check_key, 'Waiting for first select 1 check')
-        loop.call_soon(loop.create_task, self._monitor_select1())
-        loop.call_soon(loop.create_task, self._monitor_replication_role())
+        self.app.add_check(self._select1_check_key, self._monitor_select1, 1, retry_interval=0.5)
+        self.app.add_check(self._replication_role_check_key, self._monitor_replication_role, 5)
 
     def _is_active(self):
         return 0 == call(['systemctl', '--quiet', 'is-active', self._service()])
 
+    async def _check(self, key, check):
+        # run a blocking check outside the event loop, a stalled check has failed
+        try:
+            return await self.app.run_blocking(key, check)
+        except HookTimeout:
+            return False
+
+    async def _monitor(self, key, check, reason):
+        # we only become unhealthy after 2 failed checks in a row
+        if await self._check(key, check):
+            self._failures[key] = 0
+            self.app.healthy(key)
+            return True
+        self._failures[key] = self._failures.get(key, 0) + 1
+        if self._failures[key] >= 2:
+            self.app.unhealthy(key, reason)
+        return False
+
     async def _monitor_systemd(self):
-        loop = asyncio.get_event_loop()
-        while True:
-            if self._is_active():
-                self.app.healthy(self._systemd_check_key)
-            else:
-                await sleep(10)
-                if not self._is_active():
-                    self.app.unhealthy(self._systemd_check_key, 'inactive according to systemd')
-            await sleep(5)
+        return await self._monitor(self._systemd_check_key, self._is_active, 'inactive according to systemd')
 
     def _can_select1(self):
         try:
@@ -322,15 +347,7 @@ class AptPostgresqlPlugin:
         return True
 
     async def _monitor_select1(self):
-        loop = asyncio.get_event_loop()
-        while True:
-            await sleep(1)
-            if self._can_select1():
-                self.app.healthy(self._select1_check_key)
-            else:
-                await sleep(2)
-                if not self._can_select1():
-                    self.app.unhealthy(self._select1_check_key, 'SELECT 1 failed')
+        return await self._monitor(self._select1_check_key, self._can_select1, 'SELECT 1 failed')
 
     def _trigger_file(self):
         return '/var/run/postgresql/{}-{}.master_trigger'.format(self._version, self._cluster_name)
@@ -344,28 +361,55 @@ class AptPostgresqlPlugin:
         finally:
             conn.close()
 
+    def _recovery_status(self, conn):
+        cur = conn.cursor()
+        cur.execute('SELECT pg_is_in_recovery(), pg_last_xlog_replay_location();')
+        return cur.fetchall()[0]
+
     @subscribe
-    def pg_stop_replication(self):
+    def pg_stop_replication(self, progress=None):
+        import psycopg2
         assert self.pg_replication_role() == 'replica'
+        poll_interval = float(self.app.config['apt'].get('promote_poll_interval', 0.1))
         trigger_file = self._trigger_file()
         with open(trigger_file, 'w') as f:
             f.write('touched')
-        time.sleep(0.2)
-        while True:
-            # it might seem like a nice idea to timeout here, but it is NOT
-            #
-            # Postgres might be in recovery mode replaying WAL which can take
-            # an ARBITRARY time. but it is on it's way to becoming a master.
-            #
-            # This can happen if we kill the whole cluster and just start
-            # again from the archive
-            try:
-                if not self._pg_is_in_recovery():
+        conn = None
+        last_location = None
+        last_log = None
+        try:
+            while True:
+                # it might seem like a nice idea to timeout here, but it is NOT
+                #
+                # Postgres might be in recovery mode replaying WAL which can take
+                # an ARBITRARY time. but it is on it's way to becoming a master.
+                #
+                # This can happen if we kill the whole cluster and just start
+                # again from the archive
+                try:
+                    if conn is None:
+                        conn = self._conn()
+                        conn.autocommit = True
+                    in_recovery, location = self._recovery_status(conn)
+                except psycopg2.Error:
+                    # postgres may restart processes while promoting, connect again
+                    if conn is not None:
+                        conn.close()
+                        conn = None
+                    in_recovery, location = True, None
+                if not in_recovery:
                     break
-            except psycopg2.OperationalError as e:
-                pass
-            logging.info('waiting for postgresql to come out of recovery')
-            time.sleep(1)
+                if location is not None and location != last_location:
+                    last_location = location
+                    if progress is not None:
+                        progress(pg_last_xlog_replay_location=location)
+                if last_log is None or time.monotonic() - last_log >= 10:
+                    last_log = time.monotonic()
+                    self.logger.info('waiting for postgresql to come out of recovery, replayed up to {}'.format(last_location))
+                time.sleep(poll_interval)
+        finally:
+            if conn is not None:
+                conn.close()
         if self._set_config_values('master.'):
             self.pg_reload()
 
@@ -396,13 +440,14 @@ recovery_target_timeline = 'latest'
         self._set_config_values('replica.')
 
     async def _monitor_replication_role(self):
-        while True:
-            await sleep(5)
-            real_role = self.pg_replication_role()
-            state_role = self.app.replication_role
-            if real_role == 'master' and state_role == 'replica':
-                self.logger.error('Did you promote postgres manually? zgres thinks its a replica but postgres is actually a master. Restarting to try get the master lock')
-                self.app.restart(0)
-            if real_role == 'master' and not self.app.have_master_lock:
-                self.logger.error('Postgresql is a master, but we DONT have the lock. This should never happen. oh well, restarting to try make the best of it')
-                self.app.restart(0)
+        real_role = self.pg_replication_role()
+        state_role = self.app.replication_role
+        if real_role == 'master' and state_role == 'replica':
+            self.logger.error('Did you promote postgres manually? zgres thinks its a replica but postgres is actually a master. Restarting to try get the master lock')
+            self.app.restart(0)
+            return False
+        if real_role == 'master' and not self.app.have_master_lock:
+            self.logger.error('Postgresql is a master, but we DONT have the lock. This should never happen. oh well, restarting to try make the best of it')
+            self.app.restart(0)
+            return False
+        return True
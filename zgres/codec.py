@@ -0,0 +1,102 @@
+"""Encoding of the values we store in ZooKeeper (state, conn and stats).
+
+Historically every value is plain JSON. That is still the default, so a
+cluster can be upgraded one node at a time: only switch the encoding once
+every deadman and zgres-sync can decode it. Other encodings start with a
+header which JSON never does (a NUL byte), so old and new znodes can be told
+apart:
+
+    b'\\x00zg' + version (1 byte) + encoding + compression
+
+The encoding is b'j' (JSON) or b'm' (msgpack, which must be installed), the
+compression b'-' (none) or b'z' (zlib). Configured in the [zookeeper]
+section:
+
+    encoding = msgpack
+    compress_above = 512
+
+compress_above is a size in bytes, larger encoded values are compressed.
+"""
+import json
+import zlib
+import logging
+
+_logger = logging.getLogger('zgres')
+
+MAGIC = b'\x00zg'
+VERSION = 1
+_HEADER_SIZE = len(MAGIC) + 3
+
+def _msgpack():
+    # msgpack is optional, only needed if it is used
+    import msgpack
+    return msgpack
+
+def _json_dumps(value):
+    return json.dumps(value).encode('ascii')
+
+def _json_loads(data):
+    return json.loads(data.decode('ascii'))
+
+def _msgpack_dumps(value):
+    return _msgpack().packb(value, use_bin_type=True)
+
+def _msgpack_loads(data):
+    return _msgpack().unpackb(data, raw=False)
+
+_ENCODINGS = {
+        'json': (b'j', _json_dumps),
+        'msgpack': (b'm', _msgpack_dumps),
+        }
+
+_DECODERS = {
+        b'j': _json_loads,
+        b'm': _msgpack_loads,
+        }
+
+class Codec:
+    """Encode values for storage in ZooKeeper, decode() reads every encoding"""
+
+    def __init__(self, encoding='json', compress_above=None):
+        if encoding not in _ENCODINGS:
+            raise ValueError('Unknown encoding {}, use one of: {}'.format(encoding, ', '.join(sorted(_ENCODINGS))))
+        if encoding == 'msgpack':
+            try:
+                _msgpack()
+            except ImportError:
+                _logger.warn('msgpack is not installed, writing JSON instead')
+                encoding = 'json'
+        self.encoding = encoding
+        self.compress_above = compress_above
+        self._tag, self._dumps = _ENCODINGS[encoding]
+
+    def encode(self, value):
+        data = self._dumps(value)
+        compression = b'-'
+        if self.compress_above is not None and len(data) > self.compress_above:
+            data = zlib.compress(data)
+            compression = b'z'
+        elif self.encoding == 'json':
+            # readable by every version of zgres
+            return data
+        return MAGIC + bytes([VERSION]) + self._tag + compression + data
+
+def decode(data):
+    """Decode a value written by any Codec, or plain JSON"""
+    if not data.startswith(MAGIC):
+        return _json_loads(data)
+    header = data[:_HEADER_SIZE]
+    if len(header) != _HEADER_SIZE or header[len(MAGIC)] != VERSION:
+        raise ValueError('Unsupported encoding header: {!r}'.format(header))
+    encoding = header[-2:-1]
+    compression = header[-1:]
+    data = data[_HEADER_SIZE:]
+    if compression == b'z':
+        data = zlib.decompress(data)
+    elif compression != b'-':
+        raise ValueError('Unsupported compression: {!r}'.format(compression))
+    try:
+        loads = _DECODERS[encoding]
+    except KeyError:
+        raise ValueError('Unsupported encoding: {!r}'.format(encoding))
+    return loads(data)
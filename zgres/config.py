@@ -59,6 +59,30 @@ def read_config_file(args):
                 config.read_file(open(os.path.join(file_or_dir, cfg), 'r'))
     return config
 
+def cluster_configs(config):
+    """Split the config of a deadman supervising several clusters.
+
+    [deadman] clusters lists the cluster names. Returns a config for each
+    cluster in which the options of a section "{section}@{cluster}" override
+    those of "{section}". Sections of the other clusters are left out.
+    """
+    names = config['deadman'].get('clusters', '').split()
+    configs = {}
+    for name in names:
+        sections = {}
+        for section in config.sections():
+            if '@' not in section:
+                sections.setdefault(section, {}).update(config.items(section, raw=True))
+        suffix = '@' + name
+        for section in config.sections():
+            if section.endswith(suffix):
+                sections.setdefault(section[:-len(suffix)], {}).update(config.items(section, raw=True))
+        # interpolate again, so ${zookeeper:group} is the group of this cluster
+        cluster_config = configparser.ConfigParser(interpolation=configparser.ExtendedInterpolation())
+        cluster_config.read_dict(sections)
+        configs[name] = cluster_config
+    return configs
+
 def parse_args(parser, argv, config_file=None):
     if config_file is not None:
         add_config_file(parser, config_file)
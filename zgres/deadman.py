@@ -1,16 +1,24 @@
 import sys
+import signal
 import itertools
 import time
 import uuid
-from copy import deepcopy
 import asyncio
 import logging
 import argparse
+from functools import partial
 
 import zgres.plugin
 from zgres.plugin import hookspec
 import zgres.config
 from zgres import utils
+from zgres.utils import FrozenDict, freeze
+from zgres.dispatch import BlockingHookDispatcher, HookTimeout
+from zgres.publish import StatePublisher
+from zgres.scheduler import HealthCheckScheduler
+from zgres.trace import FailoverTracer
+from zgres.initgraph import InitGraph
+from zgres import metrics
 
 _missing = object()
 
@@ -31,6 +39,11 @@ def notify_state(state):
     """subscribe to changes in cluster state"""
     pass
 
+@hookspec
+def notify_stats(stats):
+    """subscribe to changes in cluster stats (frequently changing metrics)"""
+    pass
+
 @hookspec
 def notify_conn_info(conn_info):
     # subscribe to changes in cluster connection info
@@ -70,6 +83,16 @@ def dcs_set_timeline(timeline):
 def dcs_get_timeline():
     pass
 
+@hookspec(firstresult=True)
+def dcs_publish_promotion(timeline, state):
+    """Set our timeline and state after becoming master, in one atomic step.
+
+    Nothing is written unless we still hold the master lock. Return True if
+    they were written, False if we do not hold the lock. If no plugin
+    implements this, dcs_set_timeline and dcs_set_state are called.
+    """
+    pass
+
 @hookspec(firstresult=True)
 def dcs_lock(name):
     """Get a named lock in the DCS"""
@@ -100,6 +123,20 @@ def dcs_set_conn_info(conn_info):
 def dcs_list_conn_info():
     pass
 @hookspec
+def dcs_set_stats(stats):
+    """Set our frequently changing metrics (e.g. WAL replay location)
+
+    These are stored apart from the state so that watchers of the state
+    are not woken up every time they change.
+    """
+    pass
+@hookspec(firstresult=True)
+def dcs_list_stats():
+    pass
+@hookspec
+def dcs_watch_stats(stats):
+    pass
+@hookspec
 def dcs_disconnect():
     pass
 
@@ -138,7 +175,13 @@ def pg_reset():
 def pg_initdb():
     pass
 @hookspec
-def pg_stop_replication():
+def pg_stop_replication(progress):
+    """Promote the replica, returning once it is out of recovery.
+
+    This is called in a thread and can take as long as replaying the WAL
+    takes. It can report progress by calling progress(**state) from any
+    thread, e.g. progress(pg_last_xlog_replay_location='0/3000060').
+    """
     pass
 @hookspec
 def pg_setup_replication(primary_conninfo):
@@ -154,6 +197,10 @@ def pg_restore():
  # returns one of: None, 'master', 'replica'
 @hookspec(firstresult=True)
 def pg_replication_role():
+    pass
+ # returns the WAL replay location of a replica (e.g. '68A/16E1DA8') or None if it is unknown
+@hookspec(firstresult=True)
+def pg_get_replay_location():
     pass
 
         # monitoring
@@ -169,6 +216,16 @@ def get_conn_info():
     """
     pass
 
+def merge_stats(states, stats):
+    """Add the stats of every node to it's state"""
+    stats = dict(stats or ())
+    for id, state in states:
+        node_stats = stats.get(id)
+        if node_stats:
+            state = dict(state)
+            state.update(node_stats)
+        yield id, state
+
 def willing_replicas(states):
     for id, state in states:
         if state.get('willing', None) is None:
@@ -187,22 +244,41 @@ def _is_all_true(item):
         return False
     return True
 
+class LostMasterLock(Exception):
+    """We no longer hold the master lock"""
+
 class App:
 
-    _giveup_lock = asyncio.Lock()
     my_id = None
     config = None
     database_identifier = None
     tick_time = None
     _exit_code = 0
     _master_lock_owner = None
-
-    def __init__(self, config):
+    _election = None
+    _election_task = None
+    _taking_over = False
+    _promotion = None
+    state_version = 0
+    hook_profile = None
+    _stopped = False
+
+    def __init__(self, config, supervisor=None, cluster=None):
+        # supervisor is set if we are one of several clusters in this process
+        self.supervisor = supervisor
+        self.cluster = cluster
+        self._giveup_lock = asyncio.Lock()
         self.health_problems = {}
-        self._state = {}
+        # our state is immutable, so it can be shared with plugins, the DCS and
+        # threads by reference. Every change replaces it and increments
+        # state_version.
+        self._state = FrozenDict()
+        self._group_state = {}
+        self._group_stats = {}
         self.config = config
-        self.tick_time = config['deadman'].get('tick_time', 2) # float seconds to scale all timeouts
-        self._conn_info = {} # TODO: populate from config file
+        self.tick_time = float(config['deadman'].get('tick_time', 2)) # float seconds to scale all timeouts
+        self._role_timer = metrics.RoleTimer(cluster=cluster or '')
+        self._conn_info = FrozenDict() # TODO: populate from config file
         self._setup_plugins()
         self.logger = logging.getLogger('zgres')
 
@@ -221,6 +297,61 @@ class App:
                 sys.modules[__name__],
                 self)
         self._plugins = self._pm.hook
+        self._dispatch = BlockingHookDispatcher(
+                self,
+                self._plugins,
+                self.config['deadman'],
+                self.tick_time,
+                executor=getattr(self.supervisor, 'executor', None))
+        if self.supervisor is None:
+            self._scheduler = HealthCheckScheduler(self.config['deadman'])
+        else:
+            self._scheduler = self.supervisor.scheduler.namespace(self.cluster, self.config['deadman'])
+        self._trace = FailoverTracer(self.config['deadman'])
+        publish_stats = None
+        if zgres.plugin.has_implementations(self._plugins.dcs_set_stats):
+            publish_stats = self._publish_stats
+        self._publisher = StatePublisher(
+                self._publish_state,
+                self.config['deadman'],
+                self.tick_time,
+                publish_stats=publish_stats)
+
+    async def run_blocking(self, name, func, *args):
+        """Run a blocking function outside the event loop.
+
+        Plugins use this for calls which can block for an unknown time (e.g.
+        forking systemctl or connecting to postgresql). Raises HookTimeout if
+        the call does not return within the timeout configured for name.
+        """
+        return await self._dispatch.run(name, func, *args)
+
+    def acquire_shared(self, key, factory):
+        """Get an object (e.g. a DCS connection) which can be shared by clusters.
+
+        If we supervise several clusters, all acquiring the same key get the
+        same object. Otherwise factory() is called every time.
+        """
+        if self.supervisor is None:
+            return factory()
+        return self.supervisor.acquire_shared(key, factory)
+
+    def release_shared(self, key):
+        """Stop using a shared object, returns True if the caller should close it"""
+        if self.supervisor is None:
+            return True
+        return self.supervisor.release_shared(key)
+
+    def add_check(self, name, check, interval, retry_interval=None, max_interval=None):
+        """Periodically run a health check.
+
+        check is a coroutine function returning True if all is well. It is
+        run about every interval seconds while it succeeds (slowly backing off
+        up to max_interval) and every retry_interval seconds while it fails.
+        """
+        self._scheduler.register(name, check, interval,
+                retry_interval=retry_interval,
+                max_interval=max_interval)
 
     def follow(self, primary_conninfo): 
         # Change who we are replicating from
@@ -279,19 +410,27 @@ class App:
         """
         self.unhealthy('zgres.initialize', 'Initializing')
         self.logger.info('Initializing plugins')
-        self._plugins.initialize()
-        self.my_id = self._plugins.get_my_id()
-        self.logger.info('My ID is: {}'.format(self.my_id))
-        self.database_identifier = self._plugins.dcs_get_database_identifier()
+        graph = self._initialize_graph()
+        try:
+            self.my_id = graph.result('get_my_id')
+            self._trace.node = self.my_id
+            self.logger.info('My ID is: {}'.format(self.my_id))
+            self.database_identifier = graph.result('dcs_get_database_identifier')
+            if self.database_identifier is not None:
+                self.logger.info('Found database identifier in DCS: {}'.format(self.database_identifier))
+                my_database_id = graph.result('pg_get_database_identifier')
+                if my_database_id == self.database_identifier:
+                    replication_role = graph.result('pg_replication_role')
+        finally:
+            # don't let probes still running race with bootstrapping
+            graph.shutdown()
+            graph.log_timings()
         if self.database_identifier is None:
             self.logger.info('Could not find database identifier in DCS, bootstrapping master')
             return self.master_bootstrap()
-        self.logger.info('Found database identifier in DCS: {}'.format(self.database_identifier))
-        my_database_id = self._plugins.pg_get_database_identifier()
         if my_database_id != self.database_identifier:
             self.logger.info('My database identifer is different ({}), bootstrapping as replica'.format(my_database_id))
             return self.replica_bootstrap()
-        replication_role = self._plugins.pg_replication_role()
         self.update_state(replication_role=replication_role)
         if replication_role is None:
             raise AssertionError('I should have a replication role already')
@@ -326,6 +465,7 @@ class App:
                 master_lock=self.master_lock_changed,
                 state=self._notify_state,
                 conn_info=self._notify_conn_info)
+        self._plugins.dcs_watch_stats(stats=self._notify_stats)
         self._get_conn_info_from_plugins()
         self.healthy('zgres.initialize')
         if self.health_problems:
@@ -338,8 +478,23 @@ class App:
                 loop.call_later(300 * self.tick_time, loop.create_task, self._handle_unhealthy_master())
         return None
 
+    def _initialize_graph(self):
+        """The probes initialize needs, independent ones run concurrently"""
+        graph = InitGraph(int(self.config['deadman'].get('initialize_workers', 4)))
+        # the initialize hook must run first and on the event loop thread
+        graph.add('initialize', self._plugins.initialize, main_thread=True)
+        for name in [
+                'get_my_id',
+                'dcs_get_database_identifier',
+                'pg_get_database_identifier',
+                'pg_replication_role']:
+            graph.add(name, getattr(self._plugins, name), requires=['initialize'])
+        graph.start()
+        return graph
+
     def _get_conn_info_from_plugins(self):
         sources = dict((k, None) for k in self._conn_info)
+        conn_info = dict(self._conn_info)
         for info in self._plugins.get_conn_info():
             for k, v in info.items():
                 source = sources.get(k, _missing)
@@ -348,11 +503,26 @@ class App:
                 elif source is not _missing:
                     self.logger.info('plugin overriding connection info for {} set by another plugin ({}), set to: {}'.format(k, source, v))
                 sources[k] = 'plugin_name'
-                self._conn_info[k] = v
-        self._state.update(deepcopy(self._conn_info))
+                conn_info[k] = v
+        self._conn_info = freeze(conn_info)
+        self._set_state(self._state.replace(**self._conn_info))
+
+    def _set_state(self, state):
+        role = state.get('replication_role', None)
+        if role != self._state.get('replication_role', None):
+            self._role_timer.set_role(role)
+        self._state = state
+        self.state_version += 1
 
     def update_state(self, **kw):
-        changed = False
+        changed = self._change_state(**kw)
+        if changed and 'zgres.initialize' not in self.health_problems:
+            # don't update state in the DCS till we are finished updating
+            self._publisher.update(self._state)
+
+    def _change_state(self, **kw):
+        """Change our state without publishing it, returns True if it changed"""
+        changes = {}
         for k, v in kw.items():
             if k in ['willing']:
                 self.logger.warn('Cannot set state for {}={}, key {} is automatically set'.format(k, v, k))
@@ -360,16 +530,37 @@ class App:
             if k in self._conn_info:
                 self.logger.warn('Cannot set state for {}={}, key {} has already been set in the connection info'.format(k, v, k))
                 continue
-            v = deepcopy(v) # for reliable change detection on mutable args
+            v = freeze(v) # for reliable change detection on mutable args
             existing = self._state.get(k, _missing)
-            if v != existing:
-                changed = True
-                self._state[k] = v
+            if v is not existing and v != existing:
+                changes[k] = v
+        changed = bool(changes)
         if changed:
-            changed = self._update_auto_state() or changed
-        if changed and 'zgres.initialize' not in self.health_problems:
-            # don't update state in the DCS till we are finished updating
-            self._plugins.dcs_set_state(state=self._state.copy())
+            self._set_state(self._state.replace(**changes))
+            self._update_auto_state()
+        return changed
+
+    def _publish_state(self, state):
+        metrics.state_published('state')
+        self._plugins.dcs_set_state(state=state)
+
+    def _publish_promotion(self, timeline, replication_role):
+        """Publish our new role together with the timeline we promoted to"""
+        self._change_state(replication_role=replication_role)
+        def publish(state):
+            metrics.state_published('state')
+            published = self._plugins.dcs_publish_promotion(timeline=timeline, state=state)
+            if published is False:
+                raise LostMasterLock('Lost the master lock before publishing our new timeline')
+            if published is None:
+                # no plugin can publish them atomically
+                self._plugins.dcs_set_timeline(timeline=timeline)
+                self._plugins.dcs_set_state(state=state)
+        self._publisher.flush(self._state, publish=publish)
+
+    def _publish_stats(self, stats):
+        metrics.state_published('stats')
+        self._plugins.dcs_set_stats(stats=stats)
 
     def _update_auto_state(self):
         """Update any keys in state which the deadman App itself calculates"""
@@ -381,21 +572,17 @@ class App:
         if state.get('replication_role', None) != 'replica':
             willing = False
         if willing:
-            for vetoed in self._plugins.veto_takeover(state=deepcopy(self._state)):
+            for vetoed in self._plugins.veto_takeover(state=state):
                 if vetoed:
                     willing = False
         if willing and state.get('willing', None) is None:
-            state['willing'] = time.time()
+            self._set_state(state.replace(willing=time.time()))
             changed = True
         elif not willing and state.get('willing', None) is not None:
-            state['willing'] = None
+            self._set_state(state.replace(willing=None))
             changed = True
         return changed
 
-    def _update_timeline(self):
-        my_timeline = self._plugins.pg_get_timeline()
-        self._plugins.dcs_set_timeline(timeline=my_timeline)
-
     def master_lock_changed(self, owner):
         """Respond to a change in the master lock.
         
@@ -404,45 +591,82 @@ class App:
         with the current master.
         """
         self._master_lock_owner = owner
+        if owner is not None:
+            self._end_election()
         if owner == self.my_id:
             # I have the master lock, if I am replicating, stop.
-            if self._plugins.pg_replication_role() == 'replica':
+            if self._promotion is None and self._plugins.pg_replication_role() == 'replica':
+                self._trace.start('lock_acquired')
                 self.update_state(replication_role='taking-over')
-                self._plugins.pg_stop_replication()
-                new_role = self._plugins.pg_replication_role()
-                if new_role != 'master':
-                    raise Exception('I should have become a master already!')
-                self._update_timeline()
-                self.update_state(replication_role=new_role)
+                loop = asyncio.get_event_loop()
+                self._promotion = loop.create_task(self._promote())
+        elif self._promotion is not None:
+            # we are already on our way to becoming a master, there is no way
+            # back to being a replica of someone else.
+            self.logger.error('Lost the master lock while promoting, restarting')
+            self.restart(10)
+            return
         else:
+            if owner is not None:
+                self._trace.finish('new_master', owner=owner)
             if self._plugins.pg_replication_role() == 'master':
                 # if I am master, but I am not replicating, shut down
                 self.restart(10)
+                return
             if owner is None:
                 # No-one has the master lock, try take over
+                self._trace.start('lock_lost')
                 loop = asyncio.get_event_loop()
-                loop.call_soon(loop.create_task, self._try_takeover())
+                self._election_task = loop.create_task(self._start_election())
         self._plugins.master_lock_changed(owner=owner)
 
+    async def _promote(self):
+        """Bring postgresql out of recovery without blocking the event loop.
+
+        While the WAL is replayed, the DCS session, health checks and state
+        publishing carry on and plugins can publish the replay progress.
+        """
+        loop = asyncio.get_event_loop()
+        def progress(**kw):
+            # called from the promoting thread
+            loop.call_soon_threadsafe(partial(self.update_state, **kw))
+        try:
+            with self._trace.span('recovery_exit'):
+                await self._dispatch.run(
+                        'pg_stop_replication',
+                        partial(self._plugins.pg_stop_replication, progress=progress),
+                        deadline=False)
+            new_role = self._plugins.pg_replication_role()
+            if new_role != 'master':
+                raise Exception('I should have become a master already!')
+            with self._trace.span('timeline_published'):
+                self._publish_promotion(self._plugins.pg_get_timeline(), new_role)
+            self._trace.finish('promoted')
+        except asyncio.CancelledError:
+            raise # we are restarting
+        except Exception:
+            self.logger.exception('Failed to promote postgresql, restarting')
+            self.restart(10)
+        finally:
+            self._promotion = None
+
     def _notify_state(self, state):
+        self._group_state = state
         self._plugins.notify_state(state=state)
+        self._check_election()
+
+    def _notify_stats(self, stats):
+        self._group_stats = stats
+        self._plugins.notify_stats(stats=stats)
+        self._check_election()
 
     def _notify_conn_info(self, conn_info):
         self._plugins.notify_conn_info(conn_info=conn_info)
 
-    def _willing_replicas(self):
-        return willing_replicas(self._plugins.dcs_list_state())
-
-    def _am_i_best_replica(self):
-        # Check how I am doing compared to my brethern
-        better = []
-        willing_replicas = list(self._willing_replicas()) # list() for easer testing
-        for id, state in self._plugins.best_replicas(states=willing_replicas):
-            if id == self.my_id:
-                return True
-            better.append((id, state))
-        self.logger.info('Abstaining from leader election as I am not among the best replicas: {}'.format(better))
-        return False
+    async def _willing_replicas(self):
+        states = await self._dispatch.call('dcs_list_state')
+        stats = await self._dispatch.call('dcs_list_stats')
+        return willing_replicas(merge_stats(states, stats))
 
     async def _async_sleep(self, delay):
         await asyncio.sleep(delay * self.tick_time)
@@ -451,22 +675,102 @@ class App:
         # blocking sleep
         time.sleep(delay * self.tick_time)
 
-    async def _try_takeover(self):
-        while True:
-            self.logger.info('Sleeping a little to allow state to be updated in the DCS before trying to take over')
-            await self._async_sleep(3) # let replicas update their state
-            # The master is still missing and we should decide if we must take over
-            if self._master_lock_owner is not None:
-                self.logger.info('There is a new master: {}, stop trying to take over'.format(self._master_lock_owner))
+    async def _start_election(self):
+        """Elect a new master after the master lock was lost.
+
+        We first publish our current WAL position together with the
+        "lost_master" flag. Every replica does the same, so once all willing
+        replicas have set the flag, they all have reported a position from
+        after the master was lost and the best of them can take over. This
+        is driven by the state notifications from the DCS (see
+        _check_election). If a replica stays silent, we decide without it
+        after takeover_timeout ticks.
+        """
+        if self._stopped or self._election is not None or self._master_lock_owner is not None:
+            return
+        loop = asyncio.get_event_loop()
+        self._election = loop.call_later(self._takeover_timeout(), self._election_timed_out)
+        self.logger.info('The master lock was lost, reporting my position to elect a new master')
+        with self._trace.span('position_published') as trace:
+            try:
+                location = await self._dispatch.call('pg_get_replay_location')
+            except HookTimeout as e:
+                self.logger.warn('Could not get my replay location: {}'.format(e))
+                location = None
+            trace['location'] = location
+            if self._election is None:
+                return # a new master appeared while we were waiting
+            state = dict(lost_master=True)
+            if location is not None:
+                state['pg_last_xlog_replay_location'] = location
+            self.update_state(**state)
+        self._check_election()
+
+    def _takeover_timeout(self):
+        return float(self.config['deadman'].get('takeover_timeout', 3)) * self.tick_time
+
+    def _election_timed_out(self):
+        # some willing replicas did not report their position in time (or the best
+        # replica could not take the lock). Decide with what we have and try again later
+        if self._stopped:
+            self._election = None
+            return
+        loop = asyncio.get_event_loop()
+        self._election = loop.call_later(self._takeover_timeout(), self._election_timed_out)
+        self._check_election(timed_out=True)
+
+    def _end_election(self):
+        if self._election is None:
+            return
+        self._election.cancel()
+        self._election = None
+        if self._state.get('lost_master'):
+            self.update_state(lost_master=None)
+
+    def _check_election(self, timed_out=False):
+        if self._election is None or not self._state.get('lost_master'):
+            return
+        states = dict(merge_stats(self._group_state.items(), self._group_stats))
+        states[self.my_id] = self._state
+        willing = list(willing_replicas(states.items()))
+        silent = sorted(id for id, state in willing if not state.get('lost_master'))
+        self._trace.phase('willing_computed',
+                willing=sorted(id for id, state in willing),
+                silent=silent,
+                timed_out=timed_out)
+        if silent:
+            if not timed_out:
+                self.logger.info('Waiting for these replicas to report their position: {}'.format(silent))
+                return
+            self.logger.info('These replicas did not report their position in time: {}'.format(silent))
+        better = []
+        for id, state in self._plugins.best_replicas(states=willing):
+            if id == self.my_id:
                 break
-            if self._am_i_best_replica():
-                # try get the master lock, if this suceeds, master_lock_change will be called again
-                # and will bring us out of replication
-                self.logger.info('I am one of the best, trying to get the master lock')
-                if not self._plugins.dcs_lock(name='master'):
-                    continue
-            else:
-                self.logger.info('I am not yet the best replica, giving the others a chance')
+            better.append((id, state))
+        else:
+            self._trace.phase('best_replica_decision', best=False)
+            self.logger.info('Abstaining from leader election as I am not among the best replicas: {}'.format(better))
+            return
+        self._trace.phase('best_replica_decision', best=True)
+        if not self._taking_over:
+            loop = asyncio.get_event_loop()
+            loop.create_task(self._take_over())
+
+    async def _take_over(self):
+        # try get the master lock, if this suceeds, master_lock_change will be called again
+        # and will bring us out of replication
+        self.logger.info('I am one of the best, trying to get the master lock')
+        self._taking_over = True
+        try:
+            with self._trace.span('lock_requested') as trace:
+                trace['locked'] = locked = await self._dispatch.call('dcs_lock', name='master')
+            if not locked:
+                self.logger.info('Failed to get the master lock, waiting for the next election round')
+        except HookTimeout as e:
+            self.logger.warn('Could not get the master lock in time: {}'.format(e))
+        finally:
+            self._taking_over = False
 
     def unhealthy(self, key, reason, can_be_replica=False):
         """Plugins call this if they want to declare the instance unhealthy.
@@ -490,8 +794,13 @@ class App:
         if self._giveup_lock.locked():
             return # already trying
         async with self._giveup_lock:
-            while self.health_problems:
-                for i in self._willing_replicas():
+            while self.health_problems and not self._stopped:
+                try:
+                    willing = list(await self._willing_replicas())
+                except HookTimeout as e:
+                    self.logger.warn('Could not list willing replicas: {}'.format(e))
+                    willing = []
+                for i in willing:
                     # there is at least one willing replica
                     # give it a chance to take over by giving up
                     # the lock
@@ -519,9 +828,30 @@ class App:
     def _set_conn_info(self):
         self._plugins.dcs_set_conn_info(conn_info=self._conn_info)
 
+    def _start_metrics(self):
+        observers = []
+        port = self.config['deadman'].get('metrics_port', None)
+        if port is not None:
+            observers.append(metrics.observe_hook)
+            self._lag_monitor = metrics.LoopLagMonitor(1, role_timer=self._role_timer)
+            self._lag_monitor.start()
+            metrics.serve(int(port), addr=self.config['deadman'].get('metrics_addr', ''))
+        if self.config['deadman'].get('profile_hooks', 'false').lower().strip() in ('t', 'true'):
+            # log the profile with: kill -USR1 <pid>
+            self.hook_profile = zgres.plugin.HookProfile()
+            observers.append(self.hook_profile.observe)
+            loop = asyncio.get_event_loop()
+            loop.add_signal_handler(signal.SIGUSR1, self.hook_profile.dump, self.logger)
+        if observers:
+            def observe(*args):
+                for observer in observers:
+                    observer(*args)
+            zgres.plugin.time_hooks(self._pm, observe)
+
     def run(self):
         loop = asyncio.get_event_loop()
         self.logger.info('Starting')
+        self._start_metrics()
         timeout = self.initialize()
         if timeout is not None:
             self.restart(timeout)
@@ -538,10 +868,26 @@ class App:
 
     def _stop(self):
         # for testing
+        if self.supervisor is not None:
+            return # the other clusters carry on
         loop = asyncio.get_event_loop()
         loop.stop()
 
+    def _cancel_tasks(self):
+        # nothing we started may call plugins once they are shut down, with a
+        # supervisor the loop keeps running
+        if self._election is not None:
+            self._election.cancel()
+            self._election = None
+        for task in (self._election_task, self._promotion):
+            if task is not None:
+                task.cancel()
+        self._election_task = self._promotion = None
+
     def restart(self, timeout):
+        if self._stopped and self.supervisor is not None:
+            return # already restarting
+        self._stopped = True
         self.logger.warn('Shutting Down')
         # If we are master, our priority is to stop
         # postgresql to avoid a split brain
@@ -553,11 +899,20 @@ class App:
         # that postgres is stopped on master before we do that
         self.logger.warn('Telling asyncio to stop')
         self._stop()
+        self._cancel_tasks()
+        self._scheduler.stop()
+        self._publisher.close()
+        self._dispatch.shutdown()
         # TODO: deal with very long timeouts/hangs in the following code here
         #       perhaps spawn a thread to kill -9 ourselves?
         # now we try clean up gracefully
         self.logger.warn('disconnecting DCS')
         self._plugins.dcs_disconnect()
+        if self.supervisor is not None:
+            # only this cluster restarts
+            self.logger.warn('Finished Shut Down, restarting in {} ticks'.format(timeout))
+            self.supervisor.restart(self, timeout)
+            return
         if timeout:
             self.logger.warn('sleeping for {} ticks, then restarting'.format(timeout))
             self._sleep(timeout) # yes, this blocks everything. that's the point of it!
@@ -567,6 +922,10 @@ class App:
         # expose pg_connect for other plugins to use
         return self._plugins.pg_connect_info()
 
+    def pg_get_replay_location(self):
+        # expose pg_get_replay_location for other plugins to use
+        return self._plugins.pg_get_replay_location()
+
 #
 # Command Line Scripts
 #
@@ -592,5 +951,10 @@ It does not:
     - do remastering (assumed to have happened before we start)
 """)
     config = zgres.config.parse_args(parser, argv, config_file='deadman.ini')
-    app = App(config)
+    if config['deadman'].get('clusters', '').strip():
+        # supervise several local clusters
+        from zgres.supervisor import Supervisor
+        app = Supervisor(config)
+    else:
+        app = App(config)
     sys.exit(app.run())
@@ -0,0 +1,96 @@
+"""Run blocking plugin hooks off the asyncio event loop.
+
+Many hooks (and some plugin internals) block: they fork systemctl, connect to
+postgresql or retry ZooKeeper operations for up to a minute. If these are
+called directly from a coroutine, the whole deadman stops reacting to events
+till they return.
+
+The dispatcher runs these calls in a bounded thread pool and waits for them
+with a deadline. If the deadline passes, the call is reported to the App as a
+health problem which is cleared again once the call finally returns.
+
+Timeouts are configured in the [deadman] section in ticks:
+
+    blocking_hook_workers = 4
+    blocking_hook_timeout = 5
+    blocking_hook_timeout.dcs_list_state = 10
+    blocking_hook_timeout.zgres#apt-systemd = 2
+"""
+import asyncio
+import logging
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+
+_logger = logging.getLogger('zgres')
+
+class HookTimeout(Exception):
+    """A blocking call did not return before its deadline"""
+
+class BlockingHookDispatcher:
+
+    def __init__(self, app, hooks, config, tick_time, executor=None):
+        self._app = app
+        self._hooks = hooks
+        self._config = config
+        self._tick_time = tick_time
+        self._own_executor = executor is None
+        if executor is None:
+            workers = int(config.get('blocking_hook_workers', 4))
+            executor = ThreadPoolExecutor(max_workers=workers)
+        self._executor = executor
+        self._stalled = {}
+
+    def timeout(self, name):
+        """Seconds to wait for a call to `name` before declaring a stall"""
+        ticks = self._config.get('blocking_hook_timeout.' + name, None)
+        if ticks is None:
+            ticks = self._config.get('blocking_hook_timeout', 5)
+        return float(ticks) * self._tick_time
+
+    def _health_key(self, name):
+        return 'zgres.stalled.{}'.format(name)
+
+    async def call(self, hook_name, **kw):
+        """Call a hook in the thread pool"""
+        hook = getattr(self._hooks, hook_name)
+        return await self.run(hook_name, partial(hook, **kw))
+
+    async def run(self, name, func, *args, deadline=True):
+        """Call func(*args) in the thread pool.
+
+        Raises HookTimeout if it does not return within the timeout configured
+        for `name`. The call itself carries on in the background.
+
+        With deadline=False we wait for as long as the call takes, this is for
+        calls like promotion which can legitimately take minutes.
+        """
+        loop = asyncio.get_event_loop()
+        future = loop.run_in_executor(self._executor, func, *args)
+        if not deadline:
+            return await future
+        timeout = self.timeout(name)
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError:
+            self._stall(name, timeout, future)
+            raise HookTimeout('{} did not return within {} seconds'.format(name, timeout))
+
+    def _stall(self, name, timeout, future):
+        key = self._health_key(name)
+        self._stalled[key] = self._stalled.get(key, 0) + 1
+        _logger.warn('blocking call {} stalled for more than {} seconds'.format(name, timeout))
+        self._app.unhealthy(key, 'blocking call {} stalled for more than {} seconds'.format(name, timeout), can_be_replica=True)
+        future.add_done_callback(partial(self._unstall, name))
+
+    def _unstall(self, name, future):
+        key = self._health_key(name)
+        self._stalled[key] -= 1
+        if not future.cancelled() and future.exception() is not None:
+            _logger.warn('stalled blocking call {} failed: {}'.format(name, future.exception()))
+        if not self._stalled[key]:
+            del self._stalled[key]
+            self._app.healthy(key)
+
+    def shutdown(self):
+        if self._own_executor:
+            self._executor.shutdown(wait=False)
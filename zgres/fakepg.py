@@ -0,0 +1,278 @@
+"""A simulated PostgreSQL for benchmarking and testing failover.
+
+FakePostgresqlPlugin implements the deadman pg_* hooks without systemd, sudo or
+a real database. All nodes configured with the same "cluster" name share an
+in-process FakeCluster which plays the role of the network and the backup
+store: the running master writes WAL at a configurable rate and replicas
+replay it at their own rate.
+
+Every operation can be made to take time, which is spent with the cluster's
+sleep function (time.sleep by default). This allows running many deadman App
+instances in one process (e.g. against a zake FakeClient) to measure end-to-end
+failover time.
+
+Example configuration:
+
+    [deadman]
+    plugins=
+        zgres#fake-postgresql
+        zgres#zookeeper
+        zgres#follow-the-leader
+        zgres#select-furthest-ahead-replica
+
+    [fake-postgresql]
+    cluster=bench
+    node_id=node1
+    wal_rate=1048576
+    replay_rate=8388608
+    latency=0.01
+    latency.pg_start=0.5
+    latency.pg_stop_replication=0.2
+    promote_poll_interval=0.1
+"""
+import time
+import random
+import logging
+
+from .plugin import subscribe
+
+_clusters = {}
+
+def _int_to_lsn(pos):
+    logfile, offset = divmod(pos, 0xFF000000)
+    return '{:X}/{:X}'.format(logfile, offset)
+
+def get_cluster(name, **kw):
+    """Get (or create) the shared fake cluster called name"""
+    cluster = _clusters.get(name)
+    if cluster is None:
+        cluster = _clusters[name] = FakeCluster(**kw)
+    return cluster
+
+def reset_clusters():
+    _clusters.clear()
+
+def remove_cluster(name):
+    _clusters.pop(name, None)
+
+class FakeCluster:
+    """State shared between all fake nodes in one database group."""
+
+    def __init__(self, clock=time.monotonic, sleep=time.sleep):
+        self.clock = clock
+        self.sleep = sleep
+        self.backups = []
+        self.primary = None
+        self.nodes = {}
+
+    def node(self, node_id, wal_rate, replay_rate):
+        """Get (or create) the node called node_id.
+
+        Like the data directory of a real database, a node outlives the deadman
+        using it, so a restarted deadman finds the node as it was left.
+        """
+        node = self.nodes.get(node_id)
+        if node is None:
+            node = self.nodes[node_id] = FakeNode(self, wal_rate, replay_rate)
+        return node
+
+    def wal_end(self):
+        """The position and timeline up to which replicas can replay"""
+        if self.primary is None:
+            return None, None
+        return self.primary.position(), self.primary.timeline
+
+class FakeNode:
+    """One simulated postgresql cluster"""
+
+    initialized = False
+    running = False
+    role = None
+    database_identifier = None
+    timeline = None
+
+    def __init__(self, cluster, wal_rate, replay_rate):
+        self._cluster = cluster
+        self.wal_rate = wal_rate
+        self.replay_rate = replay_rate
+        self._lsn = 0
+        self._updated = cluster.clock()
+
+    def position(self):
+        """Current WAL position (written for a master, replayed for a replica)"""
+        now = self._cluster.clock()
+        elapsed = now - self._updated
+        self._updated = now
+        if not self.running:
+            return self._lsn
+        if self.role == 'master':
+            self._lsn += int(elapsed * self.wal_rate)
+        elif self.role == 'replica':
+            end, timeline = self._cluster.wal_end()
+            if end is not None and end > self._lsn:
+                self._lsn = min(end, self._lsn + int(elapsed * self.replay_rate))
+                self.timeline = max(self.timeline, timeline)
+        return self._lsn
+
+    def backlog(self):
+        """Bytes of WAL which are available but not yet replayed"""
+        end, _ = self._cluster.wal_end()
+        if end is None:
+            return 0
+        return max(0, end - self.position())
+
+    def initdb(self):
+        self.initialized = True
+        self.running = False
+        self.role = 'master'
+        self.database_identifier = str(random.randint(1, 2 ** 63))
+        self.timeline = 1
+        self._lsn = 0x1000000
+
+    def restore(self, backup):
+        self.initialized = True
+        self.running = False
+        self.role = 'master' # until replication is set up
+        self.database_identifier, self.timeline, self._lsn = backup
+
+    def backup(self):
+        return (self.database_identifier, self.timeline, self.position())
+
+class FakePostgresqlPlugin:
+
+    def __init__(self, name, app):
+        self.name = name
+        self.app = app
+        self.logger = logging.getLogger(name)
+        config = self.app.config['fake-postgresql']
+        self._config = config
+        self._cluster = get_cluster(config.get('cluster', 'default').strip())
+        self._node = self._cluster.node(
+                config.get('node_id', name),
+                wal_rate=int(config.get('wal_rate', 1024 * 1024)),
+                replay_rate=int(config.get('replay_rate', 8 * 1024 * 1024)))
+
+    def _latency(self, operation):
+        seconds = self._config.get('latency.' + operation, None)
+        if seconds is None:
+            seconds = self._config.get('latency', 0)
+        seconds = float(seconds)
+        if seconds:
+            self._cluster.sleep(seconds)
+
+    @subscribe
+    def get_my_id(self):
+        return self._config.get('node_id', None)
+
+    @subscribe
+    def get_conn_info(self):
+        return dict(host=self._config.get('node_id', self.name), port='5432')
+
+    @subscribe
+    def pg_connect_info(self):
+        return dict(fake_cluster=self._config.get('cluster', 'default'), node=self.name)
+
+    @subscribe
+    def pg_get_database_identifier(self):
+        self._latency('pg_get_database_identifier')
+        if not self._node.initialized:
+            return None
+        return self._node.database_identifier
+
+    @subscribe
+    def pg_get_timeline(self):
+        self._latency('pg_get_timeline')
+        if not self._node.initialized:
+            return None
+        self._node.position()
+        return self._node.timeline
+
+    @subscribe
+    def pg_replication_role(self):
+        if not self._node.initialized:
+            return None
+        return self._node.role
+
+    @subscribe
+    def pg_get_replay_location(self):
+        self._latency('pg_get_replay_location')
+        if not self._node.running or self._node.role != 'replica':
+            return None
+        return _int_to_lsn(self._node.position())
+
+    @subscribe
+    def pg_initdb(self):
+        self._latency('pg_initdb')
+        self.pg_stop()
+        self._node.initdb()
+
+    @subscribe
+    def pg_start(self):
+        self._latency('pg_start')
+        if not self._node.initialized:
+            raise Exception('Failed to start postgresql: no cluster')
+        self._node.position()
+        self._node.running = True
+        if self._node.role == 'master':
+            self._cluster.primary = self._node
+
+    @subscribe
+    def pg_stop(self):
+        self._latency('pg_stop')
+        self._node.position()
+        self._node.running = False
+
+    @subscribe
+    def pg_restart(self):
+        self.pg_stop()
+        self.pg_start()
+
+    @subscribe
+    def pg_reload(self):
+        self._latency('pg_reload')
+
+    @subscribe
+    def pg_reset(self):
+        self.pg_stop()
+        self._node.initialized = False
+        self._node.role = None
+        if self._cluster.primary is self._node:
+            self._cluster.primary = None
+
+    @subscribe
+    def pg_setup_replication(self, primary_conninfo):
+        self._latency('pg_setup_replication')
+        self._node.position()
+        self._node.role = 'replica'
+        if self._cluster.primary is self._node:
+            self._cluster.primary = None
+
+    @subscribe
+    def pg_stop_replication(self, progress=None):
+        assert self.pg_replication_role() == 'replica'
+        self._latency('pg_stop_replication')
+        # replay everything that is left before becoming a master, reporting
+        # progress every promote_poll_interval like the apt plugin
+        poll_interval = float(self._config.get('promote_poll_interval', 0.1))
+        backlog = self._node.backlog()
+        if backlog and self._node.running:
+            clock = self._cluster.clock
+            done = clock() + backlog / self._node.replay_rate
+            while clock() < done:
+                self._cluster.sleep(min(poll_interval, done - clock()))
+                if progress is not None:
+                    progress(pg_last_xlog_replay_location=_int_to_lsn(self._node.position()))
+        self._node.position()
+        self._node.role = 'master'
+        self._node.timeline += 1
+        self._cluster.primary = self._node
+
+    @subscribe
+    def pg_backup(self):
+        self._latency('pg_backup')
+        self._cluster.backups.append(self._node.backup())
+
+    @subscribe
+    def pg_restore(self):
+        self._latency('pg_restore')
+        self._node.restore(self._cluster.backups[-1])
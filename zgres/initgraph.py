@@ -0,0 +1,138 @@
+"""Run the independent steps of App.initialize concurrently.
+
+Initializing waits on the network (EC2 metadata, ZooKeeper) and on local
+PostgreSQL (pg_controldata, config files). Most of these probes do not depend
+on each other, so they are started as soon as the steps they require have
+finished and App.initialize picks up their results when it needs them.
+
+Steps which must run on the event loop thread (e.g. the plugin initialize hook)
+run in the thread calling result(). With 0 workers every step runs there too,
+lazily and in the order the results are asked for.
+
+Configured in the [deadman] section:
+
+    initialize_workers = 4
+"""
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+_logger = logging.getLogger('zgres')
+
+class _Step:
+
+    future = None
+    started = None
+    duration = None
+
+    def __init__(self, name, func, requires, main_thread):
+        self.name = name
+        self.func = func
+        self.requires = tuple(requires)
+        self.main_thread = main_thread
+
+class InitGraph:
+
+    def __init__(self, workers, clock=time.monotonic):
+        self._clock = clock
+        self._steps = {}
+        self._order = []
+        self._results = {}
+        self._errors = {}
+        self._executor = None
+        if workers:
+            self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._start = clock()
+
+    def add(self, name, func, requires=(), main_thread=False):
+        if name in self._steps:
+            raise ValueError('A step called {} already exists'.format(name))
+        for r in requires:
+            if r not in self._steps:
+                raise ValueError('{} requires unknown step {}'.format(name, r))
+        self._steps[name] = _Step(name, func, requires, main_thread)
+        self._order.append(name)
+
+    def _done(self, step):
+        return step.name in self._results or step.name in self._errors
+
+    def _ready(self, step):
+        return all(r in self._results for r in step.requires)
+
+    def _call(self, step):
+        step.started = self._clock()
+        try:
+            return step.func()
+        finally:
+            step.duration = self._clock() - step.started
+
+    def _collect(self, step):
+        try:
+            self._results[step.name] = step.future.result()
+        except Exception as e:
+            self._errors[step.name] = e
+
+    def _run_inline(self, step):
+        try:
+            self._results[step.name] = self._call(step)
+        except Exception as e:
+            self._errors[step.name] = e
+
+    def start(self):
+        """Submit every step which can run in the background"""
+        if self._executor is None:
+            return
+        for name in self._order:
+            step = self._steps[name]
+            if step.main_thread or step.future is not None or self._done(step):
+                continue
+            if self._ready(step):
+                step.future = self._executor.submit(self._call, step)
+
+    def result(self, name):
+        """Wait for a step to finish and return its result.
+
+        Required steps are run first. If the step (or one it requires) raised
+        an exception, it is raised here.
+        """
+        step = self._steps[name]
+        for r in step.requires:
+            self.result(r)
+        while not self._done(step):
+            self.start()
+            for other in self._order:
+                # collect finished background steps as they may unblock others
+                o = self._steps[other]
+                if o.future is not None and o.future.done() and not self._done(o):
+                    self._collect(o)
+            if self._done(step):
+                break
+            if step.future is None:
+                # a main thread step or we have no workers
+                self._run_inline(step)
+            else:
+                running = [self._steps[n].future for n in self._order
+                        if self._steps[n].future is not None and not self._done(self._steps[n])]
+                wait(running, return_when=FIRST_COMPLETED)
+        if name in self._errors:
+            raise self._errors[name]
+        return self._results[name]
+
+    def timings(self):
+        """(name, started, duration) of every step which ran, started is relative to the graph"""
+        timings = []
+        for name in self._order:
+            step = self._steps[name]
+            if step.duration is not None:
+                timings.append((name, step.started - self._start, step.duration))
+        timings.sort(key=lambda t: t[1])
+        return timings
+
+    def log_timings(self):
+        for name, started, duration in self.timings():
+            _logger.info('initialize step {} started at {:.3f}s and took {:.3f}s'.format(name, started, duration))
+
+    def shutdown(self):
+        """Wait for steps which are still running and stop the worker threads"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
@@ -0,0 +1,143 @@
+"""Prometheus metrics of the deadman process itself.
+
+Unlike zgres-deadman-exporter, which polls the DCS from a separate process,
+these are collected in the deadman as things happen and served from memory.
+Nothing is recorded (and hooks are not timed) unless metrics_port is set in
+the [deadman] section:
+
+    metrics_port = 9164
+"""
+import time
+import asyncio
+import logging
+
+_logger = logging.getLogger('zgres')
+
+_FAST_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+
+class _Metrics:
+
+    def __init__(self):
+        # prometheus_client is imported here as it slows down startup
+        from prometheus_client import Counter, Histogram
+        self.hook_latency = Histogram(
+                'zgres_hook_seconds',
+                'Time spent in each plugin implementation of a hook',
+                ['hook', 'plugin'],
+                buckets=_FAST_BUCKETS)
+        self.zookeeper_latency = Histogram(
+                'zgres_zookeeper_operation_seconds',
+                'Time taken by ZooKeeper operations, including retries',
+                ['operation'],
+                buckets=_FAST_BUCKETS)
+        self.zookeeper_errors = Counter(
+                'zgres_zookeeper_operation_errors_total',
+                'ZooKeeper operations which failed after retrying',
+                ['operation'])
+        self.loop_lag = Histogram(
+                'zgres_event_loop_lag_seconds',
+                'How late a periodic timer runs on the event loop',
+                buckets=_FAST_BUCKETS)
+        self.state_published = Counter(
+                'zgres_state_published_total',
+                'Writes of our state (or stats) to the DCS',
+                ['kind'])
+        self.role_seconds = Counter(
+                'zgres_replication_role_seconds_total',
+                'Time spent in each replication role',
+                ['cluster', 'role'])
+
+_metrics = None
+
+def enable():
+    """Start recording metrics, until this is called recording is a no-op"""
+    global _metrics
+    if _metrics is None:
+        _metrics = _Metrics()
+    return _metrics
+
+def observe_hook(hook_name, plugin_name, seconds):
+    if _metrics is not None:
+        _metrics.hook_latency.labels(hook_name, plugin_name).observe(seconds)
+
+def observe_zookeeper(operation, seconds, failed=False):
+    if _metrics is not None:
+        _metrics.zookeeper_latency.labels(operation).observe(seconds)
+        if failed:
+            _metrics.zookeeper_errors.labels(operation).inc()
+
+def observe_loop_lag(seconds):
+    if _metrics is not None:
+        _metrics.loop_lag.observe(seconds)
+
+def state_published(kind):
+    if _metrics is not None:
+        _metrics.state_published.labels(kind).inc()
+
+class RoleTimer:
+    """Accumulate the time spent in each replication role.
+
+    cluster names the cluster if the deadman supervises several.
+    """
+
+    _role = None
+    _since = None
+
+    def __init__(self, clock=time.monotonic, cluster=''):
+        self._clock = clock
+        self._cluster = cluster
+        self.seconds = {}
+
+    def set_role(self, role):
+        self.update()
+        self._role = role
+
+    def update(self):
+        now = self._clock()
+        if self._since is not None:
+            role = str(self._role)
+            elapsed = now - self._since
+            self.seconds[role] = self.seconds.get(role, 0) + elapsed
+            if _metrics is not None:
+                _metrics.role_seconds.labels(self._cluster, role).inc(elapsed)
+        self._since = now
+
+class LoopLagMonitor:
+    """Measure how late timers fire on the event loop.
+
+    Also keeps the RoleTimers up to date, so the role times are never more than
+    interval seconds old.
+    """
+
+    _handle = None
+
+    def __init__(self, interval, role_timer=None):
+        self._interval = interval
+        self.role_timers = set()
+        if role_timer is not None:
+            self.role_timers.add(role_timer)
+
+    def start(self):
+        self._loop = asyncio.get_event_loop()
+        self._schedule()
+
+    def _schedule(self):
+        self._expected = self._loop.time() + self._interval
+        self._handle = self._loop.call_later(self._interval, self._tick)
+
+    def _tick(self):
+        observe_loop_lag(max(0, self._loop.time() - self._expected))
+        for role_timer in list(self.role_timers):
+            role_timer.update()
+        self._schedule()
+
+    def stop(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+def serve(port, addr=''):
+    from prometheus_client import start_http_server
+    enable()
+    _logger.info('Serving prometheus metrics on port {}'.format(port))
+    start_http_server(port, addr=addr)
@@ -1,7 +1,12 @@
 """Plugin Machinery"""
+import os
+import sys
+import json
+import time
+import hashlib
 import logging
+import importlib
 
-from pkg_resources import iter_entry_points
 import pluggy
 
 _missing = object()
@@ -10,6 +15,150 @@ _logger = logging.getLogger('zgres')
 hookspec = pluggy.HookspecMarker('zgres')
 subscribe = pluggy.HookimplMarker('zgres')
 
+#
+# Entry point index
+#
+# Importing pkg_resources and scanning every installed distribution for entry
+# points is a large part of our startup time. Startup is on the critical path
+# of every recovery (App.restart exits and systemd starts us again), so we
+# keep an index of the entry points in a cache file. The index is rebuilt when
+# the distributions on sys.path change.
+#
+# The cache file is $ZGRES_ENTRY_POINT_CACHE or ~/.cache/zgres/entry_points.json,
+# set ZGRES_ENTRY_POINT_CACHE to an empty string to disable it.
+
+_index = None
+
+class _Distribution:
+
+    def __init__(self, project_name):
+        self.project_name = project_name
+
+class _EntryPoint:
+    """The parts of pkg_resources.EntryPoint we use"""
+
+    def __init__(self, project_name, name, value):
+        self.dist = _Distribution(project_name)
+        self.name = name
+        self.value = value
+
+    def load(self, require=False):
+        # we never install requirements, so require is ignored
+        module_name, _, attrs = self.value.partition(':')
+        obj = importlib.import_module(module_name.strip())
+        for attr in attrs.strip().split('.'):
+            if attr:
+                obj = getattr(obj, attr)
+        return obj
+
+def _scan_entry_points():
+    """Build {group: [(project_name, name, value), ...]} for all installed distributions"""
+    index = {}
+    seen = set()
+    try:
+        from importlib import metadata
+    except ImportError:
+        metadata = None
+    if metadata is not None:
+        for dist in metadata.distributions():
+            project_name = dist.metadata['Name']
+            if project_name in seen:
+                continue # shadowed by an earlier entry on sys.path
+            seen.add(project_name)
+            for ep in dist.entry_points:
+                index.setdefault(ep.group, []).append((project_name, ep.name, ep.value))
+    else:
+        import pkg_resources
+        for dist in pkg_resources.working_set:
+            for group, entry_points in dist.get_entry_map().items():
+                for name, ep in entry_points.items():
+                    value = ep.module_name
+                    if ep.attrs:
+                        value += ':' + '.'.join(ep.attrs)
+                    index.setdefault(group, []).append((dist.project_name, name, value))
+    return index
+
+_ENTRY_POINTS_FILES = {
+        '.dist-info': 'entry_points.txt',
+        '.egg-info': 'entry_points.txt',
+        '.egg': os.path.join('EGG-INFO', 'entry_points.txt'),
+        }
+
+def _index_key():
+    """A key which changes if distributions are installed, removed or their entry points change"""
+    parts = [sys.version, sys.executable]
+    for path in sys.path:
+        try:
+            names = os.listdir(path or '.')
+        except OSError:
+            continue
+        for name in sorted(names):
+            if name.endswith(('.dist-info', '.egg-info', '.egg-link', '.pth', '.egg')):
+                filename = os.path.join(path or '.', name)
+                try:
+                    mtime = os.stat(filename).st_mtime
+                except OSError:
+                    continue
+                parts.append((path, name, mtime))
+                # rewriting entry_points.txt (e.g. setup.py develop) does not
+                # change the mtime of its directory
+                entry_points = _ENTRY_POINTS_FILES.get(os.path.splitext(name)[1])
+                if entry_points is not None:
+                    try:
+                        st = os.stat(os.path.join(filename, entry_points))
+                    except OSError:
+                        continue
+                    parts.append((st.st_mtime, st.st_size))
+    return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+
+def _cache_file():
+    path = os.environ.get('ZGRES_ENTRY_POINT_CACHE', None)
+    if path is None:
+        path = os.path.join(os.path.expanduser('~'), '.cache', 'zgres', 'entry_points.json')
+    return path or None
+
+def _read_cache(path, key):
+    try:
+        with open(path, 'r') as f:
+            if os.fstat(f.fileno()).st_uid != os.getuid():
+                return None # don't import code named by someone else's file
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if cached.get('key') != key:
+        return None
+    return cached['index']
+
+def _write_cache(path, key, index):
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmp, 'w') as f:
+            json.dump(dict(key=key, index=index), f)
+        os.rename(tmp, path)
+    except OSError as e:
+        _logger.info('Could not write entry point cache {}: {}'.format(path, e))
+
+def entry_point_index():
+    global _index
+    if _index is not None:
+        return _index
+    path = _cache_file()
+    key = index = None
+    if path is not None:
+        key = _index_key()
+        index = _read_cache(path, key)
+    if index is None:
+        index = _scan_entry_points()
+        if path is not None:
+            _write_cache(path, key, index)
+    _index = index
+    return index
+
+def iter_entry_points(group):
+    for project_name, name, value in entry_point_index().get(group, ()):
+        yield _EntryPoint(project_name, name, value)
+
 def load(config, section):
     """Gets the plugin factories from the config file.
 
@@ -75,6 +224,72 @@ def get_plugin_manager(setup_plugins, events, logger=_logger):
         pm.register(plugin, name=name)
     return pm
 
+def _timed(function, hook_name, plugin_name, observe, clock):
+    def timed(*args, **kw):
+        start = clock()
+        try:
+            return function(*args, **kw)
+        finally:
+            observe(hook_name, plugin_name, clock() - start)
+    timed.__wrapped__ = function
+    return timed
+
+def _is_wrapper(hookimpl):
+    return hookimpl.hookwrapper or getattr(hookimpl, 'wrapper', False)
+
+def has_implementations(hook):
+    """True if any plugin implements hook"""
+    return bool(hook.get_hookimpls())
+
+def time_hooks(pm, observe, clock=time.monotonic):
+    """Report the duration of every call to a hook implementation.
+
+    observe is called with (hook_name, plugin_name, seconds). Hook wrappers
+    are not timed.
+    """
+    for hook_name, hook in sorted(vars(pm.hook).items()):
+        if not hasattr(hook, 'get_hookimpls'):
+            continue
+        for hookimpl in hook.get_hookimpls():
+            if _is_wrapper(hookimpl):
+                continue
+            hookimpl.function = _timed(hookimpl.function, hook_name, hookimpl.plugin_name, observe, clock)
+
+class HookProfile:
+    """Call counts and latency of every (hook, plugin) pair.
+
+    Pass profile.observe to time_hooks to collect.
+    """
+
+    def __init__(self):
+        self._stats = {}
+
+    def observe(self, hook_name, plugin_name, seconds):
+        stats = self._stats.get((hook_name, plugin_name))
+        if stats is None:
+            stats = self._stats[hook_name, plugin_name] = [0, 0.0, 0.0]
+        stats[0] += 1
+        stats[1] += seconds
+        if seconds > stats[2]:
+            stats[2] = seconds
+
+    def stats(self):
+        """List of (hook, plugin, calls, total seconds, max seconds), most total time first"""
+        result = [k + tuple(v) for k, v in list(self._stats.items())]
+        result.sort(key=lambda i: i[3], reverse=True)
+        return result
+
+    def report(self):
+        lines = ['{:<30} {:<35} {:>8} {:>10} {:>10} {:>10}'.format(
+            'hook', 'plugin', 'calls', 'total(s)', 'mean(ms)', 'max(ms)')]
+        for hook_name, plugin_name, calls, total, max_seconds in self.stats():
+            lines.append('{:<30} {:<35} {:>8} {:>10.3f} {:>10.3f} {:>10.3f}'.format(
+                hook_name, plugin_name, calls, total, total / calls * 1000, max_seconds * 1000))
+        return '\n'.join(lines)
+
+    def dump(self, logger=_logger):
+        logger.warn('Hook profile:\n{}'.format(self.report()))
+
 def get_event_handler(setup_plugins, events, logger=_logger):
     return get_plugin_manager(setup_plugins, events, logger=_logger).hook
 
@@ -0,0 +1,168 @@
+"""Decide when changes to our state are written to the DCS.
+
+Every write of our state goes to every deadman and zgres-sync daemon watching
+the group, but some keys (e.g. the WAL replay location) change every time they
+are measured. The publisher writes changes to any other key immediately. Changes
+to volatile keys are held back till they move by more than a configured delta
+(published at most once per publish_window) or till publish_max_age has passed
+since the last write.
+
+If the DCS supports it, volatile keys are written as "stats" apart from the
+state, so that watchers of the state are not woken up by them. When both
+change together, the stats are written first. This way nodes which see our
+new state (e.g. that we lost the master) can rely on our stats being current.
+
+Configured in the [deadman] section, times in ticks:
+
+    volatile_state_keys = pg_last_xlog_replay_location
+    publish_window = 1
+    publish_max_age = 15
+    publish_delta.pg_last_xlog_replay_location = 16777216
+"""
+import time
+import asyncio
+
+from .utils import pg_lsn_to_int
+
+_missing = object()
+
+DEFAULT_VOLATILE_KEYS = 'pg_last_xlog_replay_location'
+DEFAULT_DELTA = 16 * 1024 * 1024 # one WAL segment
+
+def _distance(old, new):
+    """How far a volatile value has moved, None if that cannot be measured"""
+    if isinstance(old, str) and isinstance(new, str) and '/' in old and '/' in new:
+        return abs(pg_lsn_to_int(new) - pg_lsn_to_int(old))
+    if isinstance(old, (int, float)) and isinstance(new, (int, float)):
+        return abs(new - old)
+    return None
+
+class StatePublisher:
+
+    _published = None
+    _published_at = None
+    _pending = None
+    _timer = None
+    _due = None
+    _closed = False
+    publish_count = 0
+
+    def __init__(self, publish, config, tick_time, publish_stats=None):
+        self._publish = publish
+        self._publish_stats = publish_stats
+        self._config = config
+        self._volatile = set(config.get('volatile_state_keys', DEFAULT_VOLATILE_KEYS).split())
+        self._window = float(config.get('publish_window', 1)) * tick_time
+        self._max_age = float(config.get('publish_max_age', 15)) * tick_time
+
+    def _delta(self, key):
+        return float(self._config.get('publish_delta.' + key, DEFAULT_DELTA))
+
+    def _classify(self, state):
+        """Compare state to what was last published.
+
+        returns one of None (no change), 'minor', 'moved' or 'significant'
+        """
+        if self._published is None:
+            return 'significant'
+        result = None
+        for k in set(state) | set(self._published):
+            old = self._published.get(k, _missing)
+            new = state.get(k, _missing)
+            if old == new:
+                continue
+            if k not in self._volatile or old in (None, _missing) or new in (None, _missing):
+                return 'significant'
+            distance = _distance(old, new)
+            if distance is None or distance >= self._delta(k):
+                result = 'moved'
+            elif result is None:
+                result = 'minor'
+        return result
+
+    def update(self, state):
+        """Our state changed, publish it now or later.
+
+        state must not be changed after it is passed in (e.g. a FrozenDict)
+        """
+        if self._closed:
+            return
+        if state is self._published:
+            self._cancel()
+            return
+        change = self._classify(state)
+        if change is None:
+            # back to what was published
+            self._cancel()
+            return
+        if change == 'significant':
+            self.flush(state)
+            return
+        if change == 'moved':
+            due = self._published_at + self._window
+        else:
+            due = self._published_at + self._max_age
+        now = time.monotonic()
+        if now >= due:
+            self.flush(state)
+            return
+        self._pending = state
+        if self._timer is not None and self._due <= due:
+            return
+        self._cancel_timer()
+        self._due = due
+        self._timer = asyncio.get_event_loop().call_later(due - now, self._flush_pending)
+
+    def _flush_pending(self):
+        self._timer = None
+        if self._pending is not None:
+            self.flush(self._pending)
+
+    def _split(self, state):
+        topology, stats = {}, {}
+        for k, v in state.items():
+            if k in self._volatile:
+                stats[k] = v
+            else:
+                topology[k] = v
+        return topology, stats
+
+    def flush(self, state, publish=None):
+        """Publish state now.
+
+        If publish is given, it publishes the state (without the volatile keys
+        if they are published separately) instead of the usual function, it is
+        always called.
+        """
+        self._cancel()
+        force = publish is not None
+        if publish is None:
+            publish = self._publish
+        if self._publish_stats is None:
+            publish(state)
+            self.publish_count += 1
+        else:
+            topology, stats = self._split(state)
+            old_topology, old_stats = self._split(self._published or {})
+            if stats != old_stats:
+                self._publish_stats(stats)
+                self.publish_count += 1
+            if force or self._published is None or topology != old_topology:
+                publish(topology)
+                self.publish_count += 1
+        self._published = state
+        self._published_at = time.monotonic()
+
+    def _cancel_timer(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _cancel(self):
+        self._pending = None
+        self._cancel_timer()
+
+    def close(self):
+        """Cancel pending publishes, later updates are ignored"""
+        self._closed = True
+        self._cancel()
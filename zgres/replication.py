@@ -1,9 +1,8 @@
 import logging
 import asyncio
 
-import psycopg2
-
 from .plugin import subscribe
+from .dispatch import HookTimeout
 from . import utils
 
 class FollowTheLeader:
@@ -73,32 +72,16 @@ class SelectFurthestAheadReplica:
 
     @subscribe
     def start_monitoring(self):
-        loop = asyncio.get_event_loop()
-        loop.call_soon(loop.create_task, self._set_replication_status())
-
-    def _get_location(self, conn_args):
-        conn = psycopg2.connect(**conn_args)
-        try:
-            cur = conn.cursor()
-            cur.execute("SELECT pg_last_xlog_replay_location();")
-            results = cur.fetchall()[0]
-        finally:
-            conn.rollback()
-            conn.close()
-        return results[0]
+        self.app.add_check(self.name, self._set_replication_status, 1)
 
     async def _set_replication_status(self):
-        args = None
-        while True:
-            await asyncio.sleep(1)
-            try:
-                if args is None:
-                    # cache connection info till connection fails once
-                    args = self.app.pg_connect_info()
-                result = self._get_location(args)
-            except psycopg2.OperationalError as e:
-                logging.warn('Could not get wal location from postgresql: {}'.format(e))
-                result = None
-                args = None
-            self.app.update_state(
-                    pg_last_xlog_replay_location=result)
+        try:
+            result = await self.app.run_blocking(self.name, self.app.pg_get_replay_location)
+        except HookTimeout as e:
+            logging.warn('Could not get wal location from postgresql: {}'.format(e))
+            self.app.update_state(pg_last_xlog_replay_location=None)
+            return False
+        self.app.update_state(
+                pg_last_xlog_replay_location=result)
+        # a master has no replay location
+        return result is not None or self.app.replication_role != 'replica'
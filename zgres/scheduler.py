@@ -0,0 +1,156 @@
+"""Run the periodic health checks of deadman plugins.
+
+Plugins register checks with App.add_check instead of each running their own
+loop. A check is a coroutine function which returns True if all is well. The
+scheduler:
+
+    * adds random jitter to every interval so checks of several clusters on
+      one host do not run in lock step
+    * re-runs a failing check after its (usually shorter) retry_interval
+    * backs off a healthy check by check_backoff every run till it reaches
+      its max_interval
+    * runs at most check_concurrency checks at the same time
+
+Configured in the [deadman] section, times are in seconds:
+
+    check_concurrency = 2
+    check_jitter = 0.2
+    check_backoff = 1.5
+    check_max_backoff = 3
+    check_interval.zgres#apt-select1 = 1
+    check_retry_interval.zgres#apt-select1 = 0.5
+    check_max_interval.zgres#apt-select1 = 3
+
+When one deadman supervises several clusters, they share one scheduler. Each
+cluster registers its checks through a namespace() which reads the per-check
+options from the cluster's own config.
+"""
+import random
+import asyncio
+import logging
+
+_logger = logging.getLogger('zgres')
+
+class _Check:
+
+    handle = None
+    task = None
+    runs = 0
+    failures = 0
+    stopped = False
+
+    def __init__(self, name, check, interval, retry_interval, max_interval):
+        self.name = name
+        self.check = check
+        self.interval = interval
+        self.retry_interval = retry_interval
+        self.max_interval = max_interval
+        self.delay = interval
+
+class HealthCheckScheduler:
+
+    _stopped = False
+
+    def __init__(self, config):
+        self._config = config
+        self._semaphore = asyncio.Semaphore(int(config.get('check_concurrency', 2)))
+        self._jitter = float(config.get('check_jitter', 0.2))
+        self._backoff = float(config.get('check_backoff', 1.5))
+        self._max_backoff = float(config.get('check_max_backoff', 3))
+        self._checks = {}
+
+    def _option(self, config, option, name, default):
+        value = config.get('{}.{}'.format(option, name), None)
+        if value is None:
+            return default
+        return float(value)
+
+    def register(self, name, check, interval, retry_interval=None, max_interval=None):
+        """Run check every interval seconds, starting at a random time within the first interval"""
+        self._register(name, check, interval, retry_interval, max_interval, self._config, name)
+
+    def _register(self, name, check, interval, retry_interval, max_interval, config, option_name):
+        if name in self._checks:
+            raise ValueError('A check called {} is already registered'.format(name))
+        interval = self._option(config, 'check_interval', option_name, interval)
+        if retry_interval is None:
+            retry_interval = interval
+        retry_interval = self._option(config, 'check_retry_interval', option_name, retry_interval)
+        if max_interval is None:
+            max_interval = interval * self._max_backoff
+        max_interval = self._option(config, 'check_max_interval', option_name, max_interval)
+        c = self._checks[name] = _Check(name, check, interval, retry_interval, max_interval)
+        self._loop = asyncio.get_event_loop()
+        c.handle = self._loop.call_later(random.uniform(0, interval), self._start, c)
+
+    def unregister(self, name):
+        c = self._checks.pop(name)
+        c.stopped = True
+        if c.handle is not None:
+            c.handle.cancel()
+        if c.task is not None:
+            c.task.cancel()
+
+    def namespace(self, namespace, config):
+        """Register checks for one of several clusters sharing this scheduler"""
+        return _Namespace(self, namespace, config)
+
+    def _schedule(self, c, delay):
+        if self._stopped or c.stopped:
+            return
+        delay *= random.uniform(1 - self._jitter, 1 + self._jitter)
+        c.handle = self._loop.call_later(delay, self._start, c)
+
+    def _start(self, c):
+        c.handle = None
+        c.task = self._loop.create_task(self._run(c))
+
+    async def _run(self, c):
+        async with self._semaphore:
+            try:
+                ok = await c.check()
+            except Exception:
+                _logger.exception('Health check {} raised an exception'.format(c.name))
+                ok = False
+        c.task = None
+        c.runs += 1
+        if ok:
+            c.failures = 0
+            delay = c.delay
+            c.delay = min(c.delay * self._backoff, c.max_interval)
+        else:
+            c.failures += 1
+            c.delay = c.interval
+            delay = c.retry_interval
+        self._schedule(c, delay)
+
+    def stop(self):
+        self._stopped = True
+        for c in self._checks.values():
+            if c.handle is not None:
+                c.handle.cancel()
+            if c.task is not None:
+                c.task.cancel()
+
+class _Namespace:
+    """The checks of one cluster in a shared scheduler.
+
+    Check names are prefixed with the namespace, stop() only stops the checks
+    of this namespace.
+    """
+
+    def __init__(self, scheduler, namespace, config):
+        self._scheduler = scheduler
+        self._namespace = namespace
+        self._config = config
+        self._names = []
+
+    def register(self, name, check, interval, retry_interval=None, max_interval=None):
+        full_name = '{}/{}'.format(self._namespace, name)
+        self._scheduler._register(full_name, check, interval, retry_interval, max_interval, self._config, name)
+        self._names.append(full_name)
+
+    def stop(self):
+        for name in self._names:
+            self._scheduler.unregister(name)
+        self._names = []
@@ -3,7 +3,7 @@ import argparse
 from pprint import pformat, pprint
 
 from .config import parse_args
-from .deadman import App, willing_replicas
+from .deadman import App, willing_replicas, merge_stats
 
 def indented_pprint(obj):
     lines = []
@@ -18,7 +18,7 @@ def show_cli(argv=sys.argv):
     if config.has_section('deadman') and config['deadman'].get('plugins', '').strip():
         plugins = App(config)._plugins
         plugins.initialize()
-        all_state = list(plugins.dcs_list_state())
+        all_state = list(merge_stats(plugins.dcs_list_state(), plugins.dcs_list_stats()))
         my_id = plugins.get_my_id()
         my_state = None
         for id, state in all_state:
@@ -49,3 +49,4 @@ def show_cli(argv=sys.argv):
         indented_pprint(list(plugins.dcs_list_conn_info()))
         print('\nall state:')
         indented_pprint(all_state)
+        plugins.dcs_disconnect()
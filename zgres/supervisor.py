@@ -0,0 +1,160 @@
+"""Run the deadman for several PostgreSQL clusters in one process.
+
+With several clusters on one host, running one zgres-deadman per cluster
+means one ZooKeeper session, one set of watches and one set of health check
+loops per cluster. Instead, one deadman can supervise them all:
+
+    [deadman]
+    clusters = main analytics
+    plugins =
+        zgres#zookeeper
+        zgres#apt
+        zgres#follow-the-leader
+        zgres#select-furthest-ahead-replica
+
+    [zookeeper]
+    connection_string = zk1:2181,zk2:2181
+    path = /databases
+
+    [zookeeper@main]
+    group = main
+
+    [zookeeper@analytics]
+    group = analytics
+
+    [apt@main]
+    postgresql_version = 9.5
+    postgresql_cluster_name = main
+
+    [apt@analytics]
+    postgresql_version = 9.5
+    postgresql_cluster_name = analytics
+
+Every cluster gets an App with its own config (see config.cluster_configs).
+The Apps share one ZooKeeper session (and one watch per folder), one health
+check scheduler and the metrics server. If one cluster restarts, only that
+cluster is shut down and initialized again, the others carry on.
+"""
+import time
+import signal
+import asyncio
+import logging
+
+import zgres.plugin
+from zgres import metrics
+from zgres.config import cluster_configs
+from zgres.deadman import App
+from zgres.scheduler import HealthCheckScheduler
+
+class Supervisor:
+
+    _exit_code = 0
+    _stopping = False
+    _lag_monitor = None
+    hook_profile = None
+    executor = None # every cluster has its own pool for blocking hooks
+
+    def __init__(self, config, app_factory=App):
+        self.config = config
+        self.configs = cluster_configs(config)
+        if not self.configs:
+            raise ValueError('No clusters configured in [deadman] clusters')
+        self.tick_time = float(config['deadman'].get('tick_time', 2))
+        self.scheduler = HealthCheckScheduler(config['deadman'])
+        self.apps = {}
+        self.logger = logging.getLogger('zgres')
+        self._app_factory = app_factory
+        self._shared = {}
+        self._observers = []
+
+    def acquire_shared(self, key, factory):
+        shared = self._shared.get(key)
+        if shared is None:
+            shared = self._shared[key] = [factory(), 0]
+        shared[1] += 1
+        return shared[0]
+
+    def release_shared(self, key):
+        shared = self._shared[key]
+        shared[1] -= 1
+        if shared[1]:
+            return False
+        del self._shared[key]
+        return True
+
+    def _observe(self, *args):
+        for observer in self._observers:
+            observer(*args)
+
+    def _start_metrics(self):
+        port = self.config['deadman'].get('metrics_port', None)
+        if port is not None:
+            self._observers.append(metrics.observe_hook)
+            self._lag_monitor = metrics.LoopLagMonitor(1)
+            self._lag_monitor.start()
+            metrics.serve(int(port), addr=self.config['deadman'].get('metrics_addr', ''))
+        if self.config['deadman'].get('profile_hooks', 'false').lower().strip() in ('t', 'true'):
+            # log the profile of all clusters with: kill -USR1 <pid>
+            self.hook_profile = zgres.plugin.HookProfile()
+            self._observers.append(self.hook_profile.observe)
+            loop = asyncio.get_event_loop()
+            loop.add_signal_handler(signal.SIGUSR1, self.hook_profile.dump, self.logger)
+
+    def _start(self, name):
+        if self._stopping:
+            return
+        self.logger.info('Starting cluster {}'.format(name))
+        app = self.apps[name] = self._app_factory(self.configs[name], supervisor=self, cluster=name)
+        app.hook_profile = self.hook_profile
+        if self._observers:
+            zgres.plugin.time_hooks(app._pm, self._observe)
+        if self._lag_monitor is not None:
+            self._lag_monitor.role_timers.add(app._role_timer)
+        try:
+            timeout = app.initialize()
+        except Exception:
+            self.logger.exception('Failed to initialize cluster {}'.format(name))
+            timeout = 10
+        if timeout is not None:
+            app.restart(timeout)
+
+    def restart(self, app, timeout):
+        """Start a cluster again timeout ticks after its App has shut down"""
+        if self._lag_monitor is not None:
+            self._lag_monitor.role_timers.discard(app._role_timer)
+        if self.apps.get(app.cluster) is app:
+            del self.apps[app.cluster]
+        if self._stopping:
+            return
+        loop = asyncio.get_event_loop()
+        loop.call_later(timeout * self.tick_time, self._start, app.cluster)
+
+    def stop(self, timeout):
+        """Shut down every cluster and stop the event loop"""
+        self._stopping = True
+        for app in list(self.apps.values()):
+            try:
+                app.restart(0)
+            except Exception:
+                self.logger.exception('Failed to shut down cluster {}'.format(app.cluster))
+        self.scheduler.stop()
+        asyncio.get_event_loop().stop()
+        if timeout:
+            self.logger.warn('sleeping for {} ticks, then restarting'.format(timeout))
+            time.sleep(timeout * self.tick_time)
+
+    def run(self):
+        loop = asyncio.get_event_loop()
+        self.logger.info('Starting to supervise clusters: {}'.format(', '.join(sorted(self.configs))))
+        self._start_metrics()
+        for name in sorted(self.configs):
+            self._start(name)
+        loop.set_exception_handler(self._handle_exception)
+        loop.run_forever()
+        return self._exit_code
+
+    def _handle_exception(self, loop, context):
+        loop.default_exception_handler(context)
+        self.logger.error('Unexpected exception, exiting...')
+        self._exit_code = 1
+        loop.call_soon(self.stop, 10)
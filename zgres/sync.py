@@ -1,5 +1,8 @@
 import os
 import sys
+import json
+import asyncio
+import logging
 import argparse
 
 import zgres.plugin
@@ -27,6 +30,71 @@ def masters(masters):
 def databases(databases):
     pass
 
+@hookspec
+def warm_start(snapshot):
+    # called before start_watching with the values the other hooks were last
+    # called with in a previous run: {'state': ..., 'conn_info': ..., ...}.
+    # After it, the other hooks are only called if a value differs.
+    pass
+
+@hookspec(firstresult=True)
+def snapshot_version():
+    # the version of the values passed to the hooks so far (e.g. the ZooKeeper zxid)
+    pass
+
+_logger = logging.getLogger('zgres')
+
+_missing = object()
+
+class SnapshotCache:
+    """The values the sync hooks were last called with, kept in a file.
+
+    The file is JSON: {"version": 1, "source_version": ..., "values": {...}}.
+    A file of another version (or one which cannot be read) is ignored.
+    """
+
+    VERSION = 1
+    _timer = None
+
+    def __init__(self, path):
+        self.path = path
+        self.values = {}
+        self.source_version = None
+
+    def load(self):
+        """Load the file, returns True if it was loaded"""
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError) as e:
+            _logger.warn('Ignoring snapshot {}: {}'.format(self.path, e))
+            return False
+        if not isinstance(data, dict) or data.get('version') != self.VERSION:
+            _logger.warn('Ignoring snapshot {} of an unknown version'.format(self.path))
+            return False
+        self.values = data['values']
+        self.source_version = data.get('source_version')
+        return True
+
+    def save(self):
+        data = dict(version=self.VERSION, source_version=self.source_version, values=self.values)
+        tmpfile = self.path + '.tmp'
+        with open(tmpfile, 'w') as f:
+            f.write(json.dumps(data, sort_keys=True))
+        os.rename(tmpfile, self.path)
+
+    def changed(self, source_version):
+        """Save soon, at most once per second"""
+        self.source_version = source_version
+        if self._timer is None:
+            self._timer = asyncio.get_event_loop().call_later(1, self._debounced_save)
+
+    def _debounced_save(self):
+        self._timer = None
+        self.save()
+
 class SyncApp:
     """Synchronize local machine configuration with the current postgresql state.
 
@@ -42,6 +110,14 @@ class SyncApp:
                    see zgres.apply.Plugin for an example of this plugin.
         state: Called whenever the additional data of a cluster node changes (e.g. the replication lag). 
 
+    If snapshot_file is set in the [sync] section, the values passed to these
+    hooks are saved there. On start, they are loaded and passed to the
+    warm_start hook straight away, then the hooks are only called for values
+    which differ from the snapshot. So a restart does not call every hook
+    again, and plugins have the last known values even if the source cannot be
+    reached. Plugins which need all the values (not only the changed ones)
+    must implement warm_start.
+
     All plugins are configured by being passed the arguments: (plugin name, SyncApp())
     """
 
@@ -53,6 +129,13 @@ class SyncApp:
                 sys.modules[__name__],
                 self)
         self._plugins = self._pm.hook
+        self._snapshot = None
+        snapshot_file = config['sync'].get('snapshot_file', '').strip()
+        if snapshot_file:
+            self._snapshot = SnapshotCache(snapshot_file)
+            if self._snapshot.load():
+                _logger.info('Warm start from {} (version {})'.format(snapshot_file, self._snapshot.source_version))
+                self._plugins.warm_start(snapshot=dict(self._snapshot.values))
         self._plugins.start_watching(
                 state=self._only_if_has_plugins(self._plugins.state, 'state'),
                 conn_info=self._only_if_has_plugins(self._plugins.conn_info, 'conn_info'),
@@ -61,10 +144,16 @@ class SyncApp:
                 ) # start watching for cluster events.
 
     def _only_if_has_plugins(self, hookimpl, kw):
-        if hookimpl._nonwrappers or hookimpl._wrappers:
+        if zgres.plugin.has_implementations(hookimpl):
             def f(val):
+                if self._snapshot is not None and self._snapshot.values.get(kw, _missing) == val:
+                    return # no change since the last call, maybe in a previous run
                 args = {kw: val}
-                return hookimpl(**args)
+                result = hookimpl(**args)
+                if self._snapshot is not None:
+                    self._snapshot.values[kw] = val
+                    self._snapshot.changed(self._plugins.snapshot_version())
+                return result
             return f
         return None
 
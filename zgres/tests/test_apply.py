@@ -1,4 +1,5 @@
 import os
+import json
 import tempfile
 import shutil
 from unittest import TestCase, mock
@@ -120,3 +121,45 @@ class Test_main(TestCase):
                 [mock.call(hook1, self.config),
                     mock.call(hook3, self.config),
                     ])
+
+class Test_Plugin(TestCase):
+
+    def setUp(self):
+        from zgres.apply import Plugin
+        self.tmpdir = tempfile.mkdtemp()
+        self.plugin = Plugin('zgres-apply', None)
+        self.plugin._config_file = os.path.join(self.tmpdir, 'databases.json')
+        self.plugin._applied_file = os.path.join(self.tmpdir, 'databases.applied.json')
+        self.plugin._write = mock.Mock()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_warm_start_applies_once(self):
+        snapshot = {'databases': ['mygroup'], 'masters': {'mygroup': 'A'}, 'state': {}}
+        self.plugin.warm_start(snapshot)
+        # never applied
+        self.plugin._write.assert_called_once_with()
+        with mock.patch('zgres.apply.check_call') as check_call:
+            self.plugin._debounced_write()
+        check_call.assert_called_once_with('zgres-apply')
+        with open(self.plugin._config_file) as f:
+            self.assertEqual(json.load(f), {'databases': ['mygroup'], 'masters': {'mygroup': 'A'}, 'conn_info': {}})
+        # so a restart with the same snapshot does not apply it again
+        from zgres.apply import Plugin
+        plugin = Plugin('zgres-apply', None)
+        plugin._applied_file = self.plugin._applied_file
+        plugin._write = mock.Mock()
+        plugin.warm_start(snapshot)
+        self.assertFalse(plugin._write.called)
+
+    def test_failed_apply_is_retried_on_warm_start(self):
+        from subprocess import CalledProcessError
+        self.plugin.warm_start({'databases': ['mygroup']})
+        with mock.patch('zgres.apply.check_call', side_effect=CalledProcessError(1, 'zgres-apply')):
+            with self.assertRaises(CalledProcessError):
+                self.plugin._debounced_write()
+        self.assertFalse(os.path.exists(self.plugin._applied_file))
+        self.plugin._write.reset_mock()
+        self.plugin.warm_start({'databases': ['mygroup']})
+        self.plugin._write.assert_called_once_with()
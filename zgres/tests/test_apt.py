@@ -6,7 +6,6 @@ from subprocess import check_output, check_call
 
 import pytest
 import psycopg2
-from . import FakeSleeper
 
 def have_root():
     destroy = os.environ.get('ZGRES_DESTROY_MACHINE', 'false').lower()
@@ -60,12 +59,21 @@ def running_plugin(request, plugin, cluster):
 def test_config_file(plugin, cluster):
     assert plugin._config_file(name='pg_hba.conf') == '/etc/postgresql/{}/{}/pg_hba.conf'.format(*cluster)
 
-async def _disabled_monitor():
-    return
+async def _run_inline(name, func, *args):
+    return func(*args)
 
 @pytest.mark.asyncio
 async def test_monitoring(plugin, cluster):
-    with mock.patch('zgres.apt.sleep') as sleep, mock.patch('zgres.apt.call') as subprocess_call, mock.patch('zgres.apt.AptPostgresqlPlugin._monitor_select1') as ignored:
+    plugin.start_monitoring()
+    assert plugin.app.mock_calls == [
+            mock.call.unhealthy('zgres#apt-systemd', 'Waiting for first systemd check'),
+            mock.call.add_check('zgres#apt-systemd', plugin._monitor_systemd, 5, retry_interval=1),
+            mock.call.unhealthy('zgres#apt-select1', 'Waiting for first select 1 check'),
+            mock.call.add_check('zgres#apt-select1', plugin._monitor_select1, 1, retry_interval=0.5),
+            mock.call.add_check('zgres#apt-replication-role', plugin._monitor_replication_role, 5),
+            ]
+    plugin.app.reset_mock()
+    with mock.patch('zgres.apt.call') as subprocess_call:
         retvals = [
                 0, # become healthy
                 1, # noop
@@ -74,14 +82,14 @@ async def test_monitoring(plugin, cluster):
                 0, # become healthy
                 ]
         subprocess_call.side_effect = retvals
-        sleeper = FakeSleeper(max_loops=len(retvals) + 1)
-        sleep.side_effect = sleeper
-        plugin._monitor_replication_role = _disabled_monitor
-        plugin.start_monitoring()
-        await sleeper.wait()
+        plugin.app.run_blocking = _run_inline
+        results = []
+        for i in retvals:
+            results.append(await plugin._monitor_systemd())
+        # the scheduler retries sooner after a False result
+        assert results == [True, False, True, True, False, False, True]
         assert plugin.app.mock_calls == [
-                mock.call.unhealthy('zgres#apt-systemd', 'Waiting for first systemd check'),
-                mock.call.unhealthy('zgres#apt-select1', 'Waiting for first select 1 check'),
+                mock.call.healthy('zgres#apt-systemd'),
                 mock.call.healthy('zgres#apt-systemd'),
                 mock.call.healthy('zgres#apt-systemd'),
                 mock.call.unhealthy('zgres#apt-systemd', 'inactive according to systemd'),
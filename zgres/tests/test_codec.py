@@ -0,0 +1,58 @@
+import json
+from unittest import mock
+
+import pytest
+
+STATE = {
+        'replication_role': 'replica',
+        'health_problems': {},
+        'pg_last_xlog_replay_location': '0/3000060',
+        'tags': ['a', 'b'],
+        'willing': None,
+        }
+
+def test_json_is_unchanged_by_default():
+    from ..codec import Codec, decode
+    data = Codec().encode(STATE)
+    # old versions of zgres can read it
+    assert json.loads(data.decode('ascii')) == STATE
+    assert decode(data) == STATE
+
+def test_compress_large_values():
+    from ..codec import Codec, decode, MAGIC
+    codec = Codec(compress_above=100)
+    small = codec.encode({'a': 1})
+    assert not small.startswith(MAGIC)
+    big = dict(STATE, padding='x' * 1000)
+    data = codec.encode(big)
+    assert data.startswith(MAGIC)
+    assert len(data) < 200
+    assert decode(data) == big
+
+def test_msgpack():
+    pytest.importorskip('msgpack')
+    from ..codec import Codec, decode, MAGIC
+    for compress_above in (None, 0):
+        data = Codec('msgpack', compress_above=compress_above).encode(STATE)
+        assert data.startswith(MAGIC)
+        assert decode(data) == STATE
+
+def test_msgpack_not_installed():
+    from ..codec import Codec, decode
+    with mock.patch('zgres.codec._msgpack', side_effect=ImportError):
+        codec = Codec('msgpack')
+    assert codec.encoding == 'json'
+    assert decode(codec.encode(STATE)) == STATE
+
+def test_unknown_encodings():
+    from ..codec import Codec, decode, MAGIC
+    with pytest.raises(ValueError):
+        Codec('xml')
+    with pytest.raises(ValueError):
+        decode(MAGIC + b'\x02j-{}')
+    with pytest.raises(ValueError):
+        decode(MAGIC + b'\x01x-{}')
+    with pytest.raises(ValueError):
+        decode(MAGIC + b'\x01j?{}')
+    with pytest.raises(ValueError):
+        decode(MAGIC + b'\x01')
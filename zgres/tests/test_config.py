@@ -19,3 +19,36 @@ def test_error_with_no_config_file():
     parser = argparse.ArgumentParser()
     with pytest.raises(FileNotFoundError) as exec:
         config.parse_args(parser, ['myscript', '--config', name], config_file='zgres')
+
+def test_cluster_configs():
+    import configparser
+    parsed = configparser.ConfigParser(interpolation=configparser.ExtendedInterpolation())
+    parsed.read_string('''
+[deadman]
+clusters = main analytics
+plugins = zgres#zookeeper
+
+[zookeeper]
+connection_string = localhost:2181
+group = default
+
+[zookeeper@main]
+group = main
+
+[zookeeper@analytics]
+group = analytics
+
+[apt@analytics]
+postgresql_cluster_name = analytics
+restore_command = fetch ${zookeeper:group}
+''')
+    configs = config.cluster_configs(parsed)
+    assert sorted(configs) == ['analytics', 'main']
+    main, analytics = configs['main'], configs['analytics']
+    assert main['zookeeper']['group'] == 'main'
+    assert main['zookeeper']['connection_string'] == 'localhost:2181'
+    assert not main.has_section('apt')
+    assert analytics['zookeeper']['group'] == 'analytics'
+    assert analytics['apt']['restore_command'] == 'fetch analytics'
+    assert analytics['deadman']['plugins'] == 'zgres#zookeeper'
+    assert not analytics.has_section('zookeeper@main')
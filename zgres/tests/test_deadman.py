@@ -1,4 +1,4 @@
-from unittest.mock import call, patch, Mock
+from unittest.mock import call, patch, Mock, ANY
 import asyncio
 
 import pytest
@@ -33,7 +33,8 @@ def mock_state(replica=False, **kw):
 
 @pytest.fixture
 def app(deadman_app):
-    return deadman_app(dict(deadman=dict(tick_time=1)))
+    # initialize sequentially so we can check the order of hook calls
+    return deadman_app(dict(deadman=dict(tick_time=1, initialize_workers=0)))
 
 NO_SUBSCRIBER = object()
 
@@ -67,6 +68,34 @@ def setup_plugins(app, **kw):
         func.return_value = v
     return plugin
 
+def test_config_from_an_ini_file():
+    from configparser import ConfigParser
+    from ..deadman import App
+    config = ConfigParser()
+    config.read_string('[deadman]\ntick_time=0.5\n')
+    app = App(config)
+    assert app.tick_time == 0.5
+    assert app._dispatch.timeout('dcs_list_state') == 2.5
+    assert app._publisher._window == 0.5
+
+def test_initialize_probes_in_parallel(deadman_app):
+    app = deadman_app(dict(deadman=dict(tick_time=1, initialize_workers=4)))
+    plugins = setup_plugins(app)
+    assert app.initialize() == None
+    calls = plugins.mock_calls
+    # initialize is allways called first, then the probes in any order
+    assert calls[0] == call.initialize()
+    assert sorted(calls[1:5]) == sorted([
+            call.get_my_id(),
+            call.dcs_get_database_identifier(),
+            call.pg_get_database_identifier(),
+            call.pg_replication_role()])
+    assert calls[5:7] == [
+            call.pg_start(),
+            call.start_monitoring()]
+    assert app.my_id == '42'
+    assert app.replication_role == 'replica'
+
 def test_master_bootstrap(app):
     plugins = setup_plugins(app,
             dcs_get_database_identifier=None,
@@ -196,6 +225,7 @@ async def test_master_start(app):
                 app._notify_state,
                 app._notify_conn_info,
             ),
+            call.dcs_watch_stats(app._notify_stats),
             call.get_conn_info(),
             # set our first state
             call.dcs_set_state({
@@ -256,7 +286,7 @@ def test_replica_start(app):
             dcs_lock=True,
             pg_replication_role='replica',
             pg_get_database_identifier='1234')
-    app._conn_info['a'] = 'b'
+    app._conn_info = app._conn_info.replace(a='b')
     def start_monitoring():
         app.unhealthy('test_monitor', 'Waiting for first check')
     plugins.start_monitoring.side_effect = start_monitoring
@@ -279,6 +309,7 @@ def test_replica_start(app):
                 app._notify_state,
                 app._notify_conn_info,
             ),
+            call.dcs_watch_stats(app._notify_stats),
             # setup our connection info
             call.get_conn_info(),
             # set our first state
@@ -321,6 +352,8 @@ def test_plugin_subscribe_to_state(app):
                 app._notify_state,
                 app._notify_conn_info,
             )]
+    assert plugins.dcs_watch_stats.mock_calls ==  [
+            call.dcs_watch_stats(app._notify_stats)]
 
 def test_plugin_tells_app_to_follow_new_leader(app):
     plugins = setup_plugins(app)
@@ -378,7 +411,7 @@ async def test_master_lock_broken(app):
             call.pg_replication_role(),
             call.pg_stop(),
             call.dcs_disconnect(),
-            call.master_lock_changed(None)
+            # we have shut down, plugins are not told
             ]
     assert app._master_lock_owner == None
 
@@ -399,7 +432,7 @@ async def test_master_lock_changes_owner(app):
             call.pg_replication_role(),
             call.pg_stop(),
             call.dcs_disconnect(),
-            call.master_lock_changed('someone else')
+            # we have shut down, plugins are not told
             ]
     assert app._master_lock_owner == 'someone else'
     # if the lock is owned by us, carry on trucking
@@ -448,6 +481,7 @@ async def test_replica_reaction_to_master_lock_change(app):
     plugins.reset_mock()
     plugins.pg_replication_role.side_effect = ['replica', 'master']
     app.master_lock_changed(app.my_id)
+    # promotion happens in the background
     assert plugins.mock_calls ==  [
             call.pg_replication_role(),
             call.dcs_set_state({
@@ -455,46 +489,165 @@ async def test_replica_reaction_to_master_lock_change(app):
                 'willing': None,
                 'health_problems': {},
                 'host': '127.0.0.1'}),
-            call.pg_stop_replication(),
+            call.master_lock_changed('42')
+            ]
+    plugins.reset_mock()
+    await app._promotion
+    assert plugins.mock_calls ==  [
+            call.pg_stop_replication(ANY),
             call.pg_replication_role(),
             call.pg_get_timeline(),
+            # no DCS plugin publishes atomically, so the timeline is set first
+            call.dcs_publish_promotion(42, {
+                'health_problems': {},
+                'replication_role': 'master',
+                'willing': None,
+                'host': '127.0.0.1'}),
             call.dcs_set_timeline(42),
             call.dcs_set_state({
                 'health_problems': {},
                 'replication_role': 'master',
                 'willing': None,
                 'host': '127.0.0.1'}),
-            call.master_lock_changed('42')
             ]
     assert app._master_lock_owner == app.my_id
+    # the failover was traced
+    assert [r['phase'] for r in app._trace.records] == [
+            'lock_acquired',
+            'recovery_exit',
+            'timeline_published',
+            'promoted']
 
 @pytest.mark.asyncio
-async def test_replica_tries_to_take_over(app):
+async def test_promotion_is_published_atomically(app):
+    plugins = setup_plugins(app,
+            pg_get_timeline=42,
+            dcs_publish_promotion=True,
+            pg_replication_role='replica')
+    assert app.initialize() == None
+    plugins.pg_replication_role.side_effect = ['replica', 'master']
+    app.master_lock_changed(app.my_id)
+    plugins.reset_mock()
+    await app._promotion
+    assert plugins.mock_calls ==  [
+            call.pg_stop_replication(ANY),
+            call.pg_replication_role(),
+            call.pg_get_timeline(),
+            call.dcs_publish_promotion(42, {
+                'health_problems': {},
+                'replication_role': 'master',
+                'willing': None,
+                'host': '127.0.0.1'}),
+            ]
+
+@pytest.mark.asyncio
+async def test_promotion_fails_if_the_lock_is_lost(app):
+    plugins = setup_plugins(app,
+            pg_get_timeline=42,
+            dcs_publish_promotion=False,
+            pg_replication_role='replica')
+    assert app.initialize() == None
+    plugins.pg_replication_role.side_effect = ['replica', 'master']
+    app.master_lock_changed(app.my_id)
+    plugins.reset_mock()
+    with patch.object(app, 'restart') as restart:
+        await app._promotion
+    restart.assert_called_once_with(10)
+    assert not plugins.dcs_set_timeline.called
+    assert not plugins.dcs_set_conn_info.called
+
+@pytest.mark.asyncio
+async def test_promotion_reports_progress(app):
     plugins = setup_plugins(app,
+            pg_get_timeline=42,
             pg_replication_role='replica')
     assert app.initialize() == None
+    plugins.pg_replication_role.side_effect = ['replica', 'master']
+    def pg_stop_replication(progress):
+        # called in a thread while the event loop carries on
+        progress(pg_last_xlog_replay_location='68A/16E1DA8')
+    plugins.pg_stop_replication.side_effect = pg_stop_replication
+    app.master_lock_changed(app.my_id)
+    assert app.replication_role == 'taking-over'
+    await app._promotion
+    assert app._state['pg_last_xlog_replay_location'] == '68A/16E1DA8'
+    assert app.replication_role == 'master'
+    assert app._promotion is None
+
+@pytest.mark.asyncio
+async def test_replica_tries_to_take_over(app):
+    plugins = setup_plugins(app,
+            pg_replication_role='replica',
+            pg_get_replay_location='68A/16E1DA8')
+    assert app.initialize() == None
+    app._state = app._state.replace(willing=99.0) # willing for long enough
+    # another willing replica exists
+    other = {'willing': 100.0}
+    app._group_state = {'other': other}
     plugins.reset_mock()
-    # if there is no lock owner, we start looping trying to become master
+    # if there is no lock owner, we start an election
     app.master_lock_changed(None)
     assert plugins.mock_calls ==  [call.pg_replication_role(), call.master_lock_changed(None)]
     plugins.reset_mock()
-    from asyncio import sleep as real_sleep
-    with patch('asyncio.sleep') as sleep:
-        sleeper = FakeSleeper()
-        sleep.side_effect = sleeper
-        # the first thing is to sleep a bit
-        await sleeper.next()
-        assert sleeper.log == [3]
-        assert plugins.mock_calls == []
-        # takeover attempted
-        states = [(app.my_id, {'willing': 99.0}), (app.my_id, {'willing': 100.0})]
-        plugins.dcs_list_state.return_value = states
-        await sleeper.next()
-        assert sleeper.log == [3, 3]
-        assert plugins.mock_calls ==  [
-                call.dcs_list_state(),
-                call.best_replicas([('42', {'willing': 99.0}), ('42', {'willing': 100.0})]),
-                call.dcs_lock('master')]
+    await asyncio.sleep(0.01)
+    # we publish our position after the master was lost
+    assert plugins.mock_calls ==  [
+            call.pg_get_replay_location(),
+            call.veto_takeover({
+                'health_problems': {},
+                'replication_role': 'replica',
+                'host': '127.0.0.1',
+                'willing': 99.0,
+                'lost_master': True,
+                'pg_last_xlog_replay_location': '68A/16E1DA8'}),
+            call.dcs_set_state({
+                'health_problems': {},
+                'replication_role': 'replica',
+                'host': '127.0.0.1',
+                'willing': 99.0,
+                'lost_master': True,
+                'pg_last_xlog_replay_location': '68A/16E1DA8'}),
+            ]
+    plugins.reset_mock()
+    # the other willing replica has not yet reported its position, we wait for it
+    app._notify_state({'other': other, app.my_id: dict(app._state)})
+    assert plugins.mock_calls ==  [call.notify_state({'other': other, '42': app._state})]
+    plugins.reset_mock()
+    # it reports, we are the best replica and try to take over immediately
+    other = {'willing': 100.0, 'lost_master': True}
+    app._notify_state({'other': other, app.my_id: dict(app._state)})
+    await asyncio.sleep(0.01)
+    assert plugins.mock_calls ==  [
+            call.notify_state({'other': other, '42': app._state}),
+            call.best_replicas([('other', other), ('42', app._state)]),
+            call.dcs_lock('master')]
+    # when a new master appears, the election is over
+    plugins.reset_mock()
+    app.master_lock_changed('other')
+    assert app._election is None
+    assert plugins.dcs_set_state.call_args == call({
+                'health_problems': {},
+                'replication_role': 'replica',
+                'host': '127.0.0.1',
+                'willing': 99.0,
+                'lost_master': None,
+                'pg_last_xlog_replay_location': '68A/16E1DA8'})
+
+@pytest.mark.asyncio
+async def test_replica_takes_over_if_others_are_silent(deadman_app):
+    app = deadman_app(dict(deadman=dict(tick_time=0.01)))
+    plugins = setup_plugins(app,
+            pg_replication_role='replica')
+    assert app.initialize() == None
+    app._state = app._state.replace(willing=99.0) # willing for long enough
+    app._group_state = {'other': {'willing': 100.0}}
+    plugins.reset_mock()
+    app.master_lock_changed(None)
+    await asyncio.sleep(0.01)
+    assert not plugins.dcs_lock.called
+    # the other replica never reports, we decide without it after takeover_timeout ticks
+    await asyncio.sleep(0.03)
+    assert plugins.dcs_lock.mock_calls[0] == call('master')
 
 def test_replica_unhealthy(app):
     plugins = setup_plugins(app,
@@ -0,0 +1,42 @@
+import time
+import asyncio
+from unittest import mock
+
+import pytest
+
+def make_dispatcher(**config):
+    from ..dispatch import BlockingHookDispatcher
+    app = mock.Mock()
+    hooks = mock.Mock()
+    return BlockingHookDispatcher(app, hooks, config, 0.01), app, hooks
+
+def test_timeouts_are_configured_per_hook_in_ticks():
+    dispatch, app, hooks = make_dispatcher(**{
+        'blocking_hook_timeout': '3',
+        'blocking_hook_timeout.dcs_list_state': '10'})
+    assert dispatch.timeout('dcs_lock') == pytest.approx(0.03)
+    assert dispatch.timeout('dcs_list_state') == pytest.approx(0.1)
+
+@pytest.mark.asyncio
+async def test_call_hook_in_thread():
+    dispatch, app, hooks = make_dispatcher()
+    hooks.dcs_lock.return_value = True
+    assert await dispatch.call('dcs_lock', name='master') == True
+    hooks.dcs_lock.assert_called_once_with(name='master')
+    assert app.mock_calls == []
+
+@pytest.mark.asyncio
+async def test_stalled_call_is_a_health_problem():
+    from ..dispatch import HookTimeout
+    dispatch, app, hooks = make_dispatcher(blocking_hook_timeout='1')
+    hooks.dcs_list_state.side_effect = lambda: time.sleep(0.05)
+    with pytest.raises(HookTimeout):
+        await dispatch.call('dcs_list_state')
+    assert app.mock_calls == [
+            mock.call.unhealthy('zgres.stalled.dcs_list_state',
+                'blocking call dcs_list_state stalled for more than 0.01 seconds',
+                can_be_replica=True)]
+    # once the call finally returns, we are healthy again
+    app.reset_mock()
+    await asyncio.sleep(0.1)
+    assert app.mock_calls == [mock.call.healthy('zgres.stalled.dcs_list_state')]
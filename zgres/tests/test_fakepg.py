@@ -0,0 +1,92 @@
+from unittest import mock
+
+import pytest
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+@pytest.fixture
+def clock(request):
+    from .. import fakepg
+    clock = FakeClock()
+    fakepg.reset_clusters()
+    fakepg.get_cluster('test', clock=clock, sleep=clock.sleep)
+    request.addfinalizer(fakepg.reset_clusters)
+    return clock
+
+@pytest.fixture
+def plugin(clock):
+    from ..fakepg import FakePostgresqlPlugin
+    def factory(node_id, **config):
+        app = mock.Mock()
+        app.config = {'fake-postgresql': dict(
+            cluster='test',
+            node_id=node_id,
+            wal_rate='100',
+            replay_rate='10',
+            **config)}
+        return FakePostgresqlPlugin('zgres#fake-postgresql', app)
+    return factory
+
+def test_no_cluster(plugin):
+    pg = plugin('A')
+    assert pg.get_my_id() == 'A'
+    assert pg.pg_replication_role() is None
+    assert pg.pg_get_database_identifier() is None
+    assert pg.pg_get_timeline() is None
+    with pytest.raises(Exception):
+        pg.pg_start()
+
+def test_latency(plugin, clock):
+    pg = plugin('A', **{'latency': '1', 'latency.pg_start': '5'})
+    pg.pg_initdb() # pg_stop + pg_initdb
+    assert clock.now == 2
+    pg.pg_start()
+    assert clock.now == 7
+
+def test_replica_follows_master_and_takes_over(plugin, clock):
+    from ..utils import pg_lsn_to_int
+    master, replica = plugin('A'), plugin('B', promote_poll_interval='30')
+    master.pg_initdb()
+    master.pg_start()
+    master.pg_backup()
+    replica.pg_initdb()
+    replica.pg_restore()
+    replica.pg_setup_replication(None)
+    replica.pg_start()
+    assert replica.pg_replication_role() == 'replica'
+    assert replica.pg_get_database_identifier() == master.pg_get_database_identifier()
+    start = pg_lsn_to_int(replica.pg_get_replay_location())
+    # the master writes 100 bytes/s, but the replica replays only 10 bytes/s
+    clock.sleep(10)
+    assert pg_lsn_to_int(replica.pg_get_replay_location()) == start + 100
+    # the master dies, promoting the replica replays the remaining WAL
+    master.pg_stop()
+    progress = mock.Mock()
+    replica.pg_stop_replication(progress=progress)
+    assert clock.now == 100
+    # progress was reported while replaying
+    reported = [pg_lsn_to_int(c[1]['pg_last_xlog_replay_location']) for c in progress.call_args_list]
+    assert reported == [start + 400, start + 700, start + 1000]
+    assert replica.pg_replication_role() == 'master'
+    assert replica.pg_get_timeline() == 2
+    assert replica.pg_get_replay_location() is None
+
+def test_node_outlives_plugin(plugin):
+    pg = plugin('A')
+    pg.pg_initdb()
+    pg.pg_start()
+    database_id = pg.pg_get_database_identifier()
+    # e.g. the deadman restarted
+    pg = plugin('A')
+    assert pg.pg_get_database_identifier() == database_id
+    assert pg.pg_replication_role() == 'master'
+    assert plugin('B').pg_get_database_identifier() is None
@@ -0,0 +1,60 @@
+import threading
+
+import pytest
+
+from ..initgraph import InitGraph
+
+def test_sequential_steps_run_lazily():
+    log = []
+    graph = InitGraph(0)
+    graph.add('a', lambda: log.append('a') or 1)
+    graph.add('b', lambda: log.append('b') or 2, requires=['a'])
+    graph.add('c', lambda: log.append('c') or 3, requires=['a'])
+    graph.start()
+    assert log == []
+    assert graph.result('c') == 3
+    assert log == ['a', 'c']
+    assert graph.result('b') == 2
+    assert graph.result('b') == 2
+    assert log == ['a', 'c', 'b']
+    assert [t[0] for t in graph.timings()] == ['a', 'c', 'b']
+    graph.shutdown()
+
+def test_independent_steps_run_concurrently():
+    main = threading.current_thread()
+    barrier = threading.Barrier(2, timeout=5)
+    threads = {}
+    def step(name):
+        def func():
+            threads[name] = threading.current_thread()
+            if name != 'init':
+                # both probes must be running at the same time to pass
+                barrier.wait()
+            return name
+        return func
+    graph = InitGraph(2)
+    graph.add('init', step('init'), main_thread=True)
+    graph.add('dcs', step('dcs'), requires=['init'])
+    graph.add('pg', step('pg'), requires=['init'])
+    graph.start()
+    assert graph.result('pg') == 'pg'
+    assert graph.result('dcs') == 'dcs'
+    graph.shutdown()
+    assert threads['init'] is main
+    assert threads['dcs'] is not main
+    assert threads['pg'] is not main
+
+def test_errors_are_raised_by_result():
+    graph = InitGraph(2)
+    def fail():
+        raise ValueError('no')
+    graph.add('a', fail)
+    graph.add('b', lambda: 1, requires=['a'])
+    graph.add('c', lambda: 2)
+    graph.start()
+    with pytest.raises(ValueError):
+        graph.result('b')
+    assert graph.result('c') == 2
+    graph.shutdown()
+    with pytest.raises(ValueError):
+        graph.add('d', lambda: 1, requires=['unknown'])
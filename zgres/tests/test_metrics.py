@@ -0,0 +1,35 @@
+import asyncio
+from unittest import mock
+
+import pytest
+
+def test_role_timer():
+    from ..metrics import RoleTimer, enable
+    role_seconds = enable().role_seconds
+    clock = mock.Mock(side_effect=[10.0, 12.5, 13.0, 20.0])
+    before = dict(
+            replica=role_seconds.labels('', 'replica')._value.get(),
+            master=role_seconds.labels('', 'master')._value.get())
+    timer = RoleTimer(clock=clock)
+    timer.set_role('replica')
+    timer.set_role('master')
+    timer.update()
+    timer.update()
+    assert timer.seconds == {'replica': 2.5, 'master': 7.5}
+    assert role_seconds.labels('', 'replica')._value.get() - before['replica'] == 2.5
+    assert role_seconds.labels('', 'master')._value.get() - before['master'] == 7.5
+
+@pytest.mark.asyncio
+async def test_loop_lag_monitor():
+    from ..metrics import LoopLagMonitor, enable
+    loop_lag = enable().loop_lag
+    role_timer = mock.Mock()
+    def count():
+        return [s.value for s in loop_lag.collect()[0].samples if s.name.endswith('_count')][0]
+    before = count()
+    monitor = LoopLagMonitor(0.001, role_timer=role_timer)
+    monitor.start()
+    await asyncio.sleep(0.02)
+    monitor.stop()
+    assert count() > before
+    assert role_timer.update.called
@@ -166,3 +166,93 @@ def test_get_event_handler_with_single_event():
     handler = get_event_handler(plugins, Spec)
     result = handler.event(arg1='hey')
     assert result == 'hey-he'
+
+def test_time_hooks():
+    log = []
+    plugins = configure([
+            ('plugin1', Plugin1),
+            ('plugin2', Plugin2),
+            ], log)
+    pm = get_plugin_manager(plugins, sys.modules[__name__])
+    observe = Mock()
+    clock = Mock(side_effect=[1.0, 1.5, 2.0, 2.25, 3.0, 3.125])
+    time_hooks(pm, observe, clock=clock)
+    assert pm.hook.event(arg1='hey') == ['hey-ho']
+    assert pm.hook.other_event(arg1=1, arg2=5) == [6]
+    assert sorted(observe.call_args_list) == sorted([
+            (('event', 'plugin1', 0.5), {}),
+            (('event', 'plugin2', 0.25), {}),
+            (('other_event', 'plugin2', 0.125), {}),
+            ])
+
+def test_hook_profile():
+    log = []
+    plugins = configure([
+            ('plugin1', Plugin1),
+            ('plugin2', Plugin2),
+            ], log)
+    pm = get_plugin_manager(plugins, sys.modules[__name__])
+    profile = HookProfile()
+    clock = Mock(side_effect=[0, 1, 0, 2, 0, 3, 0, 1, 0, 9])
+    time_hooks(pm, profile.observe, clock=clock)
+    pm.hook.event(arg1='hey')
+    pm.hook.event(arg1='hey')
+    pm.hook.other_event(arg1=1, arg2=5)
+    stats = dict(((hook, plugin), (calls, total, max_seconds))
+            for hook, plugin, calls, total, max_seconds in profile.stats())
+    assert sum(calls for calls, _, _ in stats.values()) == 5
+    assert stats[('other_event', 'plugin2')] == (1, 9, 9)
+    assert stats[('event', 'plugin1')][0] == 2
+    assert stats[('event', 'plugin2')][0] == 2
+    # most expensive first
+    assert profile.stats()[0][:2] == ('other_event', 'plugin2')
+    logger = Mock()
+    profile.dump(logger)
+    report = logger.warn.call_args[0][0]
+    assert 'other_event' in report and 'plugin2' in report
+
+def test_entry_point_index_cache(tmpdir, monkeypatch):
+    import zgres.plugin as plugin
+    cache = str(tmpdir.join('cache', 'entry_points.json'))
+    monkeypatch.setenv('ZGRES_ENTRY_POINT_CACHE', cache)
+    monkeypatch.setattr(plugin, '_index', None)
+    scan = Mock(return_value={'zgres.deadman': [['zgres', 'apt', 'zgres.apt:AptPostgresqlPlugin']]})
+    monkeypatch.setattr(plugin, '_scan_entry_points', scan)
+    [ep] = plugin.iter_entry_points('zgres.deadman')
+    assert ep.name == 'apt'
+    assert ep.dist.project_name == 'zgres'
+    from zgres.apt import AptPostgresqlPlugin
+    assert ep.load(require=False) is AptPostgresqlPlugin
+    assert list(plugin.iter_entry_points('zgres.sync')) == []
+    # memoized in process
+    assert scan.call_count == 1
+    # and read from the cache in a new process
+    monkeypatch.setattr(plugin, '_index', None)
+    assert [ep.name for ep in plugin.iter_entry_points('zgres.deadman')] == ['apt']
+    assert scan.call_count == 1
+    # a changed key rebuilds the index
+    monkeypatch.setattr(plugin, '_index', None)
+    monkeypatch.setattr(plugin, '_index_key', lambda: 'other')
+    assert [ep.name for ep in plugin.iter_entry_points('zgres.deadman')] == ['apt']
+    assert scan.call_count == 2
+    # the cache can be disabled
+    monkeypatch.setattr(plugin, '_index', None)
+    monkeypatch.setenv('ZGRES_ENTRY_POINT_CACHE', '')
+    list(plugin.iter_entry_points('zgres.deadman'))
+    assert scan.call_count == 3
+    monkeypatch.setattr(plugin, '_index', None)
+
+def test_entry_point_index_key(tmpdir, monkeypatch):
+    import os
+    import zgres.plugin as plugin
+    egg_info = tmpdir.mkdir('zgres.egg-info')
+    entry_points = egg_info.join('entry_points.txt')
+    entry_points.write('[zgres.deadman]\napt = zgres.apt:AptPostgresqlPlugin\n')
+    monkeypatch.setattr(sys, 'path', [str(tmpdir)])
+    key = plugin._index_key()
+    assert plugin._index_key() == key
+    # e.g. setup.py develop rewrites the file in place
+    mtime = os.stat(str(egg_info)).st_mtime
+    entry_points.write('[zgres.deadman]\napt = zgres.apt:AptPostgresqlPlugin\nec2 = zgres.ec2:Ec2Plugin\n')
+    os.utime(str(egg_info), (mtime, mtime))
+    assert plugin._index_key() != key
@@ -0,0 +1,94 @@
+import asyncio
+from unittest import mock
+
+import pytest
+
+def make_publisher(**config):
+    from ..publish import StatePublisher
+    publish = mock.Mock()
+    return StatePublisher(publish, config, 0.01), publish
+
+def lsn(state, pos):
+    return dict(state, pg_last_xlog_replay_location='0/{:X}'.format(pos))
+
+@pytest.mark.asyncio
+async def test_significant_changes_are_published_immediately():
+    publisher, publish = make_publisher()
+    state = dict(replication_role='replica', health_problems={})
+    publisher.update(state)
+    publisher.update(lsn(state, 100))
+    publisher.update(lsn(dict(state, health_problems={'boom': {}}), 100))
+    assert publish.mock_calls == [
+            mock.call(state),
+            mock.call(lsn(state, 100)),
+            mock.call(lsn(dict(state, health_problems={'boom': {}}), 100))]
+
+@pytest.mark.asyncio
+async def test_small_moves_wait_for_max_age():
+    publisher, publish = make_publisher(publish_max_age=3)
+    state = lsn({}, 100)
+    publisher.update(state)
+    publish.reset_mock()
+    for pos in range(101, 110):
+        publisher.update(lsn(state, pos))
+    assert publish.mock_calls == []
+    await asyncio.sleep(0.04)
+    # only the latest value is written
+    assert publish.mock_calls == [mock.call(lsn(state, 109))]
+
+@pytest.mark.asyncio
+async def test_large_moves_are_coalesced_in_window():
+    publisher, publish = make_publisher(**{
+        'publish_window': 2,
+        'publish_delta.pg_last_xlog_replay_location': '1000'})
+    state = lsn({}, 0)
+    publisher.update(state)
+    publisher.update(lsn(state, 5000))
+    publisher.update(lsn(state, 9000))
+    assert publish.mock_calls == [mock.call(state)]
+    await asyncio.sleep(0.03)
+    assert publish.mock_calls == [mock.call(state), mock.call(lsn(state, 9000))]
+    assert publisher.publish_count == 2
+
+@pytest.mark.asyncio
+async def test_pending_change_dropped_if_reverted():
+    publisher, publish = make_publisher(publish_max_age=1)
+    state = lsn({}, 100)
+    publisher.update(state)
+    publisher.update(lsn(state, 101))
+    publisher.update(state)
+    await asyncio.sleep(0.02)
+    assert publish.mock_calls == [mock.call(state)]
+
+@pytest.mark.asyncio
+async def test_stats_are_published_separately_and_first():
+    from ..publish import StatePublisher
+    publish = mock.Mock()
+    publisher = StatePublisher(publish.state, {}, 0.01, publish_stats=publish.stats)
+    state = dict(replication_role='replica')
+    publisher.update(state)
+    publisher.update(lsn(state, 100))
+    publisher.update(lsn(dict(state, lost_master=True), 200))
+    assert publish.mock_calls == [
+            mock.call.state(state),
+            mock.call.stats(lsn({}, 100)),
+            mock.call.stats(lsn({}, 200)),
+            mock.call.state(dict(state, lost_master=True))]
+
+@pytest.mark.asyncio
+async def test_flush_with_another_publish_function():
+    from ..publish import StatePublisher
+    publish = mock.Mock()
+    publisher = StatePublisher(publish.state, {'publish_max_age': 3}, 0.01, publish_stats=publish.stats)
+    state = lsn(dict(replication_role='replica'), 100)
+    publisher.update(state)
+    publisher.update(lsn(state, 101)) # pending
+    publish.reset_mock()
+    # e.g. our new role is published with our timeline, it is always called
+    publisher.flush(lsn(state, 101), publish=publish.promotion)
+    assert publish.mock_calls == [
+            mock.call.stats(lsn({}, 101)),
+            mock.call.promotion({'replication_role': 'replica'})]
+    await asyncio.sleep(0.05)
+    # the pending change was published with it
+    assert len(publish.mock_calls) == 2
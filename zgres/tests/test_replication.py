@@ -19,3 +19,27 @@ def test_no_conn_info(follow_the_leader):
     assert follow_the_leader._am_following == None
     follow_the_leader.master_lock_changed(follow_the_leader.app.my_id)
     assert follow_the_leader._am_following == None
+
+@pytest.mark.asyncio
+async def test_replication_status_check():
+    from ..deadman import App
+    from ..dispatch import HookTimeout
+    from ..replication import SelectFurthestAheadReplica
+    app = mock.Mock(spec_set=App)
+    plugin = SelectFurthestAheadReplica('zgres#select-furthest-ahead-replica', app)
+    async def run_blocking(name, func):
+        return func()
+    app.run_blocking.side_effect = run_blocking
+    app.replication_role = 'replica'
+    app.pg_get_replay_location.return_value = '0/3000060'
+    assert await plugin._set_replication_status()
+    app.update_state.assert_called_with(pg_last_xlog_replay_location='0/3000060')
+    # a replica should know its replay location
+    app.pg_get_replay_location.return_value = None
+    assert not await plugin._set_replication_status()
+    # a master has none, that is fine so the check backs off
+    app.replication_role = 'master'
+    assert await plugin._set_replication_status()
+    app.run_blocking.side_effect = HookTimeout('stalled')
+    assert not await plugin._set_replication_status()
+    app.update_state.assert_called_with(pg_last_xlog_replay_location=None)
@@ -0,0 +1,80 @@
+import asyncio
+from unittest import mock
+
+import pytest
+
+def make_scheduler(**config):
+    from ..scheduler import HealthCheckScheduler
+    config.setdefault('check_jitter', 0)
+    return HealthCheckScheduler(config)
+
+def recording_check(log, results):
+    results = iter(results)
+    async def check():
+        log.append(asyncio.get_event_loop().time())
+        return next(results, True)
+    return check
+
+@pytest.mark.asyncio
+async def test_healthy_checks_back_off():
+    scheduler = make_scheduler(check_backoff=2)
+    log = []
+    scheduler.register('check', recording_check(log, []), 0.01, max_interval=0.04)
+    await asyncio.sleep(0.2)
+    scheduler.stop()
+    gaps = [b - a for a, b in zip(log, log[1:])]
+    assert gaps[0] == pytest.approx(0.01, abs=0.005)
+    assert gaps[1] == pytest.approx(0.02, abs=0.005)
+    assert gaps[2] == pytest.approx(0.04, abs=0.005)
+    assert gaps[3] == pytest.approx(0.04, abs=0.005)
+
+@pytest.mark.asyncio
+async def test_failing_checks_are_retried_sooner():
+    scheduler = make_scheduler(check_backoff=2)
+    log = []
+    scheduler.register('check', recording_check(log, [True, True, False, True]), 0.02, retry_interval=0.005)
+    await asyncio.sleep(0.15)
+    scheduler.stop()
+    gaps = [b - a for a, b in zip(log, log[1:])]
+    assert gaps[:4] == [
+            pytest.approx(0.02, abs=0.004),
+            pytest.approx(0.04, abs=0.004),
+            pytest.approx(0.005, abs=0.004), # failed, retry
+            pytest.approx(0.02, abs=0.004)] # back to the normal interval
+
+@pytest.mark.asyncio
+async def test_concurrency_is_capped():
+    scheduler = make_scheduler(check_concurrency=1)
+    running = []
+    max_running = 0
+    async def check():
+        nonlocal max_running
+        running.append(1)
+        max_running = max(max_running, len(running))
+        await asyncio.sleep(0.005)
+        running.pop()
+        return True
+    for i in range(5):
+        scheduler.register('check{}'.format(i), check, 0.001)
+    await asyncio.sleep(0.05)
+    scheduler.stop()
+    assert max_running == 1
+
+@pytest.mark.asyncio
+async def test_exception_is_a_failure():
+    scheduler = make_scheduler()
+    check = mock.Mock(side_effect=Exception('boom'))
+    async def failing():
+        check()
+    scheduler.register('check', failing, 0.001, retry_interval=0.001)
+    await asyncio.sleep(0.02)
+    scheduler.stop()
+    assert check.call_count > 1
+    assert scheduler._checks['check'].failures == check.call_count
+
+def test_interval_can_be_configured():
+    scheduler = make_scheduler(**{'check_interval.a': '7', 'check_max_interval.a': '9'})
+    with mock.patch('asyncio.get_event_loop'):
+        scheduler.register('a', None, 1)
+    c = scheduler._checks['a']
+    assert (c.interval, c.retry_interval, c.max_interval) == (7, 7, 9)
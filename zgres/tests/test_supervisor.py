@@ -0,0 +1,115 @@
+import asyncio
+import configparser
+from unittest import mock
+
+import pytest
+
+from . import mock_plugin
+
+CONFIG = '''
+[deadman]
+clusters = a b
+plugins =
+
+[zookeeper@a]
+group = a
+
+[zookeeper@b]
+group = b
+'''
+
+@pytest.fixture
+def supervisor():
+    from ..deadman import App
+    from ..supervisor import Supervisor
+    config = configparser.ConfigParser()
+    config.read_string(CONFIG)
+    plugins = {}
+    def app_factory(config, supervisor, cluster):
+        app = App(config, supervisor=supervisor, cluster=cluster)
+        p = plugins[cluster] = mock_plugin(app._pm)
+        p.get_my_id.return_value = 'me'
+        p.pg_replication_role.return_value = 'replica'
+        p.dcs_get_database_identifier.return_value = '1'
+        p.pg_get_database_identifier.return_value = '1'
+        p.get_conn_info.return_value = {}
+        return app
+    s = Supervisor(config, app_factory=app_factory)
+    s.plugins = plugins
+    yield s
+    s.scheduler.stop()
+
+def test_share_objects(supervisor):
+    factory = mock.Mock(side_effect=lambda: object())
+    one = supervisor.acquire_shared('key', factory)
+    assert supervisor.acquire_shared('key', factory) is one
+    assert factory.call_count == 1
+    assert not supervisor.release_shared('key')
+    # the last user closes it
+    assert supervisor.release_shared('key')
+    assert supervisor.acquire_shared('key', factory) is not one
+
+@pytest.mark.asyncio
+async def test_clusters_restart_independently(supervisor):
+    supervisor._start('a')
+    supervisor._start('b')
+    a, b = supervisor.apps['a'], supervisor.apps['b']
+    assert a.config['zookeeper']['group'] == 'a'
+    assert b.config['zookeeper']['group'] == 'b'
+    # the clusters share the scheduler but keep their checks apart
+    async def check():
+        return True
+    a.add_check('select1', check, 10)
+    b.add_check('select1', check, 10)
+    assert sorted(supervisor.scheduler._checks) == ['a/select1', 'b/select1']
+    plugin_a = supervisor.plugins['a']
+    a.restart(0)
+    assert plugin_a.dcs_disconnect.called
+    assert 'a' not in supervisor.apps
+    assert sorted(supervisor.scheduler._checks) == ['b/select1']
+    assert supervisor.apps['b'] is b
+    assert not b._stopped
+    # a is started again
+    await asyncio.sleep(0.01)
+    assert supervisor.apps['a'] is not a
+    assert supervisor.plugins['a'] is not plugin_a
+    assert supervisor.plugins['a'].initialize.called
+
+@pytest.mark.asyncio
+async def test_restart_cancels_the_election(supervisor):
+    supervisor._start('a')
+    supervisor._start('b')
+    a = supervisor.apps['a']
+    plugin_a = supervisor.plugins['a']
+    a.master_lock_changed(None)
+    await asyncio.sleep(0.01)
+    election, task = a._election, a._election_task
+    assert election is not None
+    a.restart(0)
+    assert election.cancelled()
+    plugin_a.reset_mock()
+    await asyncio.sleep(0.01)
+    assert task.done()
+    # the old app does not call its plugins once they are shut down
+    assert not plugin_a.best_replicas.called
+    assert not plugin_a.dcs_set_state.called
+    assert not supervisor.apps['b']._stopped
+
+@pytest.mark.asyncio
+async def test_master_without_the_lock_does_not_start_an_election(supervisor):
+    supervisor._start('a')
+    supervisor._start('b')
+    a = supervisor.apps['a']
+    plugin_a = supervisor.plugins['a']
+    plugin_a.pg_replication_role.return_value = 'master'
+    plugin_a.reset_mock()
+    a.master_lock_changed(None)
+    assert a._stopped
+    assert a._election is None
+    assert a._election_task is None
+    assert not [r for r in a._trace.records if r['phase'] == 'lock_lost']
+    await asyncio.sleep(0.01)
+    # the stopped app did not call its plugins after shutting them down
+    calls = [c[0] for c in plugin_a.mock_calls]
+    assert calls[calls.index('dcs_disconnect'):] == ['dcs_disconnect']
+    assert not supervisor.apps['b']._stopped
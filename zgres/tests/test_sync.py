@@ -0,0 +1,117 @@
+import os
+import json
+import asyncio
+from unittest import mock
+
+import pytest
+
+from zgres.plugin import subscribe
+
+class Source:
+
+    version = 0
+
+    def __init__(self, name, app):
+        _plugins['source'] = self
+
+    @subscribe
+    def start_watching(self, state, conn_info, masters, databases):
+        self.masters = masters
+        self.databases = databases
+
+    @subscribe
+    def snapshot_version(self):
+        return self.version
+
+class Subscriber:
+
+    def __init__(self, name, app):
+        self.calls = []
+        _plugins['subscriber'] = self
+
+    @subscribe
+    def warm_start(self, snapshot):
+        self.calls.append(('warm_start', snapshot))
+
+    @subscribe
+    def masters(self, masters):
+        self.calls.append(('masters', masters))
+
+    @subscribe
+    def databases(self, databases):
+        self.calls.append(('databases', databases))
+
+_plugins = {}
+
+@pytest.fixture
+def sync_app(tmpdir):
+    from zgres.plugin import _EntryPoint
+    from zgres.sync import SyncApp
+    entry_points = [
+            _EntryPoint('zgres', 'source', 'zgres.tests.test_sync:Source'),
+            _EntryPoint('zgres', 'subscriber', 'zgres.tests.test_sync:Subscriber'),
+            ]
+    snapshot_file = str(tmpdir.join('snapshot.json'))
+    def factory():
+        _plugins.clear()
+        config = {'sync': {
+            'plugins': 'zgres#source zgres#subscriber',
+            'snapshot_file': snapshot_file}}
+        with mock.patch('zgres.plugin.iter_entry_points', return_value=entry_points):
+            SyncApp(config)
+        return _plugins['source'], _plugins['subscriber']
+    factory.snapshot_file = snapshot_file
+    return factory
+
+@pytest.mark.asyncio
+async def test_warm_start(sync_app):
+    source, subscriber = sync_app()
+    # nothing to start from the first time
+    assert subscriber.calls == []
+    source.version = 17
+    source.masters({'mygroup': 'A'})
+    source.databases(['mygroup'])
+    await asyncio.sleep(1.1)
+    with open(sync_app.snapshot_file) as f:
+        assert json.load(f) == {
+                'version': 1,
+                'source_version': 17,
+                'values': {'masters': {'mygroup': 'A'}, 'databases': ['mygroup']}}
+    # after a restart, we start from the snapshot
+    source, subscriber = sync_app()
+    assert subscriber.calls == [('warm_start', {'masters': {'mygroup': 'A'}, 'databases': ['mygroup']})]
+    # and the hooks are only called for the values which changed
+    source.databases(['mygroup'])
+    source.masters({'mygroup': 'B'})
+    assert subscriber.calls[1:] == [('masters', {'mygroup': 'B'})]
+
+@pytest.mark.asyncio
+async def test_unusable_snapshots_are_ignored(sync_app):
+    with open(sync_app.snapshot_file, 'w') as f:
+        f.write(json.dumps({'version': 2, 'values': {'databases': ['mygroup']}}))
+    source, subscriber = sync_app()
+    assert subscriber.calls == []
+    with open(sync_app.snapshot_file, 'w') as f:
+        f.write('{"version": 1, "val')
+    source, subscriber = sync_app()
+    assert subscriber.calls == []
+    source.databases(['mygroup'])
+    assert subscriber.calls == [('databases', ['mygroup'])]
+
+def test_snapshot_is_replaced_atomically(tmpdir):
+    from zgres.sync import SnapshotCache
+    path = str(tmpdir.join('snapshot.json'))
+    cache = SnapshotCache(path)
+    assert not cache.load()
+    cache.values['databases'] = ['mygroup']
+    cache.source_version = 3
+    with mock.patch('os.rename', side_effect=OSError):
+        with pytest.raises(OSError):
+            cache.save()
+    # a failed save leaves the old file alone
+    assert not os.path.exists(path)
+    cache.save()
+    loaded = SnapshotCache(path)
+    assert loaded.load()
+    assert loaded.values == {'databases': ['mygroup']}
+    assert loaded.source_version == 3
@@ -0,0 +1,63 @@
+import json
+
+import pytest
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+def test_failover_phases_are_recorded(tmpdir):
+    from ..trace import FailoverTracer
+    path = tmpdir.join('trace.jsonl')
+    clock = FakeClock()
+    tracer = FailoverTracer({'trace_file': str(path)}, clock=clock)
+    tracer.node = 'A'
+    # nothing is recorded outside of a failover
+    tracer.phase('willing_computed')
+    with tracer.span('recovery_exit'):
+        pass
+    assert list(tracer.records) == []
+    tracer.start('lock_lost')
+    clock.now += 0.5
+    with tracer.span('lock_requested') as data:
+        clock.now += 0.25
+        data['locked'] = True
+    tracer.finish('promoted')
+    assert not tracer.active
+    tracer.flush()
+    records = [json.loads(l) for l in path.read().splitlines()]
+    assert records == list(tracer.records)
+    assert [(r['phase'], r['start'], r['duration']) for r in records] == [
+            ('lock_lost', 0, 0),
+            ('lock_requested', 0.5, 0.25),
+            ('promoted', 0.75, 0)]
+    assert records[1]['locked'] == True
+    assert len(set(r['failover'] for r in records)) == 1
+    assert set(r['node'] for r in records) == set(['A'])
+
+def test_span_records_errors():
+    from ..trace import FailoverTracer
+    tracer = FailoverTracer({'trace_keep': '2'}, clock=FakeClock())
+    tracer.start('lock_lost')
+    with pytest.raises(ValueError):
+        with tracer.span('recovery_exit'):
+            raise ValueError('boom')
+    tracer.phase('timeline_published')
+    # only the last records are kept
+    assert [r['phase'] for r in tracer.records] == ['recovery_exit', 'timeline_published']
+    assert tracer.records[0]['error'] == "ValueError('boom')"
+
+def test_unwritable_trace_file(tmpdir):
+    from ..trace import FailoverTracer
+    path = tmpdir.join('missing', 'trace.jsonl')
+    tracer = FailoverTracer({'trace_file': str(path)}, clock=FakeClock())
+    # the failover carries on, the file is written in the background
+    tracer.start('lock_lost')
+    tracer.finish('promoted')
+    tracer.flush()
+    assert not path.exists()
+    assert [r['phase'] for r in tracer.records] == ['lock_lost', 'promoted']
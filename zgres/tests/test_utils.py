@@ -4,3 +4,25 @@ def test_pg_lsn_to_int():
     assert pg_lsn_to_int('0/000000') == 0
     assert pg_lsn_to_int('0/00000F') == 15
     assert pg_lsn_to_int('1/00000F') == 0xFF00000F
+
+def test_freeze():
+    import copy
+    import json
+    import pytest
+    from ..utils import freeze, FrozenDict
+    state = freeze({'health_problems': {'a': {'reason': 'x'}}, 'l': [1, {'b': 2}]})
+    assert state == {'health_problems': {'a': {'reason': 'x'}}, 'l': (1, {'b': 2})}
+    assert isinstance(state['health_problems']['a'], FrozenDict)
+    assert isinstance(state['l'][1], FrozenDict)
+    assert json.loads(json.dumps(state)) == {'health_problems': {'a': {'reason': 'x'}}, 'l': [1, {'b': 2}]}
+    with pytest.raises(TypeError):
+        state['x'] = 1
+    with pytest.raises(TypeError):
+        state['health_problems'].clear()
+    # copies are not needed
+    assert copy.deepcopy(state) is state
+    assert freeze(state) is state
+    changed = state.replace(x={'y': 1})
+    assert changed == dict(state, x={'y': 1})
+    assert isinstance(changed['x'], FrozenDict)
+    assert 'x' not in state
@@ -2,14 +2,17 @@ from configparser import ConfigParser
 from unittest import mock
 import time
 import json
+import threading
 import asyncio
 
 import pytest
 from zake.fake_client import FakeClient
 from kazoo.client import KazooState
+from kazoo.protocol.states import KeeperState
 import kazoo.exceptions
 
 from zgres import sync
+from zgres.zookeeper import SessionRegistry
 from . import FakeSleeper
 
 class MyFakeClient(FakeClient):
@@ -81,7 +84,8 @@ def storage(request):
     from ..zookeeper import ZookeeperStorage
     s = ZookeeperStorage('connection_string', '/path')
     zk = MyFakeClient()
-    with mock.patch('zgres.zookeeper.KazooClient') as KazooClient:
+    with mock.patch('zgres.zookeeper.KazooClient') as KazooClient, \
+            mock.patch('zgres.zookeeper.sessions', SessionRegistry()):
         KazooClient.return_value = zk
         s.dcs_connect()
     return s
@@ -90,7 +94,7 @@ def storage(request):
 def deadman_plugin(request):
     from ..deadman import App
     storage = None
-    def factory(my_id='42'):
+    def factory(my_id='42', group='mygroup', sessions=None):
         nonlocal storage
         app = mock.Mock(spec_set=App)
         app.my_id = my_id
@@ -99,16 +103,22 @@ def deadman_plugin(request):
                 zookeeper=dict(
                     connection_string='localhost:1234',
                     path='/mypath',
-                    group='mygroup',
+                    group=group,
                     ))
         app.master_lock_changed._is_coroutine = False # otherwise tests fail :(
+        app.acquire_shared = lambda key, factory: factory()
+        app.release_shared = lambda key: True
         from ..zookeeper import ZooKeeperDeadmanPlugin
         plugin = ZooKeeperDeadmanPlugin('zgres#zookeeper', app)
         zk = MyFakeClient(storage=storage)
         if storage is None:
             # all plugins created by this factory SHARE a storage
             storage = zk.storage
-        with mock.patch('zgres.zookeeper.KazooClient') as KazooClient:
+        if sessions is None:
+            # a session of its own, like in a separate process
+            sessions = SessionRegistry()
+        with mock.patch('zgres.zookeeper.KazooClient') as KazooClient, \
+                mock.patch('zgres.zookeeper.sessions', sessions):
             KazooClient.return_value = zk
             plugin.initialize()
         return plugin
@@ -202,13 +212,13 @@ async def test_notifications_of_state_chagnge_where_id_has_a_dash(deadman_plugin
     finished = asyncio.Event()
     asyncio.get_event_loop().call_later(5, finished.set)
     callback = mock.Mock()
-    callback.side_effect = lambda *args, **kw: finished.set()
+    callback.side_effect = lambda state: state and finished.set()
     pluginA.dcs_watch(None, callback, None)
     pluginA.dcs_set_state(dict(name='A'))
     await finished.wait()
-    assert callback.mock_calls == [
-            mock.call({'i-9b61354f': {'name': 'A'}}),
-            ]
+    # the initial snapshot may be in the same batch as our write
+    assert callback.mock_calls[-1] == mock.call({'i-9b61354f': {'name': 'A'}})
+    assert callback.mock_calls[:-1] in ([], [mock.call({})])
 
 @pytest.mark.asyncio
 async def test_groups_are_independant(deadman_plugin):
@@ -231,10 +241,9 @@ async def test_groups_are_independant(deadman_plugin):
     # NOTE: we test only the LAST call as state for A and B may come out-of-order
     #       but the final, rest state, should be correct
     assert callbackB.mock_calls[-1] == mock.call({'A': {'name': 'A'}, 'B': {'name': 'B'}})
-    # C got it's own event
-    assert callbackC.mock_calls == [
-            mock.call({'C': {'name': 'C'}}),
-            ]
+    # C got the (empty) initial snapshot and it's own event, maybe in one batch
+    assert callbackC.mock_calls[-1] == mock.call({'C': {'name': 'C'}})
+    assert callbackC.mock_calls[:-1] in ([], [mock.call({})])
     # We can get all info
     assert sorted(pluginA.dcs_list_state()) == sorted(pluginB.dcs_list_state())
     assert sorted(pluginA.dcs_list_state()) == [('A', {'name': 'A'}), ('B', {'name': 'B'})]
@@ -304,6 +313,18 @@ async def test_retry_NO_retry_on_session_expired(deadman_plugin):
             mock.call.restart(0)
             ]
 
+@pytest.mark.asyncio
+async def test_session_expired_in_a_worker_thread(deadman_plugin):
+    plugin = deadman_plugin('A')
+    mock_verify(plugin, [kazoo.exceptions.SessionExpiredError()])
+    loop = asyncio.get_event_loop()
+    with pytest.raises(kazoo.exceptions.SessionExpiredError):
+        await loop.run_in_executor(None, plugin.dcs_set_state, dict(name='A'))
+    await asyncio.sleep(0.001)
+    assert plugin.app.mock_calls == [
+            mock.call.restart(0)
+            ]
+
 @pytest.mark.asyncio
 async def test_retry_with_random_exception(deadman_plugin):
     # connection loss is a temporary exception which seems to happen after a re-connection
@@ -356,3 +377,417 @@ async def test_retry_list_all_states(deadman_plugin):
     await asyncio.sleep(0.001)
     assert plugin.app.mock_calls == []
 
+
+@pytest.mark.asyncio
+async def test_list_state_from_watch(deadman_plugin):
+    pluginA, pluginB = deadman_plugin('A'), deadman_plugin('B')
+    pluginB.dcs_set_state(dict(name='B'))
+    pluginA.dcs_watch(None, mock.Mock(), mock.Mock())
+    await asyncio.sleep(0.005)
+    with mock.patch.object(pluginA._storage, 'dcs_list_state') as list_state:
+        # answered from the watch, not zookeeper
+        assert pluginA.dcs_list_state() == [('B', {'name': 'B'})]
+        # our own writes are visible before the watch fires
+        pluginA.dcs_set_state(dict(name='A'))
+        assert sorted(pluginA.dcs_list_state()) == [('A', {'name': 'A'}), ('B', {'name': 'B'})]
+        pluginA.dcs_set_conn_info(dict(host='a'))
+        assert pluginA.dcs_list_conn_info() == [('A', {'host': 'a'})]
+        pluginA.dcs_delete_conn_info()
+        assert pluginA.dcs_list_conn_info() == []
+    assert not list_state.called
+
+@pytest.mark.asyncio
+async def test_stats_do_not_wake_state_watchers(deadman_plugin):
+    pluginA, pluginB = deadman_plugin('A'), deadman_plugin('B')
+    state, stats = mock.Mock(), mock.Mock()
+    pluginB.dcs_watch(None, state, None)
+    pluginB.dcs_watch_stats(stats)
+    pluginA.dcs_set_state(dict(name='A'))
+    await asyncio.sleep(0.005)
+    pluginA.dcs_set_stats(dict(pg_last_xlog_replay_location='0/1'))
+    pluginA.dcs_set_stats(dict(pg_last_xlog_replay_location='0/2'))
+    await asyncio.sleep(0.005)
+    assert state.mock_calls[-1] == mock.call({'A': {'name': 'A'}})
+    assert state.mock_calls[:-1] in ([], [mock.call({})])
+    assert stats.mock_calls[-1] == mock.call({'A': {'pg_last_xlog_replay_location': '0/2'}})
+    assert pluginB.dcs_list_stats() == [('A', {'pg_last_xlog_replay_location': '0/2'})]
+    assert pluginB.dcs_list_state() == [('A', {'name': 'A'})]
+
+@pytest.mark.asyncio
+async def test_groups_share_one_watch(deadman_plugin):
+    # e.g. one deadman supervising several clusters
+    storage = deadman_plugin('A')._storage
+    callbackA, callbackB = mock.Mock(), mock.Mock()
+    watchA = storage.dcs_watch_state(callbackA, 'a')
+    watchB = storage.dcs_watch_state(callbackB, 'b')
+    assert len(storage._folder_watches) == 1
+    storage.dcs_set_state('a', 'node1', {'name': 'a1'})
+    storage.dcs_set_state('b', 'node1', {'name': 'b1'})
+    storage.dcs_set_state('c', 'node1', {'name': 'c1'})
+    await asyncio.sleep(0.005)
+    # callbacks get their group and its members, the initial snapshot may be
+    # in the same batch as the change
+    assert callbackA.mock_calls[-1] == mock.call('a', {'node1': {'name': 'a1'}})
+    assert callbackA.mock_calls[:-1] in ([], [mock.call('a', {})])
+    assert callbackB.mock_calls[-1] == mock.call('b', {'node1': {'name': 'b1'}})
+    calls = len(callbackA.mock_calls)
+    assert watchA.fresh and watchB.fresh
+    assert watchA.snapshot() == {'a-node1': {'name': 'a1'}}
+    assert watchB.snapshot() == {'b-node1': {'name': 'b1'}}
+    # other groups are not watched at all
+    assert 'c-node1' not in storage._folder_watches['state']
+    # an unwatched group gets no more callbacks
+    storage.dcs_unwatch('a')
+    storage.dcs_set_state('a', 'node1', {'name': 'a2'})
+    await asyncio.sleep(0.005)
+    assert len(callbackA.mock_calls) == calls
+    assert watchA.snapshot() == {'a-node1': {'name': 'a2'}}
+
+@pytest.mark.asyncio
+async def test_list_tolerates_nodes_deleted_while_reading(deadman_plugin):
+    pluginA, pluginB = deadman_plugin('A'), deadman_plugin('B')
+    pluginA.dcs_set_state(dict(name='A'))
+    pluginB.dcs_set_state(dict(name='B'))
+    storage = pluginA._storage
+    zk = storage.connection
+    get_async = zk.get_async
+    requests = []
+    def delete_B_after_first_request(path, *args, **kw):
+        # all the gets are sent before the first answer is waited for
+        requests.append(path)
+        if len(requests) == 1:
+            storage.dcs_delete_state('mygroup', 'B')
+        return get_async(path, *args, **kw)
+    with mock.patch.object(zk, 'get_async', side_effect=delete_B_after_first_request):
+        listing = storage.dcs_list_state('mygroup')
+    assert sorted(requests) == ['/mypath/state/mygroup-A', '/mypath/state/mygroup-B']
+    assert listing == [('A', {'name': 'A'})]
+
+def test_group_index():
+    from ..zookeeper import GroupIndex, DictWatch
+    index = GroupIndex()
+    assert index.update('a-node1', 1) == 'a'
+    index.update('a-node-2', 2)
+    index.update('b-node1', 3)
+    a = index.group('a')
+    assert a == {'node1': 1, 'node-2': 2}
+    assert index.groups() == {'a': a, 'b': {'node1': 3}}
+    # changing one group leaves the members of others as they were
+    index.update('b-node1', 4)
+    assert index.group('a') is a
+    with pytest.raises(TypeError):
+        a['node1'] = 5
+    index.update('b-node1', DictWatch.MISSING)
+    assert index.groups() == {'a': a}
+    assert index.group('b') == {}
+
+@pytest.mark.asyncio
+async def test_watch_locks(deadman_plugin):
+    pluginA = deadman_plugin('A')
+    storage = pluginA._storage
+    callback = mock.Mock()
+    storage.dcs_watch_locks('master', callback)
+    storage.dcs_lock('g1', 'master', 'A')
+    storage.dcs_lock('g1', 'other', 'A')
+    storage.dcs_lock('g2', 'master', 'B')
+    await asyncio.sleep(0.005)
+    # at most one call per batch, other locks do not call back
+    assert 1 <= len(callback.mock_calls) <= 3
+    assert callback.mock_calls[-1] == mock.call({'g1': 'A', 'g2': 'B'})
+    storage.dcs_unlock('g1', 'master', 'A')
+    await asyncio.sleep(0.005)
+    assert callback.mock_calls[-1] == mock.call({'g2': 'B'})
+
+@pytest.mark.asyncio
+async def test_initial_snapshot_is_one_callback(deadman_plugin):
+    storage = deadman_plugin('A')._storage
+    for i in range(20):
+        storage.dcs_set_state('a', 'node{}'.format(i), {'i': i})
+    storage.dcs_set_state('b', 'node1', {'i': 1})
+    everything, group_a = mock.Mock(), mock.Mock()
+    storage.dcs_watch_state(everything)
+    storage.dcs_watch_state(group_a, 'a')
+    await asyncio.sleep(0.01)
+    members = dict(('node{}'.format(i), {'i': i}) for i in range(20))
+    # one callback with the full picture, not one per node
+    assert everything.mock_calls == [mock.call({'a': members, 'b': {'node1': {'i': 1}}})]
+    assert group_a.mock_calls == [mock.call('a', members)]
+    # then changes are reported one by one
+    storage.dcs_set_state('a', 'node1', {'i': 100})
+    await asyncio.sleep(0.01)
+    assert len(everything.mock_calls) == 2
+    assert group_a.mock_calls[-1][1][1]['node1'] == {'i': 100}
+    # a group added later gets its own snapshot, the others are not called again
+    group_b = mock.Mock()
+    storage.dcs_watch_state(group_b, 'b')
+    await asyncio.sleep(0.01)
+    assert group_b.mock_calls == [mock.call('b', {'node1': {'i': 1}})]
+    assert len(group_a.mock_calls) == 2
+
+@pytest.mark.asyncio
+async def test_dict_watch_coalesces_events():
+    from ..zookeeper import DictWatch
+    zk = mock.Mock()
+    watchers = {}
+    zk.ChildrenWatch.side_effect = lambda path, func: watchers.setdefault(None, func)
+    zk.DataWatch.side_effect = lambda path, func: watchers.setdefault(path.rsplit('/', 1)[1], func)
+    callback, flush = mock.Mock(), mock.Mock()
+    loop = asyncio.get_event_loop()
+    with mock.patch.object(loop, 'call_soon_threadsafe', wraps=loop.call_soon_threadsafe) as wakeups:
+        watch = DictWatch(zk, '/path', callback, window=0.05, flush=flush)
+        await loop.run_in_executor(None, watchers[None], ['a', 'b'])
+        await asyncio.sleep(0.1)
+        def kazoo_thread():
+            watchers['a'](b'1', None, None)
+            watchers['b'](b'1', None, None)
+            for i in range(2, 10):
+                watchers['a'](str(i).encode('ascii'), None, None)
+            watchers['b'](b'2', None, None)
+            watchers['b'](b'1', None, None)
+        await loop.run_in_executor(None, kazoo_thread)
+        assert not callback.called # still in the window
+        await asyncio.sleep(0.1)
+    # one wakeup of the loop for the listing, one for the burst of data
+    assert wakeups.mock_calls.count(mock.call(watch._wakeup)) == 2
+    # the snapshot is reported, then only the latest change of each key
+    assert callback.mock_calls == [
+            mock.call(watch, None, DictWatch.MISSING, DictWatch.MISSING),
+            mock.call(watch, 'a', 1, 9),
+            ]
+    assert flush.mock_calls == [mock.call(watch)]
+    assert dict(watch) == {'a': 9, 'b': 1}
+    # nothing changed, nothing is flushed
+    watchers['b'](b'1', None, None)
+    await asyncio.sleep(0.1)
+    assert len(flush.mock_calls) == 1
+
+@pytest.mark.asyncio
+async def test_storage_tracks_the_last_zxid(deadman_plugin):
+    storage = deadman_plugin('A')._storage
+    assert storage.last_zxid == 0
+    storage.dcs_watch_state(mock.Mock(), 'g1')
+    storage.dcs_set_state('g1', 'A', {'name': 'A'})
+    await asyncio.sleep(0.05)
+    first = storage.last_zxid
+    storage.dcs_set_state('g1', 'A', {'name': 'B'})
+    await asyncio.sleep(0.05)
+    assert storage.last_zxid > first
+
+@pytest.mark.asyncio
+async def test_lock_changes_are_not_coalesced(deadman_plugin):
+    storage = deadman_plugin('A')._storage
+    storage._event_window = 10
+    state, lock = mock.Mock(), mock.Mock()
+    storage.dcs_watch_state(state, 'g1')
+    storage.dcs_watch_lock('master', 'g1', lock)
+    storage.dcs_set_state('g1', 'A', {'name': 'A'})
+    storage.dcs_lock('g1', 'master', 'A')
+    await asyncio.sleep(0.01)
+    assert lock.mock_calls[-1] == mock.call('A')
+    assert not state.called
+
+@pytest.mark.asyncio
+async def test_dict_watch_without_coalescing():
+    from ..zookeeper import DictWatch
+    zk = mock.Mock()
+    watchers = {}
+    zk.ChildrenWatch.side_effect = lambda path, func: watchers.setdefault(None, func)
+    zk.DataWatch.side_effect = lambda path, func: watchers.setdefault(path.rsplit('/', 1)[1], func)
+    changes = []
+    callback = lambda watch, key, from_val, to_val: changes.append((key, from_val, to_val))
+    flush = lambda watch: changes.append(dict(watch))
+    loop = asyncio.get_event_loop()
+    watch = DictWatch(zk, '/path', callback, flush=flush, coalesce=False)
+    await loop.run_in_executor(None, watchers[None], ['a'])
+    await loop.run_in_executor(None, watchers['a'], b'1', None, None)
+    await asyncio.sleep(0.01)
+    del changes[:]
+    def kazoo_thread():
+        # e.g. a lock is released and taken again before the loop wakes up
+        watchers['a'](None, None, None)
+        watchers['a'](b'2', None, None)
+    await loop.run_in_executor(None, kazoo_thread)
+    await asyncio.sleep(0.01)
+    M = DictWatch.MISSING
+    assert changes == [('a', 1, M), {}, ('a', M, 2), {'a': 2}]
+
+@pytest.mark.asyncio
+async def test_locks_report_every_change(deadman_plugin):
+    storage = deadman_plugin('A')._storage
+    masters = mock.Mock()
+    storage.dcs_watch_locks('master', masters)
+    storage.dcs_lock('g1', 'master', 'A')
+    await asyncio.sleep(0.01)
+    masters.reset_mock()
+    # both changes are queued (by the kazoo thread) before the loop wakes up
+    storage.dcs_unlock('g1', 'master', 'A')
+    time.sleep(0.05)
+    storage.dcs_lock('g1', 'master', 'B')
+    time.sleep(0.05)
+    await asyncio.sleep(0.01)
+    # the release is not lost
+    assert masters.mock_calls == [mock.call({}), mock.call({'g1': 'B'})]
+
+@pytest.mark.asyncio
+async def test_mixed_encodings(deadman_plugin):
+    # e.g. during a rolling upgrade, only some nodes write a new encoding
+    from ..codec import Codec, MAGIC
+    pluginA, pluginB = deadman_plugin('A'), deadman_plugin('B')
+    pluginA._storage._codec = Codec(compress_above=0)
+    pluginA.dcs_set_state(dict(name='A'))
+    pluginB.dcs_set_state(dict(name='B'))
+    data, stat = pluginA._storage.connection.get('/mypath/state/mygroup-A')
+    assert data.startswith(MAGIC)
+    state = mock.Mock()
+    pluginB.dcs_watch(None, state, None)
+    await asyncio.sleep(0.005)
+    expected = {'A': {'name': 'A'}, 'B': {'name': 'B'}}
+    assert state.mock_calls[-1] == mock.call(expected)
+    assert sorted(pluginB._storage.dcs_list_state('mygroup')) == sorted(expected.items())
+
+@pytest.mark.asyncio
+async def test_takeovers_are_transactions(deadman_plugin):
+    # e.g. we restarted and our old session has not expired yet
+    old, new = deadman_plugin('A')._storage, deadman_plugin('A')._storage
+    old.dcs_set_state('g1', 'A', {'server': 41})
+    assert old.dcs_lock('g1', 'master', 'A') == 'locked'
+    zk = new.connection
+    session = zk.client_id[0]
+    with mock.patch.object(zk, 'delete') as delete, \
+            mock.patch.object(zk, 'transaction', wraps=zk.transaction) as transaction:
+        assert new.dcs_set_state('g1', 'A', {'server': 42}) == 'takeover'
+        assert new.dcs_lock('g1', 'master', 'A') == 'broken'
+    # the old nodes are replaced, never just deleted
+    assert not delete.called
+    assert len(transaction.mock_calls) == 2
+    data, stat = zk.get('/mypath/state/g1-A')
+    assert (json.loads(data.decode('ascii')), stat.owner_session_id) == ({'server': 42}, session)
+    data, stat = zk.get('/mypath/lock/g1-master')
+    assert (data, stat.owner_session_id) == (b'A', session)
+    # our own nodes are just written
+    assert new.dcs_set_state('g1', 'A', {'server': 43}) == 'existing'
+    assert new.dcs_lock('g1', 'master', 'A') == 'owned'
+
+@pytest.mark.asyncio
+async def test_publish_promotion(deadman_plugin):
+    pluginA, pluginB = deadman_plugin('A'), deadman_plugin('B')
+    pluginA.dcs_set_timeline(1)
+    pluginA.dcs_set_state({'replication_role': 'taking-over'})
+    # only the holder of the master lock can publish
+    assert pluginA.dcs_lock('master')
+    assert pluginB.dcs_publish_promotion(2, {'replication_role': 'master'}) is False
+    assert pluginA.dcs_get_timeline() == 1
+    assert pluginB.dcs_list_state() == [('A', {'replication_role': 'taking-over'})]
+    assert pluginA.dcs_publish_promotion(2, {'replication_role': 'master'}) is True
+    assert pluginB.dcs_get_timeline() == 2
+    assert pluginB.dcs_list_state() == [('A', {'replication_role': 'master'})]
+    with pytest.raises(ValueError):
+        pluginA.dcs_publish_promotion(1, {'replication_role': 'master'})
+    # our state node does not need to exist yet
+    pluginA.dcs_delete_conn_info()
+    pluginA._storage.dcs_delete_state('mygroup', 'A')
+    assert pluginA.dcs_publish_promotion(3, {'replication_role': 'master'}) is True
+    assert pluginB.dcs_list_state() == [('A', {'replication_role': 'master'})]
+
+def test_session_registry():
+    registry = SessionRegistry()
+    with mock.patch('zgres.zookeeper.KazooClient', side_effect=lambda **kw: MyFakeClient()) as KazooClient:
+        a = registry.acquire('zk:2181', 10)
+        b = registry.acquire('zk:2181', 10)
+        other = registry.acquire('zk:2181', 20)
+    assert a is b and a is not other
+    assert KazooClient.mock_calls == [
+            mock.call(hosts='zk:2181', timeout=10, read_only=False),
+            mock.call(hosts='zk:2181', timeout=20, read_only=False)]
+    assert a.client.connected
+    # listeners are called by one kazoo listener
+    called = threading.Event()
+    listenerA, listenerB = mock.Mock(), mock.Mock(side_effect=lambda state: called.set())
+    a.listeners.append(listenerA)
+    b.listeners.append(listenerB)
+    a.client._fire_state_change(KazooState.SUSPENDED)
+    assert called.wait(5)
+    listenerA.assert_called_once_with(KazooState.SUSPENDED)
+    listenerB.assert_called_once_with(KazooState.SUSPENDED)
+    # the last user closes the session
+    assert not registry.release(a)
+    assert a.client.connected
+    assert registry.release(b)
+    assert not a.client.connected
+    assert other.client.connected
+
+@pytest.mark.asyncio
+async def test_plugins_share_a_session(deadman_plugin):
+    # e.g. zgres-sync and a deadman, or several deadman clusters in one process
+    sessions = SessionRegistry()
+    pluginA = deadman_plugin('A', group='a', sessions=sessions)
+    pluginB = deadman_plugin('B', group='b', sessions=sessions)
+    assert pluginA._storage is not pluginB._storage
+    assert pluginA._storage.connection is pluginB._storage.connection
+    stateA, stateB = mock.Mock(), mock.Mock()
+    pluginA.dcs_watch(None, stateA, None)
+    pluginB.dcs_watch(None, stateB, None)
+    pluginA.dcs_set_state({'name': 'A'})
+    pluginB.dcs_set_state({'name': 'B'})
+    await asyncio.sleep(0.005)
+    pluginA.dcs_disconnect()
+    # the session is still open, so we removed our nodes ourselves
+    zk = pluginB._storage.connection
+    assert zk.connected
+    assert not zk.exists('/mypath/state/a-A')
+    # nor are we called any more
+    stateA.reset_mock()
+    zk.set('/mypath/state/b-B', b'{"name": "B2"}')
+    zk.create('/mypath/state/a-C', b'{"name": "C"}')
+    await asyncio.sleep(0.005)
+    assert not stateA.called
+    assert stateB.mock_calls[-1] == mock.call({'B': {'name': 'B2'}})
+    # the last plugin closes the session
+    pluginB.dcs_disconnect()
+    assert not zk.connected
+
+class ReadOnlyFakeClient(MyFakeClient):
+    """Connected to a read-only server (e.g. an observer without a quorum)"""
+
+    def ensure_path(self, path):
+        raise kazoo.exceptions.NotReadOnlyCallError()
+
+@pytest.mark.asyncio
+async def test_sync_reads_from_observers(deadman_plugin):
+    from ..zookeeper import ZooKeeperSource
+    deadman = deadman_plugin('A')
+    deadman.dcs_set_state({'name': 'A'})
+    app = mock.Mock()
+    app.config = {'zookeeper': {
+        'connection_string': 'zk1:2181,zk2:2181',
+        'observers': 'observer1:2181,observer2:2181',
+        'path': '/mypath'}}
+    source = ZooKeeperSource('zgres#zookeeper', app)
+    source.logger = mock.Mock()
+    zk = ReadOnlyFakeClient(storage=deadman._storage.connection.storage)
+    state = mock.Mock()
+    with mock.patch('zgres.zookeeper.KazooClient', return_value=zk) as KazooClient, \
+            mock.patch('zgres.zookeeper.sessions', SessionRegistry()):
+        source.start_watching(state, None, None, None)
+    KazooClient.assert_called_once_with(hosts='observer1:2181,observer2:2181', timeout=10.0, read_only=True)
+    await asyncio.sleep(0.005)
+    assert state.mock_calls[-1] == mock.call({'mygroup': {'A': {'name': 'A'}}})
+    # a folder which does not exist yet cannot be created, we wait for it
+    assert not zk.exists('/mypath/stats')
+    stats = mock.Mock()
+    source._storage.dcs_watch_stats(stats)
+    await asyncio.sleep(0.005)
+    assert not stats.called
+    deadman.dcs_set_stats({'replay_lag': 1})
+    await asyncio.sleep(0.005)
+    assert stats.mock_calls[-1] == mock.call({'mygroup': {'A': {'replay_lag': 1}}})
+    deadman.dcs_set_stats({'replay_lag': 2})
+    await asyncio.sleep(0.005)
+    assert stats.mock_calls[-1] == mock.call({'mygroup': {'A': {'replay_lag': 2}}})
+    # a normal connection is not worth a warning, a read-only one is
+    with mock.patch.object(zk, 'client_state', KeeperState.CONNECTED, create=True):
+        source._session_state_handler(KazooState.CONNECTED)
+    assert not source.logger.warn.called
+    with mock.patch.object(zk, 'client_state', KeeperState.CONNECTED_RO, create=True):
+        source._session_state_handler(KazooState.CONNECTED)
+    assert source.logger.warn.called
@@ -0,0 +1,125 @@
+"""Trace the phases of a failover.
+
+Each failover gets an id. Phases are recorded with monotonic timestamps
+relative to the start of the failover and a duration, so slow failovers can be
+broken down by phase. Records are kept in memory (the last trace_keep) and
+optionally appended to a JSON-lines file. The file is written by a background
+thread, so tracing does not add disk latency to the failover it measures.
+
+Configured in the [deadman] section:
+
+    trace_file = /var/lib/zgres/failover-trace.jsonl
+    trace_keep = 1000
+
+Example record:
+
+    {"failover": "5f0c...", "node": "10.0.0.9", "phase": "recovery_exit",
+     "start": 1.253, "duration": 0.812, "time": 1466163521.32}
+"""
+import json
+import time
+import uuid
+import queue
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+_logger = logging.getLogger('zgres')
+
+class FailoverTracer:
+
+    failover = None
+    node = None
+    _started = None
+    _writer = None
+
+    def __init__(self, config, clock=time.monotonic):
+        self._path = config.get('trace_file', None)
+        self._clock = clock
+        self.records = deque(maxlen=int(config.get('trace_keep', 1000)))
+        self._lines = queue.Queue()
+
+    @property
+    def active(self):
+        return self.failover is not None
+
+    def start(self, phase, **data):
+        """Record a phase, starting to trace a new failover if needed"""
+        if not self.active:
+            self.failover = uuid.uuid4().hex
+            self._started = self._clock()
+        self.phase(phase, **data)
+
+    def finish(self, phase, **data):
+        """Record the last phase of a failover"""
+        if not self.active:
+            return
+        self.phase(phase, **data)
+        self.failover = None
+        self._started = None
+
+    def phase(self, phase, **data):
+        """Record that a phase was reached"""
+        if not self.active:
+            return
+        self._record(phase, self._clock(), 0, data)
+
+    @contextmanager
+    def span(self, phase, **data):
+        """Record how long the body takes.
+
+        Yields a dict which can be updated to add data to the record.
+        """
+        start = self._clock()
+        try:
+            yield data
+        except BaseException as e:
+            data['error'] = repr(e)
+            raise
+        finally:
+            if self.active:
+                self._record(phase, start, self._clock() - start, data)
+
+    def _record(self, phase, start, duration, data):
+        record = dict(data,
+                failover=self.failover,
+                node=self.node,
+                phase=phase,
+                start=round(start - self._started, 6),
+                duration=round(duration, 6),
+                time=time.time())
+        self.records.append(record)
+        _logger.info('failover {} phase {} took {:.3f}s ({:.3f}s since start)'.format(
+            self.failover, phase, duration, record['start'] + duration))
+        if self._path is not None:
+            try:
+                line = json.dumps(record, sort_keys=True) + '\n'
+            except (TypeError, ValueError) as e:
+                _logger.warn('Could not serialize failover trace record: {}'.format(e))
+                return
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._write, name='zgres-trace', daemon=True)
+                self._writer.start()
+            self._lines.put(line)
+
+    def flush(self):
+        """Wait till the records are written to trace_file"""
+        self._lines.join()
+
+    def _write(self):
+        # runs in the writer thread, appends the queued lines in batches
+        while True:
+            lines = [self._lines.get()]
+            while True:
+                try:
+                    lines.append(self._lines.get(block=False))
+                except queue.Empty:
+                    break
+            try:
+                with open(self._path, 'a') as f:
+                    f.write(''.join(lines))
+            except OSError as e:
+                _logger.warn('Could not write failover trace to {}: {}'.format(self._path, e))
+            for i in lines:
+                self._lines.task_done()
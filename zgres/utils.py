@@ -9,6 +9,51 @@ def pg_lsn_to_int(pos):
     logfile, offset = pos.split('/')
     return 0xFF000000 * int(logfile, 16) + int(offset, 16)
 
+class FrozenDict(dict):
+    """A dict which cannot be changed.
+
+    Used for state which is shared by reference (e.g. with plugins or other
+    threads) instead of being copied. Use replace() to get a changed copy.
+    """
+
+    __slots__ = ()
+
+    def _immutable(self, *args, **kw):
+        raise TypeError('FrozenDict is immutable')
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = __ior__ = _immutable
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        return (FrozenDict, (dict(self), ))
+
+    def replace(self, **kw):
+        """A copy with some keys changed"""
+        new = dict(self)
+        for k, v in kw.items():
+            new[k] = freeze(v)
+        return FrozenDict(new)
+
+def freeze(value):
+    """Return an immutable equivalent of a JSON-like value.
+
+    Other objects are returned as-is and must not be changed afterwards.
+    """
+    if isinstance(value, FrozenDict):
+        return value
+    if isinstance(value, dict):
+        return FrozenDict((k, freeze(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(v) for v in value)
+    if isinstance(value, set):
+        return frozenset(value)
+    return value
+
 def exception_handler(loop, context):
     loop.default_exception_handler(context)
     logging.error('Unexpected exception, exiting...')
@@ -1,18 +1,28 @@
 import json
+import time
 import asyncio
 from asyncio import sleep
 import queue
 import logging
+import threading
 from functools import partial
 from collections.abc import Mapping
 
 import kazoo.exceptions
 from kazoo.client import KazooClient, KazooState, KazooRetry
+from kazoo.protocol.states import KeeperState
 
 from .plugin import subscribe
+from .utils import FrozenDict
+from .codec import Codec, decode
+from . import metrics
 
 _missing = object()
 
+def _sleep(seconds):
+    # time.sleep is looked up on every call, so simulations can replace it
+    time.sleep(seconds)
+
 def state_to_databases(state, get_state):
     """Convert the state to a dict of connectable database clusters.
 
@@ -87,28 +97,80 @@ class DictWatch(Mapping):
     The callack WILL be called in the main thread and the order of events from
     zookeeper will be maintained.
 
+    Events are delivered in batches: the loop is woken once for all the events
+    which arrived until it got round to them. With a window (in seconds), it
+    waits that long after the first event so a burst of changes is delivered
+    together. Within a batch the changes to one key are collapsed, the callback
+    is called once with the value from before the batch and the latest value
+    (not at all if the key ended up unchanged). After the callbacks of a batch
+    flush is called with the mapping, so aggregating callers can act once per
+    batch. With coalesce=False, every change is reported (and flushed) on its
+    own instead, in the order they happened.
+
     On add from_value is DictWatch.MISSING, on delete, to value will be
     DictWatch.MISSING.
 
+    The initial contents are not reported child by child. Once the first
+    children listing and their data have arrived, the callback is called once
+    with key None (and both values DictWatch.MISSING), the mapping then holds
+    the initial snapshot. Only changes after that are reported per key. The
+    same is done for the children matched by a prefix added with add_prefix.
+
     The implementation of this is that kazoo-fired events will be put on a
     threadsafe queue and will be processed later (in order) in the asyncio main
     thread.
+
+    The mapping can be used as a cache of the path. It is `loaded` once the
+    first children listing and the data of all those children have arrived.
+    `fresh` additionally requires the ZooKeeper connection to be up, i.e.
+    changes will still be reported. `updated` is the event loop time at which
+    the last event was processed, `zxid` the newest modification (mzxid) of a
+    child we have seen.
+
+    If prefix is given, only children starting with it are watched. More
+    prefixes can be watched later with add_prefix.
+
+    If a GroupIndex is given as index, it is updated before the callback is
+    called.
+
+    With wait_for_path, the path need not exist yet (e.g. it cannot be created
+    on a read-only server), we start watching it once it is created.
     """
 
     MISSING = object()
+    updated = None
+    zxid = 0
+    _children = None
+    _stopped = False
 
-    def __init__(self, zk, path, callback, prefix=None, deserializer=None):
+    def __init__(self, zk, path, callback, prefix=None, deserializer=None, index=None, window=0, flush=None,
+            wait_for_path=False, coalesce=True):
         self._zk = zk
         self._callback = callback
+        self._flush = flush
+        self._window = window
+        self._coalesce = coalesce
+        self.index = index
         self._state = {}
+        self._pending = set()
+        self._changes = {}
+        self._reported = False
+        self._wakeup_lock = threading.Lock()
+        self._wakeup_pending = False
         if not path.endswith('/'):
             path += '/'
         self._path = path
         self._child_watchers = {}
         self._loop = asyncio.get_event_loop()
         self._zk_event_queue = queue.Queue()
-        self._prefix = prefix
-        self._watch()
+        self._prefixes = None
+        if prefix is not None:
+            self._prefixes = {prefix}
+        if wait_for_path:
+            # ChildrenWatch stops for good if the path does not exist
+            self._path_watcher = self._zk.DataWatch(path[:-1], self._path_changed)
+        else:
+            self._watch()
         if deserializer is not None:
             self._deserialize = deserializer
 
@@ -117,6 +179,15 @@ class DictWatch(Mapping):
         watch = partial(self._queue_event, '_children_changed')
         self._child_watcher = self._zk.ChildrenWatch(self._path, watch)
 
+    def _path_changed(self, data, stat):
+        # Note: this runs in the kazoo thread
+        if self._stopped:
+            return False
+        if stat is None:
+            return # not created yet
+        self._watch()
+        return False # we only wait for it to be created
+
     def __getitem__(self, key):
         return self._state[key]
 
@@ -126,23 +197,90 @@ class DictWatch(Mapping):
     def __len__(self):
         return len(self._state)
 
+    @property
+    def loaded(self):
+        return self._children is not None and not self._pending
+
+    @property
+    def fresh(self):
+        return self.loaded and self._zk.connected
+
+    def add_prefix(self, prefix):
+        """Also watch children starting with prefix.
+
+        We are not loaded again till the data of the newly watched children
+        has arrived, then the callback is called with the initial snapshot.
+        """
+        if self._prefixes is None:
+            return
+        self._prefixes.add(prefix)
+        if self._children is not None:
+            self._add_children(self._children, initial=True)
+
+    def snapshot(self):
+        """A copy of the current contents, safe to call from any thread"""
+        return dict(self._state)
+
+    def stop(self):
+        """Stop watching, kazoo drops our watches when they next fire"""
+        self._stopped = True
+
     def _deserialize(self, data):
-        data = data.decode('ascii')
-        return json.loads(data)
+        return decode(data)
 
     def _queue_event(self, event_name, *args, **kw):
         # Note: this runs in the kazoo thread, hence we use
         # a threadsafe queue
+        if self._stopped:
+            return False # stop watching
         self._zk_event_queue.put((event_name, args, kw))
-        self._loop.call_soon_threadsafe(self._consume_queue)
+        with self._wakeup_lock:
+            if self._wakeup_pending:
+                return # the loop has been woken for this batch already
+            self._wakeup_pending = True
+        self._loop.call_soon_threadsafe(self._wakeup)
+
+    def _wakeup(self):
+        if self._window:
+            self._loop.call_later(self._window, self._consume_queue)
+        else:
+            self._consume_queue()
 
     def _consume_queue(self):
+        with self._wakeup_lock:
+            # events queued from now on need another wakeup
+            self._wakeup_pending = False
+        if self._stopped:
+            return
         while True:
             try:
                 event_name, args, kw = self._zk_event_queue.get(block=False)
             except queue.Empty:
-                return
+                break
+            self.updated = self._loop.time()
             getattr(self, event_name)(*args, **kw)
+        self._deliver_changes()
+        self._flush_reported()
+
+    def _flush_reported(self):
+        if self._reported:
+            self._reported = False
+            if self._flush is not None:
+                self._flush(self)
+
+    def _report(self, key, from_val, to_val):
+        self._reported = True
+        if self._callback is not None:
+            self._callback(self, key, from_val, to_val)
+        if not self._coalesce:
+            self._flush_reported()
+
+    def _deliver_changes(self):
+        changes, self._changes = self._changes, {}
+        for node, (old_val, new_val) in changes.items():
+            if old_val is self.MISSING and new_val is self.MISSING or old_val == new_val:
+                continue # changed back within the batch
+            self._report(node, old_val, new_val)
 
     def _watch_node(self, node):
         child_path = self._path + node
@@ -151,6 +289,10 @@ class DictWatch(Mapping):
 
     def _node_changed(self, node, data, stat, event):
         """Watch a single node in zookeeper for data changes."""
+        initial = node in self._pending
+        self._pending.discard(node)
+        if stat is not None:
+            self.zxid = max(self.zxid, stat.mzxid)
         old_val = self._state.pop(node, self.MISSING)
         if data is None:
             new_val = self.MISSING
@@ -158,41 +300,166 @@ class DictWatch(Mapping):
         else:
             new_val = self._deserialize(data)
             self._state[node] = new_val
-        if old_val is self.MISSING and new_val is self.MISSING:
-            # we re-deleted an already deleted node
-            return
-        if old_val == new_val:
-            # no change
+        # either we re-deleted an already deleted node or there was no change
+        changed = not (old_val is self.MISSING and new_val is self.MISSING) and old_val != new_val
+        if changed and self.index is not None:
+            self.index.update(node, new_val)
+        if initial:
+            if not self._pending:
+                self._initial_snapshot()
             return
-        self._callback(self, node, old_val, new_val)
+        if changed and not self._coalesce:
+            self._report(node, old_val, new_val)
+        elif changed:
+            if node in self._changes:
+                old_val = self._changes[node][0]
+            self._changes[node] = (old_val, new_val)
+
+    def _initial_snapshot(self):
+        # changes queued before the snapshot are reported before it
+        self._deliver_changes()
+        self._report(None, self.MISSING, self.MISSING)
 
     def _children_changed(self, children):
+        # the first listing, we are loaded once all these nodes have reported
+        initial = self._children is None
+        self._children = children
+        self._add_children(children, initial)
+
+    def _add_children(self, children, initial):
         to_add = set(children) - set(self._child_watchers)
+        if self._prefixes is not None:
+            prefixes = tuple(self._prefixes)
+            to_add = set(node for node in to_add if node.startswith(prefixes))
+        if initial:
+            self._pending.update(to_add)
         for node in to_add:
-            if self._prefix is not None:
-                if not node.startswith(self._prefix):
-                    continue
             self._child_watchers[node] = self._watch_node(node)
+        if initial and not self._pending:
+            # nothing to wait for, queued to keep the order of events
+            self._queue_event('_initial_snapshot')
+
+_no_members = FrozenDict()
+
+class GroupIndex:
+    """The children of a watched folder by group.
+
+    Children are named "{group}-{member}". Every change replaces the members
+    (a FrozenDict) of one group, so an update costs the size of that group, not
+    of the whole folder. The members can be shared by reference and read from
+    any thread.
+    """
+
+    def __init__(self):
+        self._groups = {}
+
+    def update(self, key, value):
+        """Set (or remove if value is DictWatch.MISSING) key, returns its group"""
+        group, member = key.split('-', 1)
+        members = dict(self._groups.get(group, _no_members))
+        if value is DictWatch.MISSING:
+            members.pop(member, None)
+        else:
+            members[member] = value
+        if members:
+            self._groups[group] = FrozenDict(members)
+        else:
+            self._groups.pop(group, None)
+        return group
+
+    def group(self, group):
+        return self._groups.get(group, _no_members)
+
+    def groups(self):
+        """All groups: {group: {member: value}}"""
+        return FrozenDict(self._groups)
+
+class _Session:
+
+    def __init__(self, key, client):
+        self.key = key
+        self.client = client
+        self.users = 0
+        self.listeners = []
+        client.add_listener(self._state_changed)
+
+    def _state_changed(self, state):
+        for listener in list(self.listeners):
+            listener(state)
+
+class SessionRegistry:
+    """The ZooKeeper sessions of a process.
+
+    Everyone connecting with the same connection string, timeout and read_only
+    flag shares one KazooClient, i.e. one session, one connection and one
+    kazoo thread. It is
+    started by the first acquire() and stopped when the last user release()s
+    it. Connection state listeners are added to the session rather than the
+    client, they are all called by one kazoo listener.
+    """
 
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sessions = {}
+
+    def acquire(self, connection_string, timeout, read_only=False):
+        key = (connection_string, timeout, read_only)
+        with self._lock:
+            session = self._sessions.get(key)
+            if session is None:
+                client = KazooClient(hosts=connection_string, timeout=timeout, read_only=read_only)
+                client.start()
+                session = self._sessions[key] = _Session(key, client)
+            session.users += 1
+            return session
+
+    def release(self, session):
+        """Stop using a session, returns True if it was closed"""
+        with self._lock:
+            session.users -= 1
+            if session.users:
+                return False
+            del self._sessions[session.key]
+        session.client.stop()
+        return True
+
+sessions = SessionRegistry()
 
 class ZooKeeperSource:
+    """zgres-sync source plugin using ZooKeeper.
+
+    zgres-sync only reads, so it can connect to ZooKeeper observers instead of
+    the quorum by setting observers in the [zookeeper] section (a connection
+    string like connection_string). It then connects in read-only mode: if
+    only read-only servers can be reached (e.g. the observers lost the
+    quorum), it carries on with the last known state and receives changes
+    again once they reconnect. read_only can also be set on its own, to use
+    read-only mode with connection_string.
+    """
 
     _old_connection_info = None
 
     def __init__(self, name, app):
         self.app = app
+        self.logger = logging
         self._path_prefix = self.app.config['zookeeper']['path'].strip()
         if not self._path_prefix.endswith('/'):
             self._path_prefix += '/'
 
     @subscribe
     def start_watching(self, state, conn_info, masters, databases):
+        config = self.app.config['zookeeper']
+        observers = config.get('observers', '').strip()
+        read_only = config.get('read_only', 'true' if observers else 'false').lower().strip() in ('t', 'true')
         self._storage = ZookeeperStorage(
-                self.app.config['zookeeper']['connection_string'],
-                self.app.config['zookeeper']['path'].strip(),
-                timeout=float(self.app.config['zookeeper'].get('timeout', '10').strip()),
+                observers or config['connection_string'],
+                config['path'].strip(),
+                timeout=float(config.get('timeout', '10').strip()),
+                event_window=float(config.get('event_window', '0').strip()),
+                read_only=read_only,
                 )
         self._storage.dcs_connect()
+        self._storage.add_listener(self._session_state_handler)
         if state is not None:
             self._storage.dcs_watch_state(state)
         if conn_info is not None:
@@ -206,16 +473,36 @@ class ZooKeeperSource:
             self._storage.dcs_watch_database_identifiers(partial(self._notify_databases, databases))
 
     def _notify_databases(self, callback, state):
-        callback(list(state.keys()))
+        callback(sorted(state))
+
+    @subscribe
+    def snapshot_version(self):
+        return self._storage.last_zxid
 
-def _get_clusters(in_dict):
-    out_dict = {}
-    for k, v in in_dict.items():
-        group_name, cluster_id = k.split('-', 1)
-        out_dict.setdefault(group_name, {})[cluster_id] = v
-    return out_dict
+    def _session_state_handler(self, state):
+        if state == KazooState.CONNECTED:
+            if self._storage.connection.client_state == KeeperState.CONNECTED_RO:
+                self.logger.warn('connected to a read-only zookeeper server, the state may be out of date')
+        elif state == KazooState.LOST:
+            self.logger.warn('zookeeper session lost, the state may be out of date till we reconnect')
+        else:
+            self.logger.info('zookeeper connection state: {}'.format(state))
+
+_list_methods = {
+        'state': 'dcs_list_state',
+        'conn': 'dcs_list_conn_info',
+        'stats': 'dcs_list_stats',
+        }
 
 class ZooKeeperDeadmanPlugin:
+    """Deadman DCS plugin using ZooKeeper.
+
+    Once dcs_watch has been called, dcs_list_state and dcs_list_conn_info are
+    answered from the watches on our group instead of reading every znode in
+    ZooKeeper. Our own writes are applied to those answers immediately. While
+    a watch is not fresh (still loading or disconnected), we read from
+    ZooKeeper directly.
+    """
 
     _dcs_state = None
 
@@ -225,36 +512,61 @@ class ZooKeeperDeadmanPlugin:
         self.tick_time = app.tick_time # seconds: this should match the zookeeper server tick time (normally specified in milliseconds)
         self.logger = logging
         self._takeovers = {}
+        self._watches = {}
+        self._own_info = {}
         self._kazoo_retry = KazooRetry(
                 max_tries=10,
                 deadline=60,
                 ignore_expire=False,
+                sleep_func=_sleep,
                 )
 
     def _retry(self, method, *args, **kw):
         cmd = getattr(self._storage, method)
+        start = time.monotonic()
+        failed = True
         try:
-            return self._kazoo_retry(cmd, *args, **kw)
+            # called from several threads, every call gets its own retry state
+            result = self._kazoo_retry.copy()(cmd, *args, **kw)
+            failed = False
+            return result
         except kazoo.exceptions.SessionExpiredError:
             # the session has expired, we are going to restart anyway when the LOST state is set
             # however the exceptionhandler waits some time before restarting
             #
-            # we want to restart immediately so call restart(0) first
-            loop = asyncio.get_event_loop()
-            loop.call_soon(self.app.restart, 0)
+            # we want to restart immediately so call restart(0) first. We may
+            # be in a worker thread, so we use the loop we were initialized in
+            self._loop.call_soon_threadsafe(self.app.restart, 0)
             raise
+        finally:
+            metrics.observe_zookeeper(method, time.monotonic() - start, failed=failed)
+
+    def _connect(self, connection_string, path, timeout, event_window, encoding, compress_above):
+        storage = ZookeeperStorage(connection_string, path,
+                timeout=timeout,
+                event_window=event_window,
+                codec=Codec(encoding, compress_above=compress_above))
+        storage.dcs_connect()
+        return storage
 
     @subscribe
     def initialize(self):
         self._loop = asyncio.get_event_loop()
-        self._storage = ZookeeperStorage(
-                self.app.config['zookeeper']['connection_string'],
-                self.app.config['zookeeper']['path'].strip(),
-                timeout=float(self.app.config['zookeeper'].get('timeout', '10').strip()),
-                )
-        # we start watching first to get all the state changes
-        self._storage.connection.add_listener(self._session_state_handler)
-        self._storage.dcs_connect()
+        config = self.app.config['zookeeper']
+        compress_above = config.get('compress_above', '').strip()
+        self._storage_key = (
+                'zookeeper',
+                config['connection_string'].strip(),
+                config['path'].strip(),
+                float(config.get('timeout', '10').strip()),
+                float(config.get('event_window', '0').strip()),
+                config.get('encoding', 'json').strip(),
+                int(compress_above) if compress_above else None)
+        # clusters supervised by one deadman share the ZooKeeper session
+        self._storage = self.app.acquire_shared(self._storage_key, partial(self._connect, *self._storage_key[1:]))
+        if self._storage.connection.connected:
+            self._dcs_state = KazooState.CONNECTED
+        self._storage.add_listener(self._session_state_handler)
         self._group_name = self.app.config['zookeeper']['group'].strip()
         if '/' in self._group_name or '-' in self._group_name:
             raise ValueError('cannot have - or / in the group name')
@@ -292,9 +604,9 @@ class ZooKeeperDeadmanPlugin:
     def dcs_get_timeline(self):
         return self._retry('dcs_get_timeline', self._group_name)
 
-    def _only_my_cluster_filter(self, callback):
-        def f(value):
-            callback(value.get(self._group_name, {}))
+    def _only_members(self, callback):
+        def f(group, members):
+            callback(members)
         return f
 
     @subscribe
@@ -302,14 +614,32 @@ class ZooKeeperDeadmanPlugin:
         if master_lock is not None:
             self._storage.dcs_watch_lock('master', self._group_name, master_lock)
         if state is not None:
-            self._storage.dcs_watch_state(
-                    self._only_my_cluster_filter(state),
+            self._watches['state'] = self._storage.dcs_watch_state(
+                    self._only_members(state),
                     self._group_name)
         if conn_info is not None:
-            self._storage.dcs_watch_conn_info(
-                    self._only_my_cluster_filter(conn_info),
+            self._watches['conn'] = self._storage.dcs_watch_conn_info(
+                    self._only_members(conn_info),
                     self._group_name)
 
+    @subscribe
+    def dcs_watch_stats(self, stats):
+        self._watches['stats'] = self._storage.dcs_watch_stats(
+                self._only_members(stats),
+                self._group_name)
+
+    def _list_info(self, type):
+        watch = self._watches.get(type)
+        if watch is None or not watch.fresh:
+            return self._retry(_list_methods[type], group=self._group_name)
+        info = dict(watch.members())
+        own = self._own_info.get(type, _missing)
+        if own is None:
+            info.pop(self.app.my_id, None)
+        elif own is not _missing:
+            info[self.app.my_id] = own
+        return list(info.items())
+
     @subscribe
     def dcs_get_lock_owner(self, name):
         return self._retry('dcs_get_lock_owner', self._group_name, name)
@@ -348,34 +678,101 @@ class ZooKeeperDeadmanPlugin:
     @subscribe
     def dcs_set_conn_info(self, conn_info):
         how = self._retry('dcs_set_conn_info', self._group_name, self.app.my_id, conn_info)
+        self._own_info['conn'] = conn_info
         if how == 'takeover':
             self._log_takeover('conn/{}/{}'.format(self._group_name, self.app.my_id))
 
     @subscribe
     def dcs_set_state(self, state):
         how = self._retry('dcs_set_state', self._group_name, self.app.my_id, state)
+        self._own_info['state'] = state
         if how == 'takeover':
             self._log_takeover('state/{}/{}'.format(self._group_name, self.app.my_id))
 
+    @subscribe
+    def dcs_publish_promotion(self, timeline, state):
+        how = self._retry('dcs_publish_promotion', self._group_name, self.app.my_id, timeline, state)
+        if how == 'lost':
+            return False
+        self._own_info['state'] = state
+        if how == 'takeover':
+            self._log_takeover('state/{}/{}'.format(self._group_name, self.app.my_id))
+        return True
+
+    @subscribe
+    def dcs_set_stats(self, stats):
+        how = self._retry('dcs_set_stats', self._group_name, self.app.my_id, stats)
+        self._own_info['stats'] = stats
+        if how == 'takeover':
+            self._log_takeover('stats/{}/{}'.format(self._group_name, self.app.my_id))
+
     @subscribe
     def dcs_list_conn_info(self):
-        return self._retry('dcs_list_conn_info', group=self._group_name)
+        return self._list_info('conn')
+
+    @subscribe
+    def dcs_list_stats(self):
+        return self._list_info('stats')
 
     @subscribe
     def dcs_list_state(self):
-        return self._retry('dcs_list_state', group=self._group_name)
+        return self._list_info('state')
 
     @subscribe
     def dcs_delete_conn_info(self):
         self._retry('dcs_delete_conn_info',
                 self._group_name,
                 self.app.my_id)
+        self._own_info['conn'] = None
 
     @subscribe
     def dcs_disconnect(self):
-        self._storage.connection.remove_listener(self._session_state_handler)
-        self._storage.dcs_disconnect()
+        self._storage.remove_listener(self._session_state_handler)
+        if self.app.release_shared(self._storage_key):
+            if self._storage.shares_session:
+                # others in this process still use the session
+                self._delete_own_nodes()
+            # closing the session removes our ephemeral nodes
+            self._storage.dcs_disconnect()
+            return
+        # other clusters still use the storage, clean up after ourselves
+        self._storage.dcs_unwatch(self._group_name)
+        self._delete_own_nodes()
 
+    def _delete_own_nodes(self):
+        if self.app.my_id is None:
+            return
+        try:
+            self._storage.dcs_unlock(self._group_name, 'master', self.app.my_id)
+            self._storage.dcs_delete_conn_info(self._group_name, self.app.my_id)
+            self._storage.dcs_delete_state(self._group_name, self.app.my_id)
+            self._storage.dcs_delete_stats(self._group_name, self.app.my_id)
+        except kazoo.exceptions.KazooException as e:
+            self.logger.warn('Could not remove our nodes from zookeeper: {}'.format(e))
+
+
+class _GroupWatch:
+    """The part of a DictWatch shared between groups which belongs to one group"""
+
+    def __init__(self, watch, group):
+        self._watch = watch
+        self._group = group
+        self._prefix = group + '-'
+
+    @property
+    def loaded(self):
+        return self._watch.loaded
+
+    @property
+    def fresh(self):
+        return self._watch.fresh
+
+    def members(self):
+        """{member: value} of the group, safe to call from any thread"""
+        return self._watch.index.group(self._group)
+
+    def snapshot(self):
+        return dict((self._prefix + k, v) for k, v in self.members().items())
 
 class ZookeeperStorage:
     """A low level storage object.
@@ -384,56 +781,176 @@ class ZookeeperStorage:
 
     Manages the database "schema" and allows access to multiple "groups"
     database servers, each representing one logical cluster.
+
+    Several groups can be watched through one storage object (e.g. when one
+    deadman supervises several clusters), they share one watch per folder.
+    Storage objects connecting to the same ZooKeeper share a session (see
+    SessionRegistry).
+
+    Watch callbacks are called at most once per batch of ZooKeeper events (see
+    DictWatch), event_window is the time in seconds a batch collects events.
+    Locks are never batched or collapsed, their callbacks are called on every
+    change ZooKeeper reports, in order.
+
+    State, conn info and stats are encoded with codec (plain JSON by default),
+    values in any encoding are read.
     """
 
     _zk = None
+    _session = None
+    _registry = None
 
-    def __init__(self, connection_string, path, timeout=10.0):
+    def __init__(self, connection_string, path, timeout=10.0, event_window=0, codec=None, read_only=False):
         self._connection_string = connection_string
         self._path_prefix = path
         self._timeout = timeout
+        self.read_only = read_only
+        self._event_window = event_window
+        if codec is None:
+            codec = Codec()
+        self._codec = codec
         if not self._path_prefix.endswith('/'):
             self._path_prefix += '/'
         self._watchers = {}
+        self._folder_watches = {}
+        self._listeners = {}
+        self._introduced = set()
+        self._dirty = {}
+        self._lock_watches = {}
+        self._listeners_added = []
         self._loop = asyncio.get_event_loop()
 
     @property
     def connection(self):
-        if self._zk is None:
-            self._zk = KazooClient(
-                    hosts=self._connection_string,
-                    timeout=self._timeout)
         return self._zk
 
+    @property
+    def last_zxid(self):
+        """The newest modification seen by our watches, 0 if none"""
+        watches = list(self._watchers.values()) + list(self._folder_watches.values())
+        return max([getattr(w, 'zxid', 0) for w in watches], default=0)
+
+    @property
+    def shares_session(self):
+        """True if others in this process use our ZooKeeper session"""
+        return self._session is not None and self._session.users > 1
+
     def dcs_connect(self):
-        self.connection.start()
+        self._registry = sessions
+        self._session = self._registry.acquire(self._connection_string, self._timeout, read_only=self.read_only)
+        self._zk = self._session.client
 
     def dcs_disconnect(self):
-        self._zk.stop()
-        self._zk = None
+        """Stop watching and release our session, returns True if it was closed"""
+        for listener in self._listeners_added:
+            self._session.listeners.remove(listener)
+        self._listeners_added = []
+        for watch in list(self._watchers.values()) + list(self._folder_watches.values()):
+            if isinstance(watch, DictWatch):
+                watch.stop()
+        self._watchers.clear()
+        self._folder_watches.clear()
+        self._listeners.clear()
+        self._lock_watches.clear()
+        session, self._session, self._zk = self._session, None, None
+        return self._registry.release(session)
+
+    def add_listener(self, listener):
+        """Call listener with the new state when the connection state changes"""
+        self._listeners_added.append(listener)
+        self._session.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self._listeners_added.remove(listener)
+        self._session.listeners.remove(listener)
 
     def _dict_watcher(self, group, what, callback):
-        def hook(state, key, from_val, to_val):
-            callback(_get_clusters(state))
         path = self._folder_path(what)
-        prefix = group and group + '-' or group
+        # ChildrenWatch silently stops watching if the path does not exist
+        wait_for_path = not self._ensure_path(path)
+        if group is None:
+            def flush(watch):
+                callback(watch.index.groups())
+            watch = DictWatch(self._zk, path, None, index=GroupIndex(),
+                    window=self._event_window, flush=flush, wait_for_path=wait_for_path)
+            self._watchers[id(watch)] = watch
+            return watch
+        self._listeners.setdefault((what, group), []).append(callback)
+        watch = self._folder_watches.get(what)
+        if watch is None:
+            watch = DictWatch(self._zk, path, partial(self._folder_changed, what),
+                    prefix=group + '-', index=GroupIndex(),
+                    window=self._event_window, flush=partial(self._folder_flushed, what),
+                    wait_for_path=wait_for_path)
+            self._folder_watches[what] = watch
+        else:
+            watch.add_prefix(group + '-')
+        return _GroupWatch(watch, group)
+
+    def _folder_changed(self, what, watch, key, from_val, to_val):
+        # {group: callbacks to call, None for all}, called once the batch is flushed
+        dirty = self._dirty.setdefault(what, {})
+        if key is None:
+            # an initial snapshot, listeners which have not seen their group yet get it now
+            for (this_what, group), listeners in self._listeners.items():
+                if this_what != what:
+                    continue
+                for callback in listeners:
+                    if (what, group, callback) not in self._introduced:
+                        self._introduced.add((what, group, callback))
+                        if dirty.get(group, ()) is not None:
+                            dirty.setdefault(group, set()).add(callback)
+            return
+        group, _ = key.split('-', 1)
+        dirty[group] = None
+
+    def _folder_flushed(self, what, watch):
+        for group, only in sorted(self._dirty.pop(what, {}).items()):
+            listeners = self._listeners.get((what, group))
+            if not listeners:
+                continue
+            members = watch.index.group(group)
+            for callback in list(listeners):
+                if (what, group, callback) not in self._introduced:
+                    continue
+                if only is None or callback in only:
+                    callback(group, members)
+
+    def _ensure_path(self, path):
+        """Create path if it does not exist, returns False if it could not be"""
         try:
-            watch = DictWatch(self._zk, path, hook, prefix=prefix)
-        except kazoo.exceptions.NoNodeError:
-            self._zk.create(path, makepath=True)
-            return self._dict_watcher(group, what, callback)
-        self._watchers[id(watch)] = watch
-        return watch
+            self._zk.ensure_path(path)
+        except kazoo.exceptions.NotReadOnlyCallError:
+            # connected to a read-only server, the first deadman creates it
+            if not self._zk.exists(path):
+                logging.info('{} does not exist yet, waiting for it'.format(path))
+                return False
+        return True
+
+    def dcs_unwatch(self, group):
+        """Stop calling the callbacks watching group"""
+        for key in list(self._listeners):
+            if key[1] == group:
+                del self._listeners[key]
+        for key in list(self._introduced):
+            if key[1] == group:
+                self._introduced.discard(key)
+        for key in list(self._lock_watches):
+            if key[0] == group:
+                del self._lock_watches[key]
 
     def _listen_connection(self, state):
         self._connection_state_changes.append(state)
         self._loop.call_soon_threadsafe(self._consume_connection_state_changes)
 
     def dcs_watch_conn_info(self, callback, group=None):
-        self._dict_watcher(group, 'conn', callback)
+        return self._dict_watcher(group, 'conn', callback)
 
     def dcs_watch_state(self, callback, group=None):
-        self._dict_watcher(group, 'state', callback)
+        return self._dict_watcher(group, 'state', callback)
+
+    def dcs_watch_stats(self, callback, group=None):
+        return self._dict_watcher(group, 'stats', callback)
 
     def _folder_path(self, folder):
         return self._path_prefix + folder
@@ -518,26 +1035,100 @@ class ZookeeperStorage:
             return 'owned'
         elif data == existing_data:
             # it is our log, perhaps I am restarting. of there are 2 of me running!
+            # break it and take it in one go, so no-one else can get it in between
+            transaction = self._zk.transaction()
+            transaction.delete(path, version=stat.version)
+            transaction.create(path, data, ephemeral=True)
             try:
-                self._zk.delete(path, version=stat.version)
+                self._commit(transaction)
             except (kazoo.exceptions.NoNodeError, kazoo.exceptions.BadVersionError):
-                # lock broke while we were looking at it
-                pass
-            # try get the lock again
-            result = self.dcs_lock(group, name, owner)
-            if result == 'locked':
-                return 'broken'
-            return result
+                # lock changed while we were looking at it, look again
+                return self.dcs_lock(group, name, owner)
+            return 'broken'
         return 'failed'
 
+    def _commit(self, transaction):
+        """Commit a transaction, raise the error of the operation which failed"""
+        results = transaction.commit()
+        for result in results:
+            if isinstance(result, Exception) and not isinstance(result, (
+                    kazoo.exceptions.RolledBackError,
+                    kazoo.exceptions.RuntimeInconsistency)):
+                raise result
+        return results
+
+    def _replace(self, transaction, path, data, stat):
+        """Add writing data to path to transaction, stat is what we last read of path.
+
+        returns how the node is written, like _set_info.
+        """
+        if stat is None:
+            transaction.create(path, data, ephemeral=True)
+            return 'create'
+        if stat.owner_session_id == self._zk.client_id[0]:
+            transaction.set_data(path, data, version=stat.version)
+            return 'existing'
+        # a node of another session (probably our previous one), replace it
+        transaction.delete(path, version=stat.version)
+        transaction.create(path, data, ephemeral=True)
+        return 'takeover'
+
+    def dcs_publish_promotion(self, group, owner, timeline, state):
+        """Publish the timeline and state of a new master in one transaction.
+
+        The transaction only succeeds if we still hold the master lock, else
+        nothing is written and 'lost' is returned. Otherwise returns how the
+        state was written, like _set_info.
+        """
+        lock_path = self._path(group, 'lock', 'master')
+        timeline_path = self._path(group, 'static', 'timeline')
+        state_path = self._path(group, 'state', owner)
+        requests = [self._zk.get_async(path) for path in (lock_path, timeline_path, state_path)]
+        lock, old_timeline, old_state = [self._get_result(request) for request in requests]
+        if lock is None or lock[1].owner_session_id != self._zk.client_id[0]:
+            return 'lost'
+        transaction = self._zk.transaction()
+        transaction.check(lock_path, lock[1].version)
+        data = str(timeline).encode('ascii')
+        if old_timeline is None:
+            transaction.create(timeline_path, data)
+        elif int(old_timeline[0].decode('ascii')) > timeline:
+            raise ValueError('Timelines can only increase.')
+        else:
+            transaction.set_data(timeline_path, data, version=old_timeline[1].version)
+        how = self._replace(transaction, state_path, self._codec.encode(state),
+                old_state and old_state[1])
+        try:
+            self._commit(transaction)
+        except (kazoo.exceptions.NoNodeError,
+                kazoo.exceptions.NodeExistsError,
+                kazoo.exceptions.BadVersionError):
+            # something changed while we were looking at it, look again
+            return self.dcs_publish_promotion(group, owner, timeline, state)
+        return how
+
+    def _get_result(self, request):
+        """(data, stat) of a get_async request, None if the node does not exist"""
+        try:
+            return request.get()
+        except kazoo.exceptions.NoNodeError:
+            return None
+
     def dcs_watch_lock(self, name, group, callback):
         loop = asyncio.get_event_loop()
+        token = self._lock_watches[group, name] = object()
         def handler(data, stat, event):
+            if self._lock_watches.get((group, name)) is not token:
+                return # unwatched
             if data is not None:
                 data = data.decode('utf-8')
             callback(data)
+        def watcher(data, stat, event):
+            if self._lock_watches.get((group, name)) is not token:
+                return False # stop watching
+            loop.call_soon_threadsafe(handler, data, stat, event)
         path = self._path(group, 'lock', name)
-        w = self._zk.DataWatch(path, partial(loop.call_soon_threadsafe, handler))
+        w = self._zk.DataWatch(path, watcher)
         self._watchers[id(w)] = w
 
     def dcs_get_database_identifiers(self):
@@ -547,72 +1138,84 @@ class ZookeeperStorage:
             children = self._zk.get_children(dirpath)
         except kazoo.exceptions.NoNodeError:
             return {}
+        wanted = [name for name in children if name.split('-', 1)[1] == wanted_info_name]
         result = {}
-        for name in children:
+        for name, data in self._get_children_data(dirpath, wanted):
             owner, info_name = name.split('-', 1)
-            if wanted_info_name != info_name:
-                continue
-            try:
-                data, state = self._zk.get(dirpath + '/' + name)
-            except kazoo.exceptions.NoNodeError:
-                continue
-            state = json.loads(data.decode('ascii'))
-            result[owner] = state
+            result[owner] = json.loads(data.decode('ascii'))
         return result
 
-    def dcs_watch_database_identifiers(self, callback):
-        name = 'database_identifier'
-        def handler(state, key, from_val, to_val):
-            # this is probably more complex than it needs to be!
-            c_state = _get_clusters(state)
-            new_state = {}
-            for k, v in c_state.items():
-                ours = v.get(name, None)
-                if ours is not None:
-                    new_state[k] = ours
-            callback(new_state)
-        dirpath = self._folder_path('static')
+    def _watch_named(self, folder, name, callback, window=0, coalesce=True):
+        """Call callback with {group: value} of the children called {group}-{name}"""
+        by_group = {}
+        changed = False
+        def handler(watch, key, from_val, to_val):
+            nonlocal changed
+            if key is None:
+                # the initial snapshot
+                for key, value in watch.items():
+                    group, this_name = key.split('-', 1)
+                    if this_name == name:
+                        by_group[group] = value
+                changed = True
+                return
+            group, this_name = key.split('-', 1)
+            if this_name != name:
+                return
+            if to_val is DictWatch.MISSING:
+                by_group.pop(group, None)
+            else:
+                by_group[group] = to_val
+            changed = True
+        def flush(watch):
+            nonlocal changed
+            if changed:
+                changed = False
+                callback(FrozenDict(by_group))
+        path = self._folder_path(folder)
+        wait_for_path = not self._ensure_path(path)
         watch = DictWatch(
                 self._zk,
-                dirpath,
+                path,
                 handler,
-                deserializer=lambda data: data.decode('utf-8'))
+                deserializer=lambda data: data.decode('utf-8'),
+                window=window,
+                flush=flush,
+                wait_for_path=wait_for_path,
+                coalesce=coalesce)
         self._watchers[id(watch)] = watch
 
+    def dcs_watch_database_identifiers(self, callback):
+        self._watch_named('static', 'database_identifier', callback, window=self._event_window)
+
     def dcs_watch_locks(self, name, callback):
-        def handler(state, key, from_val, to_val):
-            # this is probably more complex than it needs to be!
-            c_state = _get_clusters(state)
-            new_state = {}
-            for k, v in c_state.items():
-                ours = v.get(name, None)
-                if ours is not None:
-                    new_state[k] = ours
-            callback(new_state)
-        dirpath = self._folder_path('lock')
-        watch = DictWatch(
-                self._zk,
-                dirpath,
-                handler,
-                deserializer=lambda data: data.decode('utf-8'))
-        self._watchers[id(watch)] = watch
+        # lock changes trigger failovers, they are never held back or collapsed
+        self._watch_named('lock', name, callback, coalesce=False)
 
     def _set_info(self, group, type, owner, data):
         path = self._path(group, type, owner)
-        data = json.dumps(data)
-        data = data.encode('ascii')
+        return self._write_info(path, self._codec.encode(data))
+
+    def _write_info(self, path, data):
         try:
             stat = self._zk.set(path, data)
-            how = 'existing'
         except kazoo.exceptions.NoNodeError:
-            how = 'create'
-            stat = None
-        if stat is not None and stat.owner_session_id != self._zk.client_id[0]:
-            self._zk.delete(path)
-            how = 'takeover'
-            stat = None
-        if stat is None:
-            self._zk.create(path, data, ephemeral=True, makepath=True)
+            try:
+                self._zk.create(path, data, ephemeral=True, makepath=True)
+            except kazoo.exceptions.NodeExistsError:
+                # created while we were looking at it
+                return self._write_info(path, data)
+            return 'create'
+        if stat.owner_session_id == self._zk.client_id[0]:
+            return 'existing'
+        # the node of another session, replace it in one transaction. The
+        # version check makes sure no-one wrote to it since our set.
+        transaction = self._zk.transaction()
+        how = self._replace(transaction, path, data, stat)
+        try:
+            self._commit(transaction)
+        except (kazoo.exceptions.NoNodeError, kazoo.exceptions.BadVersionError):
+            return self._write_info(path, data)
         return how
 
     def dcs_set_conn_info(self, group, owner, data):
@@ -621,19 +1224,39 @@ class ZookeeperStorage:
     def dcs_set_state(self, group, owner, data):
         return self._set_info(group, 'state', owner, data)
 
+    def dcs_set_stats(self, group, owner, data):
+        return self._set_info(group, 'stats', owner, data)
+
+    def _get_children_data(self, dirpath, names):
+        """Get the data of many children of dirpath.
+
+        All the requests are sent before waiting for the first answer, so this
+        takes about one round trip to ZooKeeper instead of one per child.
+        Children deleted while we are reading are left out.
+        """
+        requests = [(name, self._zk.get_async(dirpath + '/' + name)) for name in names]
+        result = []
+        for name, request in requests:
+            try:
+                data, stat = request.get()
+            except kazoo.exceptions.NoNodeError:
+                continue
+            result.append((name, data))
+        return result
+
     def _get_all_info(self, group, type):
         dirpath = self._folder_path(type)
         try:
             children = self._zk.get_children(dirpath)
         except kazoo.exceptions.NoNodeError:
-            return iter([])
-        for name in children:
+            return []
+        if group is not None:
+            children = [name for name in children if name.split('-', 1)[0] == group]
+        result = []
+        for name, data in self._get_children_data(dirpath, children):
             this_group, owner = name.split('-', 1)
-            if group is not None and this_group != group:
-                continue
-            data, state = self._zk.get(dirpath + '/' + name)
-            state = json.loads(data.decode('ascii'))
-            yield owner, state
+            result.append((owner, decode(data)))
+        return result
 
     def dcs_list_conn_info(self, group=None):
         return list(self._get_all_info(group, 'conn'))
@@ -641,9 +1264,21 @@ class ZookeeperStorage:
     def dcs_list_state(self, group=None):
         return list(self._get_all_info(group, 'state'))
 
-    def dcs_delete_conn_info(self, group, owner):
-        path = self._path(group, 'conn', owner)
+    def dcs_list_stats(self, group=None):
+        return list(self._get_all_info(group, 'stats'))
+
+    def _delete_info(self, group, type, owner):
+        path = self._path(group, type, owner)
         try:
             self._zk.delete(path)
         except kazoo.exceptions.NoNodeError:
             pass
+
+    def dcs_delete_conn_info(self, group, owner):
+        self._delete_info(group, 'conn', owner)
+
+    def dcs_delete_state(self, group, owner):
+        self._delete_info(group, 'state', owner)
+
+    def dcs_delete_stats(self, group, owner):
+        self._delete_info(group, 'stats', owner)